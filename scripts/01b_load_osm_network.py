@@ -38,6 +38,9 @@ with open(r"../config.yml") as file:
     db_host = parsed_yaml_file["db_host"]
     db_port = parsed_yaml_file["db_port"]
 
+    simplification_processes = parsed_yaml_file["simplification_processes"]
+    simplification_tile_size = parsed_yaml_file["simplification_tile_size"]
+
 print("Settings loaded!")
 
 #%%
@@ -185,8 +188,10 @@ G_ox = ox.graph_from_gdfs(ox_nodes, ox_edges)
 
 #%%
 # Simplify grap
-G_sim = sf.simplify_graph(
+G_sim = sf.simplify_graph_parallel(
     G_ox,
+    processes=simplification_processes,
+    tile_size=simplification_tile_size,
     attributes=[
         "highway",
         "cycleway",
@@ -253,15 +258,16 @@ connection = dbf.connect_pg(db_name, db_user, db_password)
 
 engine = dbf.connect_alc(db_name, db_user, db_password, db_port=db_port)
 
-dbf.to_postgis(geodataframe=ox_edges, table_name="osm_edges", engine=engine)
+# Bulk load with COPY - indexes are created after loading
+dbf.to_postgis(geodataframe=ox_edges, table_name="osm_edges", engine=engine, copy=True)
 
-dbf.to_postgis(ox_nodes, "osm_nodes", engine)
+dbf.to_postgis(ox_nodes, "osm_nodes", engine, copy=True)
 
 dbf.to_postgis(
-    geodataframe=ox_edges_s, table_name="osm_edges_simplified", engine=engine
+    geodataframe=ox_edges_s, table_name="osm_edges_simplified", engine=engine, copy=True
 )
 
-dbf.to_postgis(ox_nodes_s, "osm_nodes_simplified", engine)
+dbf.to_postgis(ox_nodes_s, "osm_nodes_simplified", engine, copy=True)
 
 q = "SELECT edge_id, name, highway FROM osm_edges_simplified LIMIT 10;"
 
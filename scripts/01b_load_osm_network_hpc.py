@@ -32,6 +32,11 @@ with open(r"../config.yml") as file:
     db_host = parsed_yaml_file["db_host"]
     db_port = parsed_yaml_file["db_port"]
 
+    simplification_tile_size = parsed_yaml_file["simplification_tile_size"]
+
+# Use all cores allocated to the SLURM job
+processes = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+
 print("Settings loaded!")
 
 osm = pyrosm.OSM(osm_fp)
@@ -169,8 +174,10 @@ G_ox = ox.graph_from_gdfs(ox_nodes, ox_edges)
 
 
 # Simplify grap
-G_sim = sf.simplify_graph(
+G_sim = sf.simplify_graph_parallel(
     G_ox,
+    processes=processes,
+    tile_size=simplification_tile_size,
     attributes=[
         "highway",
         "cycleway",
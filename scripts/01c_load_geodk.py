@@ -55,7 +55,7 @@ connection = dbf.connect_pg(db_name, db_user, db_password)
 
 engine = dbf.connect_alc(db_name, db_user, db_password, db_port=db_port)
 
-dbf.to_postgis(geodataframe=geodk_bike, table_name='geodk_bike', engine=engine)
+dbf.to_postgis(geodataframe=geodk_bike, table_name='geodk_bike', engine=engine, copy=True)
 
 q = 'SELECT edge_id, vejklasse FROM geodk_bike LIMIT 10;'
 
@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 import json
 import pickle
 from src import matching_functions as mf
+from src import cache_functions as cf
 from src import db_functions as dbf
 from timeit import default_timer as timer
 
@@ -17,6 +18,11 @@ with open(r'../config.yml') as file:
 
     crs = parsed_yaml_file['CRS']
 
+    segment_cache_dir = parsed_yaml_file['segment_cache_dir']
+    segment_cache_max_size = parsed_yaml_file['segment_cache_max_size']
+
+    angle_method = parsed_yaml_file['matching_angle_method']
+
     db_name = parsed_yaml_file['db_name']
     db_user = parsed_yaml_file['db_user']
     db_password = parsed_yaml_file['db_password']
@@ -52,13 +58,13 @@ geodk = geodk.cx[bb[0]:bb[2],bb[1]:bb[3]]
 
 #%%
 # Create segments
-osm_segments = mf.create_segment_gdf(osm_edges_simplified, segment_length=10)
+osm_segments = cf.create_segment_gdf_cached(osm_edges_simplified, segment_length=10, segment_func=mf.create_segment_gdf, cache_dir=segment_cache_dir, max_size=segment_cache_max_size)
 osm_segments.rename(columns={'osmid':'org_osmid'}, inplace=True)
 osm_segments['osmid'] = osm_segments['edge_id'] # Because matching function assumes an id column names osmid as unique id for edges
 osm_segments.set_crs(crs, inplace=True)
 osm_segments.dropna(subset=['geometry'],inplace=True)
 
-ref_segments = mf.create_segment_gdf(geodk, segment_length=10)
+ref_segments = cf.create_segment_gdf_cached(geodk, segment_length=10, segment_func=mf.create_segment_gdf, cache_dir=segment_cache_dir, max_size=segment_cache_max_size)
 ref_segments.set_crs(crs, inplace=True)
 ref_segments.rename(columns={'seg_id':'seg_id_ref'}, inplace=True) 
 ref_segments.dropna(subset=['geometry'],inplace=True)
@@ -80,12 +86,13 @@ start = timer()
 
 print('Starting matching...')
 
-cycling_buffer_matches = mf.overlay_buffer(reference_data=ref_segments, osm_data=osm_cycling_segments, ref_id_col='seg_id_ref', osm_id_col='seg_id', dist=15)
+cycling_buffer_matches = mf.get_candidate_store(reference_data=ref_segments, osm_data=osm_cycling_segments, ref_id_col='seg_id_ref', osm_id_col='seg_id', dist=15)
+mf.save_candidate_store(cycling_buffer_matches, '../data/cycling_buffer_matches.npz')
 
 print('Buffer matches found!')
 
 # Find segment matches
-cycling_segment_matches = mf.find_matches_from_buffer(buffer_matches=cycling_buffer_matches, osm_edges=osm_cycling_segments, reference_data=ref_segments, angular_threshold=30, hausdorff_threshold=17)
+cycling_segment_matches = mf.find_matches_from_buffer(buffer_matches=cycling_buffer_matches, osm_edges=osm_cycling_segments, reference_data=ref_segments, angular_threshold=30, hausdorff_threshold=17, angle_method=angle_method)
 
 print('Feature matching of bike segments completed!')
 
@@ -116,12 +123,13 @@ osm_segments_no_bike = osm_segments.loc[osm_segments.cycling_infrastructure =='n
 # Match segments v. 2
 print('Starting matching of unmatched segments...')
 
-buffer_matches_unmatched = mf.overlay_buffer(reference_data=ref_segments_unmatched, osm_data=osm_segments_no_bike, ref_id_col='seg_id_ref', osm_id_col='seg_id', dist=15)
+buffer_matches_unmatched = mf.get_candidate_store(reference_data=ref_segments_unmatched, osm_data=osm_segments_no_bike, ref_id_col='seg_id_ref', osm_id_col='seg_id', dist=15)
+mf.save_candidate_store(buffer_matches_unmatched, '../data/buffer_matches_unmatched.npz')
 
 print('Buffer matches found!')
 
 # Find segment matches v.2
-segment_matches_unmatched = mf.find_matches_from_buffer(buffer_matches=buffer_matches_unmatched, osm_edges=osm_segments_no_bike, reference_data=ref_segments_unmatched, angular_threshold=30, hausdorff_threshold=17)
+segment_matches_unmatched = mf.find_matches_from_buffer(buffer_matches=buffer_matches_unmatched, osm_edges=osm_segments_no_bike, reference_data=ref_segments_unmatched, angular_threshold=30, hausdorff_threshold=17, angle_method=angle_method)
 
 print('Feature matching round 2 completed!')
 
@@ -172,16 +180,14 @@ print(f'Out of {geodk.geometry.length.sum()/1000:.2f} km of reference edges, {le
 
 #%%
 # Summarize matches with based on attributes
-updated_osm_vejklasse = mf.update_osm(osm_segments, osm_edges_simplified, segment_matches, 'vejklasse', 'edge_id','seg_id')
-
-updated_osm_overflade = mf.update_osm(osm_segments, osm_edges_simplified, segment_matches, 'overflade', 'edge_id','seg_id')
+updated_osm = mf.update_osm(osm_segments, osm_edges_simplified, segment_matches, ['vejklasse', 'overflade'], 'edge_id','seg_id')
 
 #%%
 # Export results
 
 # Create dataframe with osm_edge_ids and new attribute value
-matched_osm_vejklasse = updated_osm_vejklasse[['edge_id','vejklasse']]
-matched_osm_overflade = updated_osm_overflade[['edge_id','overflade']]
+matched_osm_vejklasse = updated_osm.loc[updated_osm.vejklasse.notna(), ['edge_id','vejklasse']]
+matched_osm_overflade = updated_osm.loc[updated_osm.overflade.notna(), ['edge_id','overflade']]
 
 
 print('Saving data to PostgreSQL!')
@@ -227,7 +233,7 @@ with open('../results/matched_osm_roadclass', 'w') as fp:
         json.dump(matched_osm_roadclass_dict, fp)
 
 matched_osm_overflade.set_index('edge_id',inplace=True)
-matched_osm_overflade_dict = matched_osm_vejklasse.to_dict('index')
+matched_osm_overflade_dict = matched_osm_overflade.to_dict('index')
 
 with open('../results/matched_osm_surface', 'w') as fp:
         json.dump(matched_osm_overflade_dict, fp)
@@ -6,7 +6,9 @@ import yaml
 import matplotlib.pyplot as plt
 import json
 import pickle
+import os
 from src import matching_functions as mf
+from src import cache_functions as cf
 from src import db_functions as dbf
 from timeit import default_timer as timer
 
@@ -15,6 +17,16 @@ with open(r'../config.yml') as file:
 
     crs = parsed_yaml_file['CRS']
 
+    segment_cache_dir = parsed_yaml_file['segment_cache_dir']
+    segment_cache_max_size = parsed_yaml_file['segment_cache_max_size']
+    checkpoint_dir = parsed_yaml_file['matching_checkpoint_dir']
+    matching_state_fp = parsed_yaml_file['matching_state_fp']
+
+    tile_size = parsed_yaml_file['matching_tile_size']
+    angle_method = parsed_yaml_file['matching_angle_method']
+
+# Use all cores allocated to the SLURM job
+processes = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
   
 print('Settings loaded!')
 
@@ -30,37 +42,53 @@ get_osm = 'SELECT osmid, cycling_infrastructure, highway, edge_id, geometry FROM
 osm_edges_simplified = None
 geodk = None
  
+# Each stage is checkpointed and skipped if it has already been completed with the same inputs
+
 # Create segments
-osm_segments = mf.create_segment_gdf(osm_edges_simplified, segment_length=10)
-osm_segments.rename(columns={'osmid':'org_osmid'}, inplace=True)
-osm_segments['osmid'] = osm_segments['edge_id'] # Because matching function assumes an id column names osmid as unique id for edges
-osm_segments.set_crs(crs, inplace=True)
-osm_segments.dropna(subset=['geometry'],inplace=True)
+def create_segments(osm_edges, reference_edges):
+
+    osm_segments = cf.create_segment_gdf_cached(osm_edges, segment_length=10, segment_func=mf.create_segment_gdf, cache_dir=segment_cache_dir, max_size=segment_cache_max_size)
+    osm_segments.rename(columns={'osmid':'org_osmid'}, inplace=True)
+    osm_segments['osmid'] = osm_segments['edge_id'] # Because matching function assumes an id column names osmid as unique id for edges
+    osm_segments.set_crs(crs, inplace=True)
+    osm_segments.dropna(subset=['geometry'],inplace=True)
 
-ref_segments = mf.create_segment_gdf(geodk, segment_length=10)
-ref_segments.set_crs(crs, inplace=True)
-ref_segments.rename(columns={'seg_id':'seg_id_ref'}, inplace=True) 
-ref_segments.dropna(subset=['geometry'],inplace=True)
+    ref_segments = cf.create_segment_gdf_cached(reference_edges, segment_length=10, segment_func=mf.create_segment_gdf, cache_dir=segment_cache_dir, max_size=segment_cache_max_size)
+    ref_segments.set_crs(crs, inplace=True)
+    ref_segments.rename(columns={'seg_id':'seg_id_ref'}, inplace=True) 
+    ref_segments.dropna(subset=['geometry'],inplace=True)
+
+    return osm_segments, ref_segments
+
+osm_segments, ref_segments = cf.run_stage('segment', create_segments, checkpoint_dir, osm_edges=osm_edges_simplified, reference_edges=geodk)
 
 print('Segments created!')
 
+# Buffer candidates and best matches are found per tile - finished tiles are checkpointed and skipped when restarting
+def match_segments(osm_data, reference_data, angle_method, tile_checkpoint_dir):
+
+    segment_matches = mf.match_networks_tiled(osm_data=osm_data, reference_data=reference_data, ref_id_col='seg_id_ref', osm_id_col='seg_id', dist=15, angular_threshold=30, hausdorff_threshold=17, angle_method=angle_method, tile_size=tile_size, processes=processes, checkpoint_dir=tile_checkpoint_dir)
+
+    return segment_matches
+
+def summarize_matches(osm_data, reference_data, segment_matches):
+
+    osm_matched_ids, osm_undec = mf.summarize_feature_matches(osm_data, segment_matches,'seg_id','osmid',osm=True)
+
+    ref_matched_ids, ref_undec = mf.summarize_feature_matches(reference_data, segment_matches, 'seg_id_ref','edge_id',osm=False)
+
+    return osm_matched_ids, osm_undec, ref_matched_ids, ref_undec
+
 # MATCH CYCLING SEGMENTS
 osm_cycling_segments = osm_segments.loc[osm_segments.cycling_infrastructure =='yes'] # Get cycling segments for first matching process
 
-cycling_buffer_matches = mf.overlay_buffer(reference_data=ref_segments, osm_data=osm_cycling_segments, ref_id_col='seg_id_ref', osm_id_col='seg_id', dist=15)
-
 # Find segment matches
-cycling_segment_matches = mf.find_matches_from_buffer(buffer_matches=cycling_buffer_matches, osm_edges=osm_cycling_segments, reference_data=ref_segments, angular_threshold=30, hausdorff_threshold=17)
-
-matches_fp = f'../data/cycling_segment_matches.pickle'
-with open(matches_fp, 'wb') as f:
-        pickle.dump(cycling_segment_matches, f)
+cycling_segment_matches = cf.run_stage('match_cycling', match_segments, checkpoint_dir, osm_data=osm_cycling_segments, reference_data=ref_segments, angle_method=angle_method, tile_checkpoint_dir=f'{checkpoint_dir}/tiles_cycling')
 
 # Summarize to feature matches
-osm_matched_ids, osm_undec = mf.summarize_feature_matches(osm_cycling_segments, cycling_segment_matches,'seg_id','osmid',osm=True)
-osm_edges_simplified.loc[osm_edges_simplified.edge_id.isin(osm_matched_ids)].plot();
+osm_matched_ids, osm_undec, ref_matched_ids, ref_undec = cf.run_stage('summarize_cycling', summarize_matches, checkpoint_dir, osm_data=osm_cycling_segments, reference_data=ref_segments, segment_matches=cycling_segment_matches)
 
-ref_matched_ids, ref_undec = mf.summarize_feature_matches(ref_segments, cycling_segment_matches, 'seg_id_ref','edge_id',osm=False)
+osm_edges_simplified.loc[osm_edges_simplified.edge_id.isin(osm_matched_ids)].plot();
 geodk.loc[geodk.edge_id.isin(ref_matched_ids)].plot();
 
 print('Matches summarized!')
@@ -73,21 +101,13 @@ osm_segments_no_bike = osm_segments.loc[osm_segments.cycling_infrastructure =='n
 
  
 # MATCH REMAINING SEGMENTS
-buffer_matches_unmatched = mf.overlay_buffer(reference_data=ref_segments_unmatched, osm_data=osm_segments_no_bike, ref_id_col='seg_id_ref', osm_id_col='seg_id', dist=15)
-
 # Find segment matches v.2
-segment_matches_unmatched = mf.find_matches_from_buffer(buffer_matches=buffer_matches_unmatched, osm_edges=osm_segments_no_bike, reference_data=ref_segments_unmatched, angular_threshold=30, hausdorff_threshold=17)
-
-matches_fp = f'../data/segment_matches_unmatched.pickle'
-with open(matches_fp, 'wb') as f:
-        pickle.dump(segment_matches_unmatched, f)
+segment_matches_unmatched = cf.run_stage('match_unmatched', match_segments, checkpoint_dir, osm_data=osm_segments_no_bike, reference_data=ref_segments_unmatched, angle_method=angle_method, tile_checkpoint_dir=f'{checkpoint_dir}/tiles_unmatched')
 
 # Summarize to feature matches
-osm_matched_ids_2, osm_undec_2 = mf.summarize_feature_matches(osm_segments_no_bike, segment_matches_unmatched,'seg_id','osmid',osm=True)
-osm_edges_simplified.loc[osm_edges_simplified.edge_id.isin(osm_matched_ids_2)].plot();
+osm_matched_ids_2, osm_undec_2, ref_matched_ids_2, ref_undec_2 = cf.run_stage('summarize_unmatched', summarize_matches, checkpoint_dir, osm_data=osm_segments_no_bike, reference_data=ref_segments_unmatched, segment_matches=segment_matches_unmatched)
 
-# Summarize
-ref_matched_ids_2, ref_undec_2 = mf.summarize_feature_matches(ref_segments_unmatched, segment_matches_unmatched, 'seg_id_ref','edge_id',osm=False)
+osm_edges_simplified.loc[osm_edges_simplified.edge_id.isin(osm_matched_ids_2)].plot();
 geodk.loc[geodk.edge_id.isin(ref_matched_ids_2)].plot();
  
 # Merge matches
@@ -100,18 +120,31 @@ matches_fp = f'../data/segment_matches_full.pickle'
 with open(matches_fp, 'wb') as f:
         pickle.dump(segment_matches, f)
 
+# Store data and matches for later incremental runs (02a_match_networks_incremental.py)
+# Features are stored as hashes, and the incremental run compares them with the new data chunk by chunk
+matching_state = {
+    'osm_hashes': mf.get_feature_hashes(osm_edges_simplified, 'edge_id'),
+    'geodk_hashes': mf.get_feature_hashes(geodk, 'edge_id'),
+    'osm_segments': osm_segments,
+    'ref_segments': ref_segments,
+    'cycling_segment_matches': cycling_segment_matches,
+    'segment_matches_unmatched': segment_matches_unmatched,
+    'ref_matched_ids': ref_matched_ids,
+}
+
+with open(matching_state_fp, 'wb') as f:
+        pickle.dump(matching_state, f)
+
  
 # Summarize matches with based on attributes
-updated_osm_vejklasse = mf.update_osm(osm_segments, osm_edges_simplified, segment_matches, 'vejklasse', 'edge_id','seg_id')
-
-updated_osm_overflade = mf.update_osm(osm_segments, osm_edges_simplified, segment_matches, 'overflade', 'edge_id','seg_id')
+updated_osm = cf.run_stage('attribute_transfer', mf.update_osm, checkpoint_dir, osm_segments=osm_segments, osm_data=osm_edges_simplified, final_matches=segment_matches, attr=['vejklasse', 'overflade'], edge_id_col='edge_id', seg_id_col='seg_id')
 
  
 # EXPORT RESULTS
 
 # Create dataframe with osm_edge_ids and new attribute value
-matched_osm_vejklasse = updated_osm_vejklasse[['edge_id','vejklasse']]
-matched_osm_overflade = updated_osm_overflade[['edge_id','overflade']]
+matched_osm_vejklasse = updated_osm.loc[updated_osm.vejklasse.notna(), ['edge_id','vejklasse']]
+matched_osm_overflade = updated_osm.loc[updated_osm.overflade.notna(), ['edge_id','overflade']]
 
 print('Saving data to file!')
 
@@ -122,7 +155,7 @@ with open('../results/matched_osm_roadclass', 'w') as fp:
         json.dump(matched_osm_roadclass_dict, fp)
 
 matched_osm_overflade.set_index('edge_id',inplace=True)
-matched_osm_overflade_dict = matched_osm_vejklasse.to_dict('index')
+matched_osm_overflade_dict = matched_osm_overflade.to_dict('index')
 
 with open('../results/matched_osm_surface', 'w') as fp:
         json.dump(matched_osm_overflade_dict, fp)
@@ -0,0 +1,184 @@
+#%%
+# Incremental version of 02a_match_networks_hpc.py
+# Compares the current osm_edges_simplified and geodk_bike with the data used in the last matching run,
+# and only matches the segments close to changed features again.
+# Requires a matching state saved by a previous full (or incremental) run.
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import yaml
+import json
+import pickle
+from src import matching_functions as mf
+from src import db_functions as dbf
+
+with open(r'../config.yml') as file:
+    parsed_yaml_file = yaml.load(file, Loader=yaml.FullLoader)
+
+    crs = parsed_yaml_file['CRS']
+
+    matching_state_fp = parsed_yaml_file['matching_state_fp']
+    db_chunksize = parsed_yaml_file['db_chunksize']
+
+    angle_method = parsed_yaml_file['matching_angle_method']
+
+    db_name = parsed_yaml_file['db_name']
+    db_user = parsed_yaml_file['db_user']
+    db_password = parsed_yaml_file['db_password']
+    db_host = parsed_yaml_file['db_host']
+    db_port = parsed_yaml_file['db_port']
+
+print('Settings loaded!')
+
+#%%
+# Load previous run
+with open(matching_state_fp, 'rb') as f:
+    matching_state = pickle.load(f)
+
+old_osm_segments = matching_state['osm_segments']
+old_ref_segments = matching_state['ref_segments']
+
+# Load new data chunk by chunk - only the hashes of all features and the added and changed features are kept in memory
+engine = dbf.connect_alc(db_name, db_user, db_password, db_port=db_port)
+
+def read_changed_features(table_name, columns, old_hashes):
+
+    hashes = []
+    changed = []
+
+    for chunk in dbf.read_postgis_chunks(table_name, engine, columns=columns, chunksize=db_chunksize):
+
+        chunk_hashes = mf.get_feature_hashes(chunk, 'edge_id')
+        hashes.append(chunk_hashes)
+
+        known = chunk_hashes.index.isin(old_hashes.index)
+        unchanged = np.zeros(len(chunk), dtype=bool)
+        unchanged[known] = old_hashes.loc[chunk_hashes.index[known]].values == chunk_hashes.values[known]
+
+        changed.append(chunk[~unchanged])
+
+    hashes = pd.concat(hashes)
+    changed = gpd.GeoDataFrame(pd.concat(changed, ignore_index=True), geometry='geometry', crs=changed[0].crs)
+
+    assert len(hashes) == len(hashes.index.unique())
+
+    return hashes, changed
+
+# Same columns as in 02a_match_networks_hpc.py, so the hashes can be compared
+osm_hashes, changed_osm_edges = read_changed_features('osm_edges_simplified', ['osmid', 'cycling_infrastructure', 'highway', 'edge_id', 'geometry'], matching_state['osm_hashes'])
+
+geodk_hashes, changed_geodk = read_changed_features('geodk_bike', None, matching_state['geodk_hashes'])
+
+#%%
+# Find changed features
+changed_osm_ids = mf.compare_feature_hashes(matching_state['osm_hashes'], osm_hashes)
+changed_ref_ids = mf.compare_feature_hashes(matching_state['geodk_hashes'], geodk_hashes)
+
+# Previous and new geometries of changed features - the previous geometries are covered by their segments from the last run
+changed_geoms = np.concatenate([
+    old_osm_segments.loc[old_osm_segments.edge_id.isin(changed_osm_ids)].geometry.values,
+    changed_osm_edges.geometry.values,
+    old_ref_segments.loc[old_ref_segments.edge_id.isin(changed_ref_ids)].geometry.values,
+    changed_geodk.geometry.values,
+])
+
+#%%
+# Update segments - only changed features are segmented again
+def create_osm_segments(osm_edges):
+
+    osm_segments = mf.create_segment_gdf(osm_edges, segment_length=10)
+    osm_segments.rename(columns={'osmid':'org_osmid'}, inplace=True)
+    osm_segments['osmid'] = osm_segments['edge_id'] # Because matching function assumes an id column names osmid as unique id for edges
+    osm_segments.set_crs(crs, inplace=True)
+    osm_segments.dropna(subset=['geometry'],inplace=True)
+
+    return osm_segments
+
+def create_ref_segments(reference_edges):
+
+    ref_segments = mf.create_segment_gdf(reference_edges, segment_length=10)
+    ref_segments.set_crs(crs, inplace=True)
+    ref_segments.rename(columns={'seg_id':'seg_id_ref'}, inplace=True)
+    ref_segments.dropna(subset=['geometry'],inplace=True)
+
+    return ref_segments
+
+osm_segments = mf.update_segments(old_osm_segments, changed_osm_edges, changed_osm_ids, 'edge_id', 'seg_id', create_osm_segments)
+ref_segments = mf.update_segments(old_ref_segments, changed_geodk, changed_ref_ids, 'edge_id', 'seg_id_ref', create_ref_segments)
+
+print('Segments updated!')
+
+#%%
+# MATCH CYCLING SEGMENTS
+osm_cycling_segments = osm_segments.loc[osm_segments.cycling_infrastructure =='yes']
+
+cycling_segment_matches = mf.rematch_changed(osm_data=osm_cycling_segments, reference_data=ref_segments, old_matches=matching_state['cycling_segment_matches'], changed_geoms=changed_geoms, ref_id_col='seg_id_ref', osm_id_col='seg_id', dist=15, angular_threshold=30, hausdorff_threshold=17, angle_method=angle_method)
+
+osm_matched_ids, osm_undec = mf.summarize_feature_matches(osm_cycling_segments, cycling_segment_matches,'seg_id','osmid',osm=True)
+ref_matched_ids, ref_undec = mf.summarize_feature_matches(ref_segments, cycling_segment_matches, 'seg_id_ref','edge_id',osm=False)
+
+print('Matches summarized!')
+
+#%%
+# MATCH REMAINING SEGMENTS
+ref_segments_unmatched = ref_segments.loc[~ref_segments.edge_id.isin(ref_matched_ids)]
+
+osm_segments_no_bike = osm_segments.loc[osm_segments.cycling_infrastructure =='no']
+
+# Reference features that moved in or out of the unmatched data must also be matched again
+moved_ref_ids = np.setxor1d(matching_state['ref_matched_ids'], ref_matched_ids)
+changed_geoms_2 = np.concatenate([changed_geoms, ref_segments.loc[ref_segments.edge_id.isin(moved_ref_ids)].geometry.values])
+
+segment_matches_unmatched = mf.rematch_changed(osm_data=osm_segments_no_bike, reference_data=ref_segments_unmatched, old_matches=matching_state['segment_matches_unmatched'], changed_geoms=changed_geoms_2, ref_id_col='seg_id_ref', osm_id_col='seg_id', dist=15, angular_threshold=30, hausdorff_threshold=17, angle_method=angle_method)
+
+# Merge matches
+segment_matches = pd.concat([cycling_segment_matches, segment_matches_unmatched])
+
+assert len(segment_matches) == len(cycling_segment_matches) + len(segment_matches_unmatched)
+
+matches_fp = f'../data/segment_matches_full.pickle'
+with open(matches_fp, 'wb') as f:
+        pickle.dump(segment_matches, f)
+
+# Store data and matches for the next incremental run
+matching_state = {
+    'osm_hashes': osm_hashes,
+    'geodk_hashes': geodk_hashes,
+    'osm_segments': osm_segments,
+    'ref_segments': ref_segments,
+    'cycling_segment_matches': cycling_segment_matches,
+    'segment_matches_unmatched': segment_matches_unmatched,
+    'ref_matched_ids': ref_matched_ids,
+}
+
+with open(matching_state_fp, 'wb') as f:
+        pickle.dump(matching_state, f)
+
+print('Matching state saved!')
+
+#%%
+# Summarize matches with based on attributes
+# Only the ids of the osm edges are exported, so the full edges are not needed
+osm_edge_ids = pd.DataFrame({'edge_id': osm_hashes.index.values})
+
+updated_osm = mf.update_osm(osm_segments, osm_edge_ids, segment_matches, ['vejklasse', 'overflade'], 'edge_id', 'seg_id')
+
+# EXPORT RESULTS
+matched_osm_vejklasse = updated_osm.loc[updated_osm.vejklasse.notna(), ['edge_id','vejklasse']]
+matched_osm_overflade = updated_osm.loc[updated_osm.overflade.notna(), ['edge_id','overflade']]
+
+print('Saving data to file!')
+
+matched_osm_vejklasse.set_index('edge_id',inplace=True)
+matched_osm_roadclass_dict = matched_osm_vejklasse.to_dict('index')
+
+with open('../results/matched_osm_roadclass', 'w') as fp:
+        json.dump(matched_osm_roadclass_dict, fp)
+
+matched_osm_overflade.set_index('edge_id',inplace=True)
+matched_osm_overflade_dict = matched_osm_overflade.to_dict('index')
+
+with open('../results/matched_osm_surface', 'w') as fp:
+        json.dump(matched_osm_overflade_dict, fp)
+
+# %%
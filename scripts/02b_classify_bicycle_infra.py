@@ -4,7 +4,9 @@ Classifies all OSM edges and intersection nodes and fills out missing values for
 
 #%%
 import yaml
+import pandas as pd
 from src import db_functions as dbf
+from src import sql_functions as sqlf
 
 #%%
 
@@ -24,52 +26,18 @@ with open(r'../config.yml') as file:
     db_password = parsed_yaml_file['db_password']
     db_host = parsed_yaml_file['db_host']
     db_port = parsed_yaml_file['db_port']
+
+    sql_processes = parsed_yaml_file['sql_processes']
+    sql_stage_state_fp = parsed_yaml_file['sql_stage_state_fp']
+    sql_set_based = parsed_yaml_file['sql_set_based']
   
 print('Settings loaded!')
-#%%
-
-print('Classifying intersection nodes!')
-
-connection = dbf.connect_pg(db_name, db_user, db_password)
-
-q = 'sql/intersections.sql'
-
-inter = dbf.run_query_pg(q, connection)
-
-q = 'SELECT osmid, count, inter_type FROM intersections WHERE inter_type IS NOT NULL LIMIT 10;'
-
-test = dbf.run_query_pg(q, connection)
-
-print(test)
 
-connection.close()
+# All queries borrow connections from the same pool
+pool = dbf.get_pool(db_name, db_user, db_password, db_host=db_host, db_port=db_port, max_conn=sql_processes + 1)
 
 #%%
-
-print('Classifying edges...')
-
-connection = dbf.connect_pg(db_name, db_user, db_password)
-
-engine = dbf.connect_alc(db_name, db_user, db_password, db_port=db_port)
-
-q = 'sql/classify_bicycle_infra.sql'
-
-classify = dbf.run_query_pg(q, connection)
-
-connection = dbf.connect_pg(db_name, db_user, db_password)
-
-q = "SELECT edge_id, protected FROM osm_edges_simplified WHERE protected = 'true' LIMIT 10;"
-
-test = dbf.run_query_pg(q, connection)
-
-print(test)
-
-#%%
-# Classify edges as urban/rural etc
-
-print('Classifying edges as urban/non-urban...')
-
-connection = dbf.connect_pg(db_name, db_user, db_password)
+# Classify edges as urban/rural etc - the view is used by classify_urban_network.sql
 
 create_view = f'''
 CREATE VIEW urban_nodes AS 
@@ -82,49 +50,53 @@ JOIN osm_nodes_simplified AS nodes
 ON ST_Intersects(polys.geometry, nodes.geometry));
 '''
 
-view = dbf.run_query_pg(create_view, connection)
+view = dbf.run_query_pg(create_view, pool)
 
-classify_urban = 'sql/classify_urban_network.sql'
-classify = dbf.run_query_pg(classify_urban, connection)
+#%%
+# The stages are run as one pipeline, since later stages change the tables of earlier stages.
+# The set based versions compute all columns in one pass into a new table instead of updating the table for every value
+print('Classifying intersection nodes and edges, interpolating missing attributes and creating cycling network...')
+
+stages = [
+    'sql/intersections.sql',
+    'sql/classify_bicycle_infra_set.sql' if sql_set_based else 'sql/classify_bicycle_infra.sql',
+    'sql/classify_urban_network.sql',
+    'sql/fill_missing_values_set.sql' if sql_set_based else 'sql/fill_missing_values.sql',
+    'sql/create_cycling_network.sql',
+]
 
-drop = dbf.run_query_pg('DROP VIEW urban_nodes;', connection)
+timings = sqlf.run_sql_stages(stages, pool, processes=sql_processes, state_fp=sql_stage_state_fp)
 
-connection.close()
+drop = dbf.run_query_pg('DROP VIEW urban_nodes;', pool)
 
 #%%
-print('Interpolating missing attributes...')
+q = 'SELECT osmid, count, inter_type FROM intersections WHERE inter_type IS NOT NULL LIMIT 10;'
 
-connection = dbf.connect_pg(db_name, db_user, db_password)
+test = dbf.run_query_pg(q, pool)
 
-engine = dbf.connect_alc(db_name, db_user, db_password, db_port=db_port)
+print(test)
 
-q = 'sql/fill_missing_values.sql'
+q = "SELECT edge_id, protected FROM osm_edges_simplified WHERE protected = 'true' LIMIT 10;"
 
-interpolate = dbf.run_query_pg(q, connection)
+test = dbf.run_query_pg(q, pool)
 
-connection = dbf.connect_pg(db_name, db_user, db_password)
+print(test)
 
 q = "SELECT edge_id, protected FROM osm_edges_simplified WHERE lit_as = 'yes' LIMIT 10;"
 
-test = dbf.run_query_pg(q, connection)
+test = dbf.run_query_pg(q, pool)
 
 print(test)
 
-#%%
-print('Create cycling network...')
-
-connection = dbf.connect_pg(db_name, db_user, db_password)
-
-engine = dbf.connect_alc(db_name, db_user, db_password, db_port=db_port)
-
-q = 'sql/create_cycling_network.sql'
-
-interpolate = dbf.run_query_pg(q, connection)
+q = "SELECT edge_id, cycling_infra_new FROM cycling_edges LIMIT 10;"
 
-connection = dbf.connect_pg(db_name, db_user, db_password)
+test = dbf.run_query_pg(q, pool)
 
-q = "SELECT edge_id, cycling_infra_new FROM cycling_edges LIMIT 10;"
+print(test)
 
-test = dbf.run_query_pg(q, connection)
+#%%
+# Slowest statements
+if len(timings) > 0:
+    print(timings.sort_values('seconds', ascending=False)[['stage','line','statement','seconds','status']].head(10))
 
-print(test)
\ No newline at end of file
+dbf.close_pools()
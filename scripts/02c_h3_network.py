@@ -17,6 +17,7 @@ from src import graph_functions as gf
 from timeit import default_timer as timer
 from shapely.geometry import Polygon
 from src import matching_functions as mf
+from src import cache_functions as cf
 import itertools
 from collections import Counter
 from src import h3_functions as h3_func
@@ -27,33 +28,29 @@ with open(r"../config.yml") as file:
 
     crs = parsed_yaml_file["CRS"]
 
+    segment_cache_dir = parsed_yaml_file["segment_cache_dir"]
+    segment_cache_max_size = parsed_yaml_file["segment_cache_max_size"]
+
     db_name = parsed_yaml_file["db_name"]
     db_user = parsed_yaml_file["db_user"]
     db_password = parsed_yaml_file["db_password"]
     db_host = parsed_yaml_file["db_host"]
     db_port = parsed_yaml_file["db_port"]
 
+    db_chunksize = parsed_yaml_file["db_chunksize"]
+
 print("Settings loaded!")
 
 #%%
 # Load data
 engine = dbf.connect_alc(db_name, db_user, db_password, db_port=db_port)
 
-get_osm_edges = "SELECT highway, edge_id, geometry FROM cycling_edges;"
 get_osm_nodes = "SELECT osmid, geometry FROM cycling_nodes;"
 
-osm_edges = gpd.GeoDataFrame.from_postgis(get_osm_edges, engine, geom_col="geometry")
 osm_nodes = gpd.GeoDataFrame.from_postgis(get_osm_nodes, engine, geom_col="geometry")
 
-#%%
-# Segmentize for edge indexing
-osm_segments = mf.create_segment_gdf(osm_edges, 10)
-#%%
 # Reproject to WGS84
 osm_nodes.to_crs("EPSG:4326", inplace=True)
-osm_edges.to_crs("EPSG:4326", inplace=True)
-osm_segments.to_crs("EPSG:4326", inplace=True)
-#%%
 
 # TODO: SPLIT INTO LTS SUB-NETWORKS
 #%%
@@ -62,28 +59,53 @@ h3_res_level = 13
 hex_id_col = f"h3_index_{h3_res_level}"
 filled_hex_id_col = f"filled_h3_index_{h3_res_level}"
 
-# Create column with edge coordinates
-osm_segments["coords"] = osm_segments["geometry"].apply(
-    lambda x: gf.return_coord_list(x)
-)
-osm_segments[hex_id_col] = osm_segments["coords"].apply(
-    lambda x: h3_func.coords_to_h3(x, h3_res_level)
-)
-osm_segments[filled_hex_id_col] = osm_segments[hex_id_col].apply(
-    lambda x: h3_func.h3_fill_line(x)
-)
+edge_h3_results = {}
+segment_chunks = []
+
+# Edges are read, segmentized and indexed one chunk at a time, so the full edge table is never held in memory
+# The edges are sorted, so the chunks (and the keys of the segment cache) are the same in every run
+for osm_edges in dbf.read_postgis_chunks(
+    "cycling_edges",
+    engine,
+    columns=["highway", "edge_id", "geometry"],
+    chunksize=db_chunksize,
+    order_by=["edge_id"],
+):
+
+    # Segmentize for edge indexing
+    osm_segments = cf.create_segment_gdf_cached(
+        osm_edges,
+        10,
+        mf.create_segment_gdf,
+        cache_dir=segment_cache_dir,
+        max_size=segment_cache_max_size,
+    )
 
-#%%
-# Get h3 indices for edges
+    # Reproject to WGS84
+    osm_segments.to_crs("EPSG:4326", inplace=True)
 
-edge_h3_results = {}
+    # Create column with edge coordinates
+    osm_segments["coords"] = osm_segments["geometry"].apply(
+        lambda x: gf.return_coord_list(x)
+    )
+    osm_segments[hex_id_col] = osm_segments["coords"].apply(
+        lambda x: h3_func.coords_to_h3(x, h3_res_level)
+    )
+    osm_segments[filled_hex_id_col] = osm_segments[hex_id_col].apply(
+        lambda x: h3_func.h3_fill_line(x)
+    )
 
-grouped_segs = osm_segments.groupby("edge_id")
-grouped_segs.apply(
-    lambda x: h3_func.return_edge_h3_indices(x, filled_hex_id_col, edge_h3_results)
-)
+    # Get h3 indices for edges
+    grouped_segs = osm_segments.groupby("edge_id")
+    grouped_segs.apply(
+        lambda x: h3_func.return_edge_h3_indices(x, filled_hex_id_col, edge_h3_results)
+    )
+
+    segment_chunks.append(osm_segments[["edge_id", hex_id_col, filled_hex_id_col]])
+
+osm_segments = pd.concat(segment_chunks, ignore_index=True)
 
-assert len(grouped_segs) == len(edge_h3_results)
+assert len(osm_segments["edge_id"].unique()) == len(edge_h3_results)
 
 #%%
 # Create polygon geometries
@@ -0,0 +1,273 @@
+"""
+Benchmark of the matching stages on the test data in tests/ and on enlarged copies of it.
+
+Each stage (create_segment_gdf, overlay_buffer, get_candidate_store, find_matches_from_buffer, summarize_feature_matches and update_osm)
+is timed separately, and the throughput (segments/s) and peak memory use of each stage is stored as JSON,
+so results can be compared between commits.
+
+Run from the scripts folder, e.g.:
+    python benchmark_matching.py --scales 1 10 100
+    python benchmark_matching.py --scales 1 10 --compare ../data/benchmarks/matching_<commit>.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from src import matching_functions as mf
+
+osm_fp = '../tests/osm_subset.gpkg'
+ref_fp = '../tests/geodk_test.gpkg'
+
+segment_length = 10
+buffer_dist = 15
+angular_threshold = 30
+hausdorff_threshold = 17
+
+
+def enlarge_data(gdf, scale, id_cols, offset):
+
+    """
+    Create an enlarged version of a dataset by tiling translated copies of it in a grid.
+
+    Arguments:
+        gdf (geodataframe): data to be enlarged
+        scale (int): number of copies
+        id_cols (list): columns with ids that must remain unique in the enlarged data
+        offset (tuple): x and y translation between neighbouring copies
+
+    Returns:
+        enlarged (geodataframe): the tiled copies
+    """
+
+    n_cols = math.ceil(math.sqrt(scale))
+
+    copies = []
+    for i in range(scale):
+        copy = gdf.copy()
+        copy[gdf.geometry.name] = shapely.transform(
+            gdf.geometry.values, lambda c: c + [(i % n_cols) * offset[0], (i // n_cols) * offset[1]]
+        )
+        for c in id_cols:
+            copy[c] = copy[c] + i * len(gdf)
+        copies.append(copy)
+
+    enlarged = gpd.GeoDataFrame(pd.concat(copies, ignore_index=True), crs=gdf.crs)
+
+    return enlarged
+
+
+def load_data(scale):
+
+    osm = gpd.read_file(osm_fp)
+    ref = gpd.read_file(ref_fp)
+
+    osm['edge_id'] = np.arange(len(osm))
+    ref['edge_id'] = np.arange(len(ref))
+
+    # Leave a gap larger than the buffer distance between copies
+    minx, miny = np.minimum(osm.total_bounds[:2], ref.total_bounds[:2])
+    maxx, maxy = np.maximum(osm.total_bounds[2:], ref.total_bounds[2:])
+    offset = (maxx - minx + 10 * buffer_dist, maxy - miny + 10 * buffer_dist)
+
+    if scale > 1:
+        osm = enlarge_data(osm, scale, ['edge_id'], offset)
+        ref = enlarge_data(ref, scale, ['edge_id'], offset)
+
+    return osm, ref
+
+
+def run_stages(osm, ref):
+
+    """
+    Create the matching stages for one run. Stages must be run in order, since each stage uses the results of the previous ones.
+
+    Returns:
+        stages (dict): for each stage a function running it and returning the number of segments processed
+    """
+
+    results = {}
+
+    def segment():
+        osm_segments = mf.create_segment_gdf(osm, segment_length)
+        osm_segments['osmid'] = osm_segments['edge_id']
+        ref_segments = mf.create_segment_gdf(ref, segment_length)
+        ref_segments.rename(columns={'seg_id': 'seg_id_ref'}, inplace=True)
+        results['osm_segments'] = osm_segments
+        results['ref_segments'] = ref_segments
+        return len(osm_segments) + len(ref_segments)
+
+    def buffer():
+        results['buffer_matches'] = mf.overlay_buffer(
+            osm_data=results['osm_segments'],
+            reference_data=results['ref_segments'],
+            dist=buffer_dist,
+            ref_id_col='seg_id_ref',
+            osm_id_col='seg_id',
+        )
+        return len(results['ref_segments'])
+
+    def candidates():
+        results['candidates'] = mf.get_candidate_store(
+            osm_data=results['osm_segments'],
+            reference_data=results['ref_segments'],
+            dist=buffer_dist,
+            ref_id_col='seg_id_ref',
+            osm_id_col='seg_id',
+        )
+        return len(results['ref_segments'])
+
+    def match():
+        results['segment_matches'] = mf.find_matches_from_buffer(
+            buffer_matches=results['candidates'],
+            osm_edges=results['osm_segments'],
+            reference_data=results['ref_segments'],
+            angular_threshold=angular_threshold,
+            hausdorff_threshold=hausdorff_threshold,
+        )
+        return len(results['candidates']['ref_ids'])
+
+    def summarize():
+        mf.summarize_feature_matches(results['osm_segments'], results['segment_matches'], 'seg_id', 'osmid', osm=True)
+        mf.summarize_feature_matches(results['ref_segments'], results['segment_matches'], 'seg_id_ref', 'edge_id', osm=False)
+        return len(results['osm_segments']) + len(results['ref_segments'])
+
+    def transfer():
+        mf.update_osm(results['osm_segments'], osm.copy(), results['segment_matches'], ['vejklasse', 'overflade'], 'edge_id', 'seg_id')
+        return len(results['osm_segments'])
+
+    return {
+        'create_segment_gdf': segment,
+        'overlay_buffer': buffer,
+        'get_candidate_store': candidates,
+        'find_matches_from_buffer': match,
+        'summarize_feature_matches': summarize,
+        'update_osm': transfer,
+    }
+
+
+def benchmark(scale, repeat, measure_memory):
+
+    """
+    Time each matching stage on the test data enlarged by scale.
+    The time is the fastest of the repeated runs. Peak memory is measured in a separate run with tracemalloc,
+    since tracing slows down the stages.
+
+    Returns:
+        result (dict): number of input features and time, throughput and peak memory of each stage
+    """
+
+    osm, ref = load_data(scale)
+
+    timings = {}
+    memory = {}
+
+    for r in range(repeat + int(measure_memory)):
+
+        trace = measure_memory and r == repeat
+
+        for name, stage in run_stages(osm, ref).items():
+
+            if trace:
+                tracemalloc.start()
+
+            start = time.perf_counter()
+            n_segments = stage()
+            duration = time.perf_counter() - start
+
+            if trace:
+                memory[name] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            elif name not in timings or duration < timings[name][0]:
+                timings[name] = (duration, n_segments)
+
+    stages = {}
+    for name, (duration, n_segments) in timings.items():
+        stages[name] = {
+            'seconds': duration,
+            'segments': n_segments,
+            'segments_per_second': n_segments / duration if duration > 0 else None,
+            'peak_memory_bytes': memory.get(name),
+        }
+
+    return {'scale': scale, 'osm_features': len(osm), 'ref_features': len(ref), 'stages': stages}
+
+
+def get_commit():
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, previous):
+
+    """
+    Print the change in time of each stage compared to a previous benchmark.
+    """
+
+    previous_runs = {r['scale']: r for r in previous['runs']}
+
+    for run in results['runs']:
+
+        if run['scale'] not in previous_runs:
+            continue
+
+        for name, stage in run['stages'].items():
+            old = previous_runs[run['scale']]['stages'].get(name)
+            if old is None:
+                continue
+            ratio = stage['seconds'] / old['seconds']
+            print(f"scale {run['scale']:>4} {name:<27} {old['seconds']:9.3f}s -> {stage['seconds']:9.3f}s ({ratio:.2f}x)")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the matching stages')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='number of tiled copies of the test data')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each stage')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory')
+    parser.add_argument('--out', default=None, help='file path of the JSON results')
+    parser.add_argument('--compare', default=None, help='file path of previous JSON results to compare with')
+    args = parser.parse_args()
+
+    commit = get_commit()
+
+    results = {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'geopandas': gpd.__version__,
+        'shapely': shapely.__version__,
+        'runs': [],
+    }
+
+    for scale in args.scales:
+        print(f'Benchmarking scale {scale}...')
+        run = benchmark(scale, args.repeat, not args.no_memory)
+        results['runs'].append(run)
+
+        for name, stage in run['stages'].items():
+            print(f"{name:<27} {stage['seconds']:9.3f}s {stage['segments_per_second']:12.0f} segments/s")
+
+    out_fp = args.out or f'../data/benchmarks/matching_{commit or "unknown"}.json'
+    os.makedirs(os.path.dirname(out_fp) or '.', exist_ok=True)
+
+    with open(out_fp, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f'Results saved to {out_fp}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
@@ -0,0 +1,228 @@
+-- Set based version of classify_bicycle_infra.sql
+-- Instead of updating osm_edges_simplified once for every value, all columns are computed in one pass
+-- into a new table, which then replaces osm_edges_simplified.
+-- The result is the same as classify_bicycle_infra.sql, but without the dead rows left by the many updates.
+-- Determine for all edges whether:
+-- - cycling is allowed
+-- - cycling infrastructure is protected
+-- - cyclists are in mixed traffic (bike separated)
+-- - there is car traffic
+-- - it is along a street
+-- - which municipality it is in
+
+
+-- Edges with 'unknown' values replaced by NULL
+-- The columns are found from the table, so all other columns are kept as they are
+-- Columns computed in this file are left out, so the file can be run again
+DO $$
+DECLARE
+    cols TEXT;
+BEGIN
+    SELECT string_agg(
+        CASE WHEN column_name IN ('maxspeed','cycleway','cycleway_both','cycleway_left','cycleway_right','bicycle_road','surface','lit')
+            THEN format('NULLIF(e.%I, ''unknown'') AS %I', column_name, column_name)
+            ELSE format('e.%I', column_name)
+        END, ', ' ORDER BY ordinal_position)
+    INTO cols
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = 'osm_edges_simplified'
+        AND column_name NOT IN ('cycling_allowed','protected','car_traffic','bike_separated','along_street','muni');
+
+    EXECUTE format('CREATE VIEW osm_edges_cleaned AS SELECT %s FROM osm_edges_simplified e', cols);
+END $$;
+
+
+-- The updates in classify_bicycle_infra.sql as CASE expressions
+-- Later updates overwrite earlier ones, so they come first in the CASE expressions
+CREATE TABLE edge_classes AS
+SELECT
+    edge_id,
+    ct.car_traffic,
+    ca.cycling_allowed,
+    CASE
+        WHEN cycling_infra_new = 'yes' AND
+            (geodk_bike = 'Cykelsti langs vej' OR
+            highway IN ('cycleway','track','path') OR
+            cycleway IN ('track','opposite_track') OR
+            cycleway_left IN ('track','opposite_track') OR
+            cycleway_right IN ('track','opposite_track') OR
+            cycleway_both IN ('track','opposite_track'))
+        AND (
+            geodk_bike = 'Cykelbane langs vej' OR
+            bicycle_road = 'yes' OR
+            cycleway IN ('lane','opposite_lane','shared_lane','crossing') OR
+            cycleway_left in ('lane','opposite_lane','shared_lane','crossing') OR
+            cycleway_right in ('lane','opposite_lane','shared_lane','crossing') OR
+            cycleway_both in ('lane','opposite_lane','shared_lane','crossing'))
+        THEN 'mixed'
+        WHEN cycling_infra_new = 'yes' AND
+            (geodk_bike = 'Cykelsti langs vej' OR
+            highway IN ('cycleway','track','path') OR
+            cycleway IN ('track','opposite_track') OR
+            cycleway_left IN ('track','opposite_track') OR
+            cycleway_right IN ('track','opposite_track') OR
+            cycleway_both IN ('track','opposite_track'))
+        THEN 'true'
+        WHEN cycling_infra_new = 'yes' AND
+            (geodk_bike = 'Cykelbane langs vej' OR
+            bicycle_road = 'yes' OR
+            highway = 'living_street' OR
+            cyclestreet = 'yes' OR
+            cycleway IN ('lane','opposite_lane','shared_lane','crossing','shared_lane;shared','share_busway') OR
+            cycleway_left in ('lane','opposite_lane','shared_lane','crossing') OR
+            cycleway_right in ('lane','opposite_lane','shared_lane','crossing') OR
+            cycleway_both in ('lane','opposite_lane','shared_lane','crossing'))
+        THEN 'false'
+        WHEN cycling_infra_new = 'yes' THEN 'unknown'
+    END::VARCHAR AS protected,
+    -- Cycling infrastructure separated from car street network - i.e. you are not biking in mixed traffic
+    -- False if not known to be true
+    CASE
+        WHEN highway IN ('cycleway')
+            OR cycleway IN ('lane','track','opposite_lane','opposite_track')
+            OR cycleway_left IN ('lane','track','opposite_lane','opposite_track')
+            OR cycleway_right IN ('lane','track','opposite_lane','opposite_track')
+            OR cycleway_both IN ('lane','track','opposite_lane','opposite_track')
+            OR highway IN ('path','track') AND bicycle IN ('designated','yes')
+            OR bicycle = 'designated' and (motor_vehicle = 'no' OR motorcar = 'no')
+            OR geodk_bike IN ('Cykelsti langs vej','Cykelbane langs vej')
+        THEN 'true'
+        WHEN ca.cycling_allowed = 'yes' THEN 'false'
+    END::VARCHAR AS bike_separated,
+    --Determining whether the segment of cycling infrastructure runs along a street or not
+    -- Along a street with car traffic (segments along car streets found from the geometries are added below)
+    CASE
+        WHEN geodk_bike IS NOT NULL THEN 'true'
+        WHEN ct.car_traffic = 'yes' AND cycling_infra_new = 'yes' THEN 'true'
+        WHEN cycling_infra_new = 'yes' THEN 'false'
+    END::VARCHAR AS along_street
+FROM osm_edges_cleaned
+CROSS JOIN LATERAL (
+    SELECT CASE
+        WHEN highway IN (
+                'trunk',
+                'trunk_link',
+                'tertiary',
+                'tertiary_link',
+                'secondary',
+                'secondary_link',
+                'living_street',
+                'primary',
+                'primary_link',
+                'residential',
+                'motorway',
+                'motorway_link',
+                'service')
+            OR highway = 'unclassified' AND ('name' IS NOT NULL AND (access IS NULL OR access NOT IN ('no', 'restricted')) AND motorcar != 'no' AND motor_vehicle != 'no')
+            OR highway = 'unclassified' AND ((maxspeed::integer > 15) AND (motorcar != 'no' OR motorcar is NULL) AND (motor_vehicle != 'no' OR motor_vehicle IS NULL))
+        THEN 'yes'
+    END::VARCHAR AS car_traffic
+) ct
+CROSS JOIN LATERAL (
+    SELECT CASE
+        WHEN bicycle IN ('no', 'dismount', 'use_sidepath')
+            OR (highway IN ('motorway','motorway_link') AND cycling_infra_new = 'no')
+        THEN 'no'
+        WHEN bicycle IN ('yes','permissive', 'ok', 'allowed', 'designated')
+            OR cycling_infra_new = 'yes'
+            OR (highway IN (
+                'trunk',
+                'trunk_link',
+                'tertiary',
+                'tertiary_link',
+                'secondary',
+                'secondary_link',
+                'living_street',
+                'primary',
+                'primary_link',
+                'residential',
+                'service',
+                'unclassified',
+                'path',
+                'track')
+                AND (access IS NULL OR access NOT IN ('no', 'restricted'))
+                    AND (bicycle IS NULl OR bicycle NOT IN ('no','dismount','use_sidepath')) )
+        THEN 'yes'
+    END::VARCHAR AS cycling_allowed
+) ca
+;
+
+
+-- Capturing cycleways digitized as individual ways both still running parallel to a street
+CREATE VIEW car_roads AS
+    (SELECT e.name, e.highway, e.geometry FROM osm_edges_simplified e
+        JOIN edge_classes c ON e.edge_id = c.edge_id
+        WHERE c.car_traffic = 'yes') -- should it include service?
+;
+
+CREATE TABLE buffered_car_roads AS
+	(SELECT (ST_Dump(geom)).geom FROM
+        (SELECT ST_Union(ST_Buffer(geometry,30)) AS geom FROM car_roads) cr)
+;
+
+CREATE INDEX buffer_geom_idx ON buffered_car_roads USING GIST (geom);
+
+CREATE TABLE intersecting_cycle_roads AS
+(SELECT o.edge_id, o.geometry FROM osm_edges_simplified o, buffered_car_roads br
+WHERE o.cycling_infra_new = 'yes' AND ST_Intersects(o.geometry, br.geom));
+
+CREATE TABLE cycle_infra_points AS
+(SELECT edge_id, ST_Collect( ARRAY[ST_StartPoint(geometry), ST_Centroid(geometry), ST_EndPoint(geometry)]) AS geometry FROM intersecting_cycle_roads);
+
+CREATE INDEX cycle_points_geom_idx ON cycle_infra_points USING GIST (geometry);
+
+CREATE TABLE cycling_cars AS
+(SELECT c.edge_id, c.geometry FROM cycle_infra_points c, buffered_car_roads br
+WHERE ST_CoveredBy(c.geometry, br.geom));
+
+
+-- Municipality of each edge. Edges in more than one municipality get one of them, like the update in classify_bicycle_infra.sql
+CREATE TABLE edge_muni AS
+    (SELECT DISTINCT ON (o.edge_id) o.edge_id, m.navn FROM osm_edges_simplified o
+        JOIN muni_boundaries m ON ST_Intersects(o.geometry, m.geometry)
+        ORDER BY o.edge_id)
+;
+
+
+-- All columns in one pass
+CREATE TABLE osm_edges_classified AS
+SELECT
+    e.*,
+    c.cycling_allowed,
+    c.protected,
+    c.car_traffic,
+    c.bike_separated,
+    CASE
+        WHEN EXISTS (SELECT FROM cycling_cars cc WHERE cc.edge_id = e.edge_id) THEN 'true'
+        ELSE c.along_street
+    END::VARCHAR AS along_street,
+    m.navn::VARCHAR AS muni
+FROM osm_edges_cleaned e
+JOIN edge_classes c ON e.edge_id = c.edge_id
+LEFT JOIN edge_muni m ON e.edge_id = m.edge_id
+;
+
+
+-- Replace osm_edges_simplified with the new table in one statement
+DO $$
+BEGIN
+    DROP VIEW car_roads;
+    DROP VIEW osm_edges_cleaned;
+    DROP TABLE osm_edges_simplified;
+    ALTER TABLE osm_edges_classified RENAME TO osm_edges_simplified;
+END $$;
+
+-- Indexes as created when the table is loaded (see db_functions.copy_to_postgis)
+CREATE INDEX IF NOT EXISTS osm_edges_simplified_geometry_idx ON osm_edges_simplified USING GIST (geometry);
+CREATE INDEX IF NOT EXISTS osm_edges_simplified_edge_id_idx ON osm_edges_simplified (edge_id);
+CREATE INDEX IF NOT EXISTS osm_edges_simplified_osmid_idx ON osm_edges_simplified (osmid);
+
+
+DROP TABLE edge_classes;
+DROP TABLE edge_muni;
+DROP TABLE buffered_car_roads;
+DROP TABLE cycling_cars;
+DROP TABLE intersecting_cycle_roads;
+DROP TABLE cycle_infra_points;
+
+ANALYZE osm_edges_simplified;
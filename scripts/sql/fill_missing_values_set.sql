@@ -0,0 +1,138 @@
+-- Set based version of fill_missing_values.sql
+-- Instead of updating osm_edges_simplified once for every value, all columns are computed in one pass
+-- into a new table, which then replaces osm_edges_simplified.
+-- The result is the same as fill_missing_values.sql, but without the dead rows left by the many updates.
+
+
+-- Limiting number of road segments with road type 'unknown'
+-- Road type of unclassified roads touching a known road with the same name
+CREATE TABLE roadtype_fix AS
+    (SELECT DISTINCT ON (uk.edge_id) uk.edge_id, kr.highway FROM osm_edges_simplified uk
+        JOIN osm_edges_simplified kr ON ST_Touches(uk.geometry, kr.geometry) AND uk.name = kr.name
+        WHERE uk.highway = 'unclassified'
+        AND kr.highway != 'unclassified' AND kr.highway != 'cycleway'
+        ORDER BY uk.edge_id)
+;
+
+
+-- SURFACE
+ALTER TABLE osm_matches_surface
+    ADD COLUMN IF NOT EXISTS surface VARCHAR
+;
+
+UPDATE osm_matches_surface
+    SET surface = CASE overflade
+        WHEN 'Befæstet' THEN 'paved'
+        WHEN 'Ubefæstet' THEN 'unpaved'
+        WHEN 'Ukendt' THEN 'unknown'
+        ELSE 'paved' -- Catch edges with both befæstet/ubefæstet due to simplification
+    END
+;
+
+-- Edges with more than one match get one of them, like the update in fill_missing_values.sql
+CREATE TABLE edge_surface AS
+    (SELECT DISTINCT ON (edge_id) edge_id, surface FROM osm_matches_surface ORDER BY edge_id)
+;
+
+
+-- Edges with updated road type and surface from GeoDK
+-- The columns are found from the table, so all other columns are kept as they are
+-- Columns computed in this file are left out, so the file can be run again
+DO $$
+DECLARE
+    cols TEXT;
+BEGIN
+    SELECT string_agg(
+        CASE column_name
+            WHEN 'highway' THEN 'COALESCE(rf.highway, e.highway) AS highway'
+            -- Surface from GeoDK is not assumed
+            WHEN 'cycleway_surface' THEN 'COALESCE(e.cycleway_surface, es.surface) AS cycleway_surface'
+            ELSE format('e.%I', column_name)
+        END, ', ' ORDER BY ordinal_position)
+    INTO cols
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = 'osm_edges_simplified'
+        AND column_name NOT IN ('cycling_surface_as','lit_as','speed_as');
+
+    EXECUTE format(
+        'CREATE VIEW osm_edges_filled AS SELECT %s FROM osm_edges_simplified e
+            LEFT JOIN roadtype_fix rf ON e.edge_id = rf.edge_id
+            LEFT JOIN edge_surface es ON e.edge_id = es.edge_id',
+        cols);
+END $$;
+
+
+-- The updates in fill_missing_values.sql as CASE expressions ('as' = 'assumed')
+-- Later updates overwrite earlier ones, so they come first in the CASE expressions
+CREATE TABLE osm_edges_filled_values AS
+SELECT
+    *,
+    CASE
+        WHEN along_street = 'true' AND surface IS NULL AND cycling_infra_new = 'yes' THEN 'paved'
+        WHEN cycleway_surface IS NOT NULL THEN cycleway_surface
+        -- Cycling surface is assumed paved if along a car street
+        WHEN highway IN (
+            'trunk',
+            'trunk_link',
+            'tertiary',
+            'tertiary_link',
+            'secondary',
+            'secondary_link',
+            'living_street',
+            'primary',
+            'primary_link',
+            'residential',
+            --'service',
+            'motorway',
+            'motorway_link'
+            )
+            AND cycling_allowed = 'yes'
+        THEN 'paved'
+    END::VARCHAR AS cycling_surface_as,
+    -- UPDATE BASED ON URBAN AREAS
+    -- LIT
+    CASE
+        WHEN lit IS NOT NULL THEN lit
+        WHEN highway IN (
+            'trunk',
+            'trunk_link',
+            'tertiary',
+            'tertiary_link',
+            'secondary',
+            'secondary_link',
+            'living_street',
+            'primary',
+            'primary_link',
+            --'residential',
+            'motorway',
+            'motorway_link')
+            AND urban_area = 'yes'
+        THEN 'yes'
+        WHEN along_street = 'true'
+            AND highway = 'cycleway'
+            AND urban_area = 'yes'
+        THEN 'yes'
+    END::VARCHAR AS lit_as,
+    NULL::VARCHAR AS speed_as
+FROM osm_edges_filled
+;
+
+
+-- Replace osm_edges_simplified with the new table in one statement
+DO $$
+BEGIN
+    DROP VIEW osm_edges_filled;
+    DROP TABLE osm_edges_simplified;
+    ALTER TABLE osm_edges_filled_values RENAME TO osm_edges_simplified;
+END $$;
+
+-- Indexes as created when the table is loaded (see db_functions.copy_to_postgis)
+CREATE INDEX IF NOT EXISTS osm_edges_simplified_geometry_idx ON osm_edges_simplified USING GIST (geometry);
+CREATE INDEX IF NOT EXISTS osm_edges_simplified_edge_id_idx ON osm_edges_simplified (edge_id);
+CREATE INDEX IF NOT EXISTS osm_edges_simplified_osmid_idx ON osm_edges_simplified (osmid);
+
+
+DROP TABLE roadtype_fix;
+DROP TABLE edge_surface;
+
+ANALYZE osm_edges_simplified;
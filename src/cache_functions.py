@@ -0,0 +1,387 @@
+"""
+Functions for caching intermediate results of the data processing on disk, so they do not have to be recomputed in later runs
+"""
+import hashlib
+import json
+import os
+import pickle
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+# Version of the segmentation (matching_functions._get_segments). Increase it when the segments change, so cached segments are not reused
+SEGMENT_VERSION = 2
+
+
+def get_fingerprint(source, *args):
+
+    """
+    Create a fingerprint identifying a data source and the settings used to process it.
+    If the source is a file path, the fingerprint is based on the path, size and modification time of the file.
+    If the source is a (geo)dataframe, the fingerprint is based on the content of the data.
+    The fingerprint includes SEGMENT_VERSION, so fingerprints change when the segmentation changes.
+
+    Arguments:
+        source (str or geodataframe): file path or data to create fingerprint for
+        *args: additional settings to include in the fingerprint (e.g. segment length and crs)
+
+    Returns:
+        fingerprint (str): hex digest identifying the source and settings
+    """
+
+    h = hashlib.blake2b(digest_size=16)
+
+    h.update(f"v{SEGMENT_VERSION}|".encode())
+
+    if isinstance(source, str):
+        stat = os.stat(source)
+        h.update(
+            f"{os.path.abspath(source)}|{stat.st_size}|{stat.st_mtime_ns}".encode()
+        )
+
+    else:
+        h.update("|".join(str(c) for c in source.columns).encode())
+
+        data = pd.DataFrame(source)
+        if isinstance(source, gpd.GeoDataFrame):
+            data = data.drop(columns=source.geometry.name)
+            h.update(b"".join(shapely.to_wkb(source.geometry.values)))
+
+        try:
+            hashed = pd.util.hash_pandas_object(data, index=True)
+        except TypeError:
+            # Columns with unhashable values (e.g. lists of osmids)
+            hashed = pd.util.hash_pandas_object(data.astype(str), index=True)
+
+        h.update(hashed.values.tobytes())
+
+    for a in args:
+        h.update(f"|{a}".encode())
+
+    return h.hexdigest()
+
+
+def _get_cache_fp(cache_dir, key):
+
+    """
+    Helper function for the segment cache functions. Gets the file path of the cached segments for a key.
+
+    Arguments:
+        cache_dir (str): folder with cached segments
+        key (str): fingerprint of the segments (result from get_fingerprint())
+
+    Returns:
+        fp (str): file path of the GeoParquet file with the segments
+    """
+
+    return os.path.join(cache_dir, f"segments_{key}.parquet")
+
+
+def load_segment_cache(cache_dir, key):
+
+    """
+    Load cached segments if they exist.
+
+    Arguments:
+        cache_dir (str): folder with cached segments
+        key (str): fingerprint of the cached segments (result from get_fingerprint())
+
+    Returns:
+        segments (geodataframe): the cached segments. None if no segments are cached for the key
+    """
+
+    fp = _get_cache_fp(cache_dir, key)
+
+    if not os.path.exists(fp):
+        return None
+
+    segments = gpd.read_parquet(fp, memory_map=True)
+
+    # Mark as recently used
+    os.utime(fp)
+
+    return segments
+
+
+def save_segment_cache(segments, cache_dir, key, max_size=None):
+
+    """
+    Save segments to the cache as GeoParquet and evict old cached segments if the cache is too large.
+    If the segments can not be written, the error is raised and no partly written file is left in the cache.
+
+    Arguments:
+        segments (geodataframe): segments to be cached
+        cache_dir (str): folder with cached segments
+        key (str): fingerprint of the segments (result from get_fingerprint())
+        max_size (numerical): max size of the cache in bytes. If None, nothing is evicted
+
+    Returns:
+        None
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    fp = _get_cache_fp(cache_dir, key)
+
+    # Written to a temporary file first, so an interrupted write does not leave an incomplete file with the name of the key
+    try:
+        segments.to_parquet(fp + ".tmp")
+    except Exception:
+        if os.path.exists(fp + ".tmp"):
+            os.remove(fp + ".tmp")
+        raise
+
+    os.replace(fp + ".tmp", fp)
+
+    if max_size is not None:
+        evict_segment_cache(cache_dir, max_size, keep=[key])
+
+    return None
+
+
+def evict_segment_cache(cache_dir, max_size, keep=None):
+
+    """
+    Remove the least recently used cached segments until the cache is smaller than max_size.
+
+    Arguments:
+        cache_dir (str): folder with cached segments
+        max_size (numerical): max size of the cache in bytes
+        keep (list): keys of cached segments that should not be removed
+
+    Returns:
+        removed (list): file paths of the removed files
+    """
+
+    keep_fps = [_get_cache_fp(cache_dir, k) for k in (keep or [])]
+
+    fps = [
+        os.path.join(cache_dir, f)
+        for f in os.listdir(cache_dir)
+        if f.startswith("segments_") and f.endswith(".parquet")
+    ]
+
+    # Oldest first
+    fps.sort(key=lambda fp: os.stat(fp).st_mtime)
+
+    total_size = sum(os.stat(fp).st_size for fp in fps)
+
+    removed = []
+    for fp in fps:
+        if total_size <= max_size:
+            break
+        if fp in keep_fps:
+            continue
+        total_size -= os.stat(fp).st_size
+        os.remove(fp)
+        removed.append(fp)
+
+    return removed
+
+
+def invalidate_segment_cache(cache_dir, key=None):
+
+    """
+    Remove cached segments.
+
+    Arguments:
+        cache_dir (str): folder with cached segments
+        key (str): fingerprint of the segments to remove. If None, all cached segments are removed
+
+    Returns:
+        None
+    """
+
+    if not os.path.exists(cache_dir):
+        return None
+
+    if key is not None:
+        fps = [_get_cache_fp(cache_dir, key)]
+
+    else:
+        fps = [
+            os.path.join(cache_dir, f)
+            for f in os.listdir(cache_dir)
+            if f.startswith("segments_") and f.endswith(".parquet")
+        ]
+
+    for fp in fps:
+        if os.path.exists(fp):
+            os.remove(fp)
+
+    return None
+
+
+def create_segment_gdf_cached(
+    org_gdf, segment_length, segment_func, cache_dir, source=None, max_size=None
+):
+
+    """
+    Segment data with segment_func (e.g. matching_functions.create_segment_gdf), but load the segments from the cache if the same data has been segmented before.
+    The cache key is based on the source data, the segment length, the crs and SEGMENT_VERSION.
+
+    Arguments:
+        org_gdf (geodataframe): Geodataframe with linestrings to be converted to shorter segments
+        segment_length (numerical): The length of the segments
+        segment_func (function): function creating the segments from org_gdf and segment_length, e.g. matching_functions.create_segment_gdf
+        cache_dir (str): folder with cached segments
+        source (str): file path of the source of org_gdf. If None, the fingerprint is based on the content of org_gdf
+        max_size (numerical): max size of the cache in bytes. If None, nothing is evicted
+
+    Returns:
+        segments_gdf (geodataframe): New geodataframe with segments and new unique ids (seg_id)
+    """
+
+    crs = org_gdf.crs.to_string() if org_gdf.crs is not None else None
+
+    key = get_fingerprint(org_gdf if source is None else source, segment_length, crs)
+
+    segments_gdf = load_segment_cache(cache_dir, key)
+
+    if segments_gdf is not None:
+        print("Segments loaded from cache!")
+        return segments_gdf
+
+    segments_gdf = segment_func(org_gdf, segment_length)
+
+    save_segment_cache(segments_gdf, cache_dir, key, max_size=max_size)
+
+    return segments_gdf
+
+
+def get_stage_key(name, inputs):
+
+    """
+    Create a key identifying a pipeline stage and its inputs.
+
+    Arguments:
+        name (str): name of the stage
+        inputs (dict): inputs to the stage. Dataframes and series are fingerprinted by content.
+            Other inputs must be explicit parameters (None, booleans, numbers, strings, or lists and dicts of these),
+            which are hashed by their JSON representation, so keys do not depend on how objects are pickled by a library version
+
+    Returns:
+        key (str): hex digest identifying the stage and its inputs
+    """
+
+    fingerprints = []
+    for k in sorted(inputs):
+        v = inputs[k]
+        if isinstance(v, pd.Series):
+            v = v.to_frame()
+        if isinstance(v, pd.DataFrame):
+            fingerprints.append(f"{k}={get_fingerprint(v)}")
+        else:
+            try:
+                v_json = json.dumps(v, sort_keys=True)
+            except TypeError:
+                raise TypeError(
+                    f"Stage input {k} of type {type(v).__name__} is not a dataframe or an explicit parameter"
+                )
+            v_hash = hashlib.blake2b(v_json.encode(), digest_size=16).hexdigest()
+            fingerprints.append(f"{k}={v_hash}")
+
+    return hashlib.blake2b(
+        "|".join([name] + fingerprints).encode(), digest_size=16
+    ).hexdigest()
+
+
+def load_checkpoint(checkpoint_dir, name, key):
+
+    """
+    Load the checkpointed result of a stage if it was created with the same key.
+
+    Arguments:
+        checkpoint_dir (str): folder with checkpoints
+        name (str): name of the stage
+        key (str): key of the stage (result from get_stage_key())
+
+    Returns:
+        found (boolean): whether a valid checkpoint was found
+        result (undefined): the checkpointed result. None if no valid checkpoint was found
+    """
+
+    key_fp = os.path.join(checkpoint_dir, f"{name}.key")
+    result_fp = os.path.join(checkpoint_dir, f"{name}.pickle")
+
+    if not (os.path.exists(key_fp) and os.path.exists(result_fp)):
+        return False, None
+
+    with open(key_fp, "r") as f:
+        if f.read() != key:
+            return False, None
+
+    with open(result_fp, "rb") as f:
+        result = pickle.load(f)
+
+    return True, result
+
+
+def save_checkpoint(result, checkpoint_dir, name, key):
+
+    """
+    Save the result of a stage as a checkpoint.
+    The key is written after the result, so an interrupted write never leaves a valid checkpoint.
+
+    Arguments:
+        result (undefined): the result of the stage
+        checkpoint_dir (str): folder with checkpoints
+        name (str): name of the stage
+        key (str): key of the stage (result from get_stage_key())
+
+    Returns:
+        None
+    """
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    key_fp = os.path.join(checkpoint_dir, f"{name}.key")
+    result_fp = os.path.join(checkpoint_dir, f"{name}.pickle")
+
+    if os.path.exists(key_fp):
+        os.remove(key_fp)
+
+    with open(result_fp + ".tmp", "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(result_fp + ".tmp", result_fp)
+
+    with open(key_fp, "w") as f:
+        f.write(key)
+
+    return None
+
+
+def run_stage(name, func, checkpoint_dir, **inputs):
+
+    """
+    Run a named pipeline stage and checkpoint the result.
+    If the stage has already been completed with the same inputs, the checkpointed result is returned instead.
+    Passing the result of one stage as input to the next makes a restarted pipeline resume from the last completed stage.
+
+    Arguments:
+        name (str): name of the stage
+        func (function): function running the stage
+        checkpoint_dir (str): folder with checkpoints
+        **inputs: keyword arguments passed to func. Also used to decide whether the stage must be rerun
+
+    Returns:
+        result (undefined): the result of func
+    """
+
+    key = get_stage_key(name, inputs)
+
+    found, result = load_checkpoint(checkpoint_dir, name, key)
+
+    if found:
+        print(f"Stage {name} loaded from checkpoint!")
+        return result
+
+    print(f"Running stage {name}...")
+
+    result = func(**inputs)
+
+    save_checkpoint(result, checkpoint_dir, name, key)
+
+    print(f"Stage {name} completed!")
+
+    return result
@@ -4,11 +4,23 @@ Uses psycopg2 and sqlaclhemy
 sqlaclemy is particularly useful for loading data without having to specifify column names and types in advance
 '''
 
+import io
+from contextlib import contextmanager
 import psycopg2 as pg
+from psycopg2 import pool as pg_pool
+from psycopg2 import extensions as pg_extensions
 import sqlalchemy 
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
 
 # TODO Format function docstrings to standard format
 
+# Connection pools and engines are shared by all calls in the same process, so scripts do not reconnect for every query
+_pools = {}
+_engines = {}
+
 
 #Function for connecting to database using psycopg2
 def connect_pg(db_name, db_user, db_password, db_host='localhost'):
@@ -34,16 +46,119 @@ def connect_pg(db_name, db_user, db_password, db_host='localhost'):
         print ("Error while connecting to PostgreSQL", error)
 
     
+#Function for getting a shared pool of psycopg2 connections
+def get_pool(db_name, db_user, db_password, db_host='localhost', db_port='5432', min_conn=1, max_conn=8):
+
+    '''
+    Function for getting a pool of psycopg2 connections to the database
+    The pool is created the first time it is requested and reused by later calls with the same settings
+    Connections are borrowed from the pool with session() or by passing the pool to run_query_pg
+    Returns the pool object
+    '''
+
+    key = (db_name, db_user, db_host, str(db_port))
+
+    if key in _pools and not _pools[key].closed:
+        return _pools[key]
+
+    try:
+        _pools[key] = pg_pool.ThreadedConnectionPool(min_conn, max_conn, database = db_name, user = db_user,
+                                  password = db_password, host = db_host, port = db_port)
+
+        print('You are connected to the database %s!' % db_name)
+
+        return _pools[key]
+
+    except (Exception, pg.Error) as error :
+        print ("Error while connecting to PostgreSQL", error)
+
+
+#Function for closing all shared pools and engines
+def close_pools():
+
+    '''
+    Function for closing all connections in the shared pools and engines
+    '''
+
+    for pool in _pools.values():
+        if not pool.closed:
+            pool.closeall()
+
+    for engine in _engines.values():
+        engine.dispose()
+
+    _pools.clear()
+    _engines.clear()
+
+
+#Function for testing whether a connection is still usable
+def _is_alive(connection):
+
+    '''
+    Checks the state of the connection without sending a query to the server
+    A connection broken by the server (e.g. after a restart) is marked as closed or with an unknown transaction status
+    by psycopg2 once a query on it has failed with an OperationalError or InterfaceError
+    '''
+
+    if connection.closed:
+        return False
+
+    return connection.get_transaction_status() != pg_extensions.TRANSACTION_STATUS_UNKNOWN
+
+
+#Function for borrowing a connection from a pool in a managed transaction
+@contextmanager
+def session(pool, commit=True):
+
+    '''
+    Context manager borrowing a connection from a pool (result from get_pool)
+    The transaction is commited when the block succeeds and rolled back if an error occurs
+    Connections broken by an error (e.g. after a server restart) are closed when they are returned to the pool, so they are replaced with new ones
+    The connection is always returned to the pool
+
+    Example:
+        with dbf.session(pool) as connection:
+            dbf.run_query_pg('sql/intersections.sql', connection)
+    '''
+
+    connection = pool.getconn()
+
+    if not _is_alive(connection):
+        pool.putconn(connection, close=True)
+        connection = pool.getconn()
+
+    try:
+        yield connection
+        if commit:
+            connection.commit()
+        else:
+            connection.rollback()
+
+    except:
+        if _is_alive(connection):
+            connection.rollback()
+        raise
+
+    finally:
+        pool.putconn(connection, close=not _is_alive(connection))
+
+
 #Function for running sql query using psycopg2
 def run_query_pg(query,connection, success='Query successful!',fail='Query failed!',commit=True, close=False):
     
     '''
     Function for running a sql query using psycopg2
-    Required input are query/filepath (string) to query and name of database connection
+    Required input are query/filepath (string) to query and name of database connection or connection pool (result from get_pool)
     Optional input are message to be printed when the query succeeds or fails, and whether the function should commit the changes (default is to commit)
     You must be connected to the database before using the function
+    If a pool is used, a connection is borrowed from the pool for the query and returned afterwards
+    If the query fails, the transaction is rolled back and the connection can be used for the next query
     '''
 
+    if isinstance(connection, pg_pool.AbstractConnectionPool):
+        with session(connection, commit=commit) as pooled_connection:
+            return run_query_pg(query, pooled_connection, success=success, fail=fail, commit=commit)
+
     cursor = connection.cursor()
 
     #Check whether query is a sql statement as string or a filepath to an sql file
@@ -51,20 +166,19 @@ def run_query_pg(query,connection, success='Query successful!',fail='Query faile
     
     try:
         if query_is_file:
-            open_query = open(query,'r')
-            cursor.execute(open_query.read())
+            with open(query,'r') as open_query:
+                cursor.execute(open_query.read())
         else:
             cursor.execute(query)
         
         print(success)
 
-        try:
+        result = None
+
+        if cursor.description is not None:
             result = cursor.fetchall()
             rows_changed = len(result)
             print(rows_changed,'rows were updated or retrieved')
-            return result
-        except:
-            pass
 
         if commit:
             connection.commit()
@@ -74,23 +188,15 @@ def run_query_pg(query,connection, success='Query successful!',fail='Query faile
         if close:
             connection.close()
             print('Connection closed')
-    
+
+        return result
 
     except(Exception) as error:
         print(fail)
         print(error)
-        print('Please fix error before rerunning and reconnect to the database')
-        connection.close()
-
-        '''
-        try:
-            connection = pg.connect(database = db_name, user = db_user,
-                                        password = db_password,
-                                        host = db_host)
-            print('You are connected to the database %s!' % db_name)
-        except (Exception, pg.Error) as error :
-            print("Error while connecting to PostgreSQL", error)
-        '''
+        print('Please fix error before rerunning')
+        connection.rollback()
+        print('Transaction rolled back')
 
 
 #Function for connecting to database using sqlalchemy
@@ -101,30 +207,41 @@ def connect_alc(db_name, db_user, db_password, db_port, db_host='localhost'):
     Required input are database name, username, password
     If no host is provided localhost is assumed
     Returns the engine object
+    The engine is reused by later calls with the same settings, and its pool checks connections before use and reconnects if needed
     '''
 
     #Create engine
-    engine_info = 'postgresql://' + db_user +':'+ db_password + '@' + db_host + ':' + db_port + '/' + db_name
+    engine_info = 'postgresql://' + db_user +':'+ db_password + '@' + db_host + ':' + str(db_port) + '/' + db_name
+
+    if engine_info in _engines:
+        return _engines[engine_info]
 
     #Connecting to database
     try:
-        engine = sqlalchemy.create_engine(engine_info)
-        engine.connect()
+        engine = sqlalchemy.create_engine(engine_info, pool_pre_ping=True)
+        with engine.connect():
+            pass
         print('You are connected to the database %s!' % db_name)
+        _engines[engine_info] = engine
         return engine
     except(Exception, sqlalchemy.exc.OperationalError) as error:
         print('Error while connecting to the dabase!', error)
 
 
 #Function for loading data to database using sqlalchemy
-def to_postgis(geodataframe, table_name, engine, if_exists='replace'):
+def to_postgis(geodataframe, table_name, engine, if_exists='replace', copy=False, id_cols=None, chunksize=100000):
     
     '''
     Function for loading a geodataframe to a postgres database using sqlalchemy
     Required input are geodataframe, desired name of table and sqlalchemy engine
-    Default behaviour is to replace table if it already exists, but this can be changed to fail
+    Default behaviour is to replace table if it already exists, but this can be changed to fail (or append)
+    If copy is True, the data is bulk loaded with COPY instead of inserted row by row, which is much faster for large tables (see copy_to_postgis)
+    id_cols and chunksize are only used with copy
     '''
 
+    if copy:
+        return copy_to_postgis(geodataframe, table_name, engine, if_exists=if_exists, id_cols=id_cols, chunksize=chunksize)
+
     try:
         geodataframe.to_postgis(table_name, engine, if_exists=if_exists)
         print(table_name, 'successfully loaded to database!')
@@ -132,16 +249,214 @@ def to_postgis(geodataframe, table_name, engine, if_exists='replace'):
         print('Error while uploading data to database:', error)
 
 
+#Function for getting the postgres column type of a pandas column
+def _get_pg_type(series):
+
+    if pd.api.types.is_bool_dtype(series):
+        return 'BOOLEAN'
+    elif pd.api.types.is_integer_dtype(series):
+        return 'BIGINT'
+    elif pd.api.types.is_float_dtype(series):
+        return 'DOUBLE PRECISION'
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        return 'TIMESTAMP'
+    else:
+        return 'TEXT'
+
+
+#Function for converting a chunk of a geodataframe to csv for COPY
+def _get_copy_buffer(chunk, geom_col, srid):
+
+    '''
+    Helper function for copy_to_postgis
+    Geometries are written as hex encoded EWKB, which postgis reads directly into a geometry column
+    Values that are not strings or numbers (e.g. lists of osmids) are written as their string representation
+    '''
+
+    data = pd.DataFrame(chunk).copy()
+
+    for c in data.columns:
+        if c != geom_col and data[c].dtype == object:
+            data[c] = data[c].map(lambda x: x if x is None or isinstance(x, str) or (isinstance(x, float) and np.isnan(x)) else str(x))
+
+    geoms = shapely.set_srid(chunk.geometry.values, srid) if srid is not None else chunk.geometry.values
+    data[geom_col] = shapely.to_wkb(geoms, hex=True, include_srid=srid is not None)
+
+    buffer = io.StringIO()
+    data.to_csv(buffer, header=False, index=False, na_rep='\\N')
+    buffer.seek(0)
+
+    return buffer
+
+
+#Function for bulk loading data to database using COPY
+def copy_to_postgis(geodataframe, table_name, engine, if_exists='replace', id_cols=None, chunksize=100000):
+
+    '''
+    Function for bulk loading a geodataframe to a postgres database using COPY ... FROM STDIN
+    Required input are geodataframe, desired name of table and sqlalchemy engine
+    Default behaviour is to replace table if it already exists, but this can be changed to fail or append
+    The table is created without indexes, and rows are streamed to the database in chunks of chunksize rows with geometries as hex encoded WKB
+    After the data is loaded, a GiST index is created on the geometry column and an index on each column in id_cols that is in the geodataframe, and the table is analyzed
+    If id_cols is not provided, the columns edge_id, osmid and seg_id are indexed
+    If replace is used, the old table is dropped without CASCADE, so loading fails if other tables or views depend on it
+    Errors are raised after the transaction is rolled back, so a failed load does not leave a missing or half written table unnoticed
+    '''
+
+    geom_col = geodataframe.geometry.name
+    srid = geodataframe.crs.to_epsg() if geodataframe.crs is not None else None
+
+    columns = list(geodataframe.columns)
+
+    if id_cols is None:
+        id_cols = ['edge_id', 'osmid', 'seg_id']
+
+    id_cols = [c for c in id_cols if c in columns and c != geom_col]
+
+    quote = engine.dialect.identifier_preparer.quote
+    table = quote(table_name)
+
+    geom_type = f'geometry(Geometry, {srid})' if srid is not None else 'geometry'
+    col_defs = ', '.join(
+        f'{quote(c)} {geom_type if c == geom_col else _get_pg_type(geodataframe[c])}' for c in columns
+    )
+
+    connection = engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL;', (table_name,))
+        exists = cursor.fetchone()[0]
+
+        if exists and if_exists == 'fail':
+            raise ValueError(f'Table {table_name} already exists!')
+
+        if exists and if_exists == 'replace':
+            cursor.execute(f'DROP TABLE IF EXISTS {table};')
+
+        if not exists or if_exists == 'replace':
+            cursor.execute(f'CREATE TABLE {table} ({col_defs});')
+
+        copy_sql = f"COPY {table} ({', '.join(quote(c) for c in columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N');"
+
+        for start in range(0, len(geodataframe), chunksize):
+            buffer = _get_copy_buffer(geodataframe.iloc[start:start + chunksize], geom_col, srid)
+            cursor.copy_expert(copy_sql, buffer)
+
+        # Indexes are created after loading, which is faster than updating them for every row
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {quote(table_name + "_" + geom_col + "_idx")} ON {table} USING GIST ({quote(geom_col)});')
+
+        for c in id_cols:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {quote(table_name + "_" + c + "_idx")} ON {table} ({quote(c)});')
+
+        connection.commit()
+
+        # Update statistics so the query planner knows the size of the new table
+        cursor.execute(f'ANALYZE {table};')
+        connection.commit()
+
+        print(table_name, 'successfully loaded to database!')
+
+    except(Exception) as error:
+        connection.rollback()
+        print('Error while uploading data to database:', error)
+        raise
+
+    finally:
+        connection.close()
+
+
+#Function for building a query for a table with an optional bounding box filter
+def _get_table_query(table_name, engine, geom_col='geometry', columns=None, bbox=None, where=None, order_by=None):
+
+    '''
+    Helper function for read_postgis_chunks
+    Builds a query selecting columns from table_name
+    If bbox (minx, miny, maxx, maxy) is given, only features intersecting the bbox are selected. The filter uses ST_Intersects, so a GiST index on the geometry column is used
+    where is an optional sql condition added to the query
+    order_by is an optional list of columns the rows are sorted by
+    Returns the query and the parameters
+    '''
+
+    quote = engine.dialect.identifier_preparer.quote
+
+    geom = quote(geom_col)
+
+    if columns is None:
+        select = '*'
+    else:
+        select = ', '.join(quote(c) for c in columns if c != geom_col) + ', ' + geom
+
+    params = {}
+    conditions = []
+
+    if bbox is not None:
+        # The srid of the table is used for the envelope, so the envelope is a constant and the spatial index can be used
+        conditions.append(
+            f"ST_Intersects({geom}, ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, Find_SRID(current_schema()::varchar, :table_name, :geom_col)))"
+        )
+        params.update(dict(zip(['xmin', 'ymin', 'xmax', 'ymax'], [float(b) for b in bbox])))
+        params.update({'table_name': table_name, 'geom_col': geom_col})
+
+    if where is not None:
+        conditions.append(f'({where})')
+
+    query = f'SELECT {select} FROM {quote(table_name)}'
+
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    if order_by is not None:
+        query += ' ORDER BY ' + ', '.join(quote(c) for c in order_by)
+
+    return sqlalchemy.text(query), params
+
+
+#Function for reading a table in chunks using sqlalchemy
+def read_postgis_chunks(table_name, engine, geom_col='geometry', columns=None, chunksize=100000, bbox=None, where=None, order_by=None):
+
+    '''
+    Function for reading a table with geometries in chunks, without loading the whole table into memory
+    Uses a server side cursor, so only one chunk is transferred from the database at a time
+    Required input are name of table and sqlalchemy engine
+    Optional input are name of geometry column, list of columns to read (default is all), number of rows per chunk,
+    a bounding box (minx, miny, maxx, maxy) in the crs of the table, an sql condition used to filter the rows
+    and a list of columns to sort the rows by. Without order_by the order of the rows (and so the rows in each chunk) can change between runs
+    Yields geodataframes with up to chunksize rows
+    '''
+
+    query, params = _get_table_query(table_name, engine, geom_col=geom_col, columns=columns, bbox=bbox, where=where, order_by=order_by)
+
+    with engine.connect().execution_options(stream_results=True) as connection:
+
+        chunks = gpd.read_postgis(query, connection, geom_col=geom_col, params=params, chunksize=chunksize)
+
+        for chunk in chunks:
+            yield chunk
+
+
 # Function for running query using sqlalchemy
 def run_query_alc(query,engine,success='Query successful!',fail='Query failed!'):
-    with engine.connect() as connection:
-        try:
+
+    '''
+    Function for running a sql query using sqlalchemy
+    The query is run in a transaction on a pooled connection, which is commited if the query succeeds and rolled back if not
+    '''
+
+    if isinstance(query, str):
+        query = sqlalchemy.text(query)
+
+    try:
+        with engine.begin() as connection:
             result = connection.execute(query)
             print(success)
+            if result.returns_rows:
+                return result.fetchall()
             return result
-        except(Exception) as error:
-            print(fail)
-            print(error)
+    except(Exception) as error:
+        print(fail)
+        print(error)
 
 
 
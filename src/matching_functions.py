@@ -5,39 +5,96 @@ import geopandas as gpd
 import numpy as np
 import pandas as pd
 from scipy.spatial.distance import directed_hausdorff
-from shapely.ops import linemerge, substring
-from shapely.geometry import MultiLineString
+import shapely
 import math
+from concurrent.futures import ProcessPoolExecutor
+from src import cache_functions as cf
 
 
-def _get_angle(linestring1, linestring2):
+def get_bearings(geoms, method="first_segment"):
 
     """
-    Function for getting the smallest angle between two lines.
+    Computes the bearing of many LineStrings at once.
+    Does not take the direction of lines into account, i.e. bearings are between 0 and 180 degrees.
+
+    Arguments:
+        geoms (array of Shapely LineStrings): lines to compute bearings for
+        method (str): how the direction of a line is found.
+            'first_segment' (default) uses the first two vertices.
+            'principal' uses the length weighted mean direction of all line segments (averaged on doubled angles, so opposite directions count as the same direction).
+            'endpoints' uses the direction from the first to the last vertex.
+
+    Returns:
+        bearings (array): bearing of each line in degrees, between 0 and 180
+    """
+
+    assert method in [
+        "principal",
+        "endpoints",
+        "first_segment",
+    ], "Method must be 'principal', 'endpoints' or 'first_segment'!"
+
+    if method == "first_segment":
+        vec = shapely.get_coordinates(shapely.get_point(geoms, 1)) - shapely.get_coordinates(
+            shapely.get_point(geoms, 0)
+        )
+
+    else:
+        vec = shapely.get_coordinates(shapely.get_point(geoms, -1)) - shapely.get_coordinates(
+            shapely.get_point(geoms, 0)
+        )
+
+    bearings = np.degrees(np.arctan2(vec[:, 1], vec[:, 0])) % 180
+
+    if method == "principal":
+
+        coords, line_ix = shapely.get_coordinates(geoms, return_index=True)
+
+        # Vectors of all line segments, excluding the step from the last vertex of one line to the first of the next
+        vectors = np.diff(coords, axis=0)
+        seg_ix = line_ix[1:]
+        seg_length = np.hypot(vectors[:, 0], vectors[:, 1])
+
+        keep = (line_ix[1:] == line_ix[:-1]) & (seg_length > 0)
+        dx, dy = vectors[keep].T
+        seg_ix = seg_ix[keep]
+        seg_length = seg_length[keep]
+
+        # Length weighted sum of cos(2 * angle) and sin(2 * angle) of each segment
+        weighted_cos = np.bincount(
+            seg_ix, (dx**2 - dy**2) / seg_length, minlength=len(geoms)
+        )
+        weighted_sin = np.bincount(seg_ix, 2 * dx * dy / seg_length, minlength=len(geoms))
+
+        principal = np.degrees(np.arctan2(weighted_sin, weighted_cos) / 2) % 180
+
+        # Use the direction between the endpoints if the line has no principal direction (e.g. a line with zero length)
+        has_direction = np.hypot(weighted_sin, weighted_cos) > 1e-9
+        bearings = np.where(has_direction, principal, bearings)
+
+    return bearings
+
+
+def _get_angles(osm_bearings, ref_bearings):
+
+    """
+    Function for getting the smallest angle between pairs of lines.
     Does not take the direction of lines into account: I.e. is the angle larger than 90, it is instead expressed as 180 minus the original angle.
 
     Argumets:
-        linestring1 (Shapely LineString): first line
-        linestring2 (Shapely LineString: second line
+        osm_bearings (array): bearing of the first line in each pair (result from get_bearings())
+        ref_bearings (array): bearing of the second line in each pair (result from get_bearings())
 
     Returns
     -------
-    angle_deg (float): angle expressed in degrees
+    angles_deg (array): angle for each pair expressed in degrees
     """
 
-    arr1 = np.array(linestring1.coords)
-    arr1 = arr1[1] - arr1[0]
+    angles_deg = np.abs(osm_bearings - ref_bearings) % 180
 
-    arr2 = np.array(linestring2.coords)
-    arr2 = arr2[1] - arr2[0]
+    angles_deg = np.where(angles_deg > 90, 180 - angles_deg, angles_deg)
 
-    angle = np.math.atan2(np.linalg.det([arr1, arr2]), np.dot(arr1, arr2))
-    angle_deg = abs(np.degrees(angle))
-
-    if angle_deg > 90:
-        angle_deg = 180 - angle_deg
-
-    return angle_deg
+    return angles_deg
 
 
 def _get_hausdorff_dist(osm_edge, ref_edge):
@@ -65,73 +122,199 @@ def _get_hausdorff_dist(osm_edge, ref_edge):
     return hausdorff_dist
 
 
-def _get_segments(linestring, seg_length):
+def _get_padded_coords(coords, offsets, counts, n_vertices):
 
     """
-    Convert a Shapely LineString into segments of a speficied length.
-    If a line segment ends up being shorter than the specified distance, it is merged with the segment before it.
+    Helper function for _get_hausdorff_dists(). Gathers the coordinates of a batch of lines into one array with n_vertices rows per line.
+    Lines with fewer vertices are padded by repeating their last vertex, which does not change the Hausdorff distance.
 
     Arguments:
-        linestring (Shapely LineString): Line to be cut into segments
-        seg_length (numerical): The length of the segments
+        coords (array): coordinates of all lines
+        offsets (array): position in coords of the first vertex of each line in the batch
+        counts (array): number of vertices of each line in the batch
+        n_vertices (int): number of vertices in the padded array
 
     Returns:
-        lines (Shapely MultiLineString): A multilinestring consisting of the line segments.
+        padded (array): array with shape (lines, n_vertices, 2)
     """
 
-    org_length = linestring.length
+    ix = offsets[:, None] + np.minimum(np.arange(n_vertices), counts[:, None] - 1)
 
-    no_segments = math.ceil(org_length / seg_length)
+    return coords[ix]
 
-    start = 0
-    end = seg_length
-    lines = []
 
-    for _ in range(no_segments):
+def _get_hausdorff_dists(
+    osm_geoms, ref_geoms, densify=None, chunk_size=100000, max_size=10000000
+):
 
-        assert start != end
+    """
+    Computes the Hausdorff distance between many pairs of LineStrings in one call.
+    Gives the same result as _get_hausdorff_dist() for each pair, but without the overhead of a function call per pair.
+    Pairs are processed in chunks of lines with a similar number of vertices to limit the size of the padded arrays.
 
-        l = substring(linestring, start, end)
+    Arguments:
+        osm_geoms (array of Shapely LineStrings): first line in each pair
+        ref_geoms (array of Shapely LineStrings): second line in each pair
+        densify (numerical): if not None, vertices are added to both lines so no line segment is longer than densify (in meters) before the distance is computed.
+            Without densification only the vertices of the lines are compared, which is less accurate for lines with long straight parts
+        chunk_size (int): max number of pairs processed at once
+        max_size (int): max number of vertex to vertex distances computed at once. Chunks with lines with many vertices are made smaller
 
-        lines.append(l)
+    Returns:
+        hausdorff_dists (array): The Hausdorff distance for each pair
+    """
 
-        start += seg_length
-        end += seg_length
+    hausdorff_dists = np.empty(len(osm_geoms))
 
-    # If the last segment is too short, merge it with the one before
-    # Check that more than one line exist (to avoid cases where the line is too short to create multiple segments)
-    if len(lines) > 1:
-        for i, l in enumerate(lines):
-            if l.length < seg_length / 3:
-                new_l = linemerge((lines[i - 1], l))
+    if len(osm_geoms) == 0:
+        return hausdorff_dists
 
-                lines[i - 1] = new_l
+    if densify is not None:
+        osm_geoms = shapely.segmentize(osm_geoms, densify)
+        ref_geoms = shapely.segmentize(ref_geoms, densify)
 
-                del lines[i]
+    osm_coords, osm_ix = shapely.get_coordinates(osm_geoms, return_index=True)
+    ref_coords, ref_ix = shapely.get_coordinates(ref_geoms, return_index=True)
 
-    lines = MultiLineString(lines)
+    osm_counts = np.bincount(osm_ix, minlength=len(osm_geoms))
+    ref_counts = np.bincount(ref_ix, minlength=len(ref_geoms))
 
-    return lines
+    osm_offsets = np.r_[0, np.cumsum(osm_counts)[:-1]]
+    ref_offsets = np.r_[0, np.cumsum(ref_counts)[:-1]]
 
+    # Sort pairs by number of vertices, so pairs of similar size are padded together
+    n_vertices = np.maximum(osm_counts, ref_counts)
+    order = np.argsort(n_vertices, kind="stable")
+
+    start = 0
+    while start < len(order):
+
+        # Limit the size of the array with distances between all vertices of the chunk
+        end = min(start + chunk_size, len(order))
+        chunk_vertices = n_vertices[order[end - 1]]
+        end = start + max(1, min(end - start, max_size // chunk_vertices**2))
+
+        chunk = order[start:end]
+        start = end
+
+        osm_padded = _get_padded_coords(
+            osm_coords, osm_offsets[chunk], osm_counts[chunk], osm_counts[chunk].max()
+        )
+        ref_padded = _get_padded_coords(
+            ref_coords, ref_offsets[chunk], ref_counts[chunk], ref_counts[chunk].max()
+        )
 
-def _merge_multiline(line_geom):
+        # Squared distances between all vertices of each pair - shape (pairs, osm vertices, ref vertices)
+        diff = osm_padded[:, :, None, :] - ref_padded[:, None, :, :]
+        sq_dists = np.einsum("ijkl,ijkl->ijk", diff, diff)
+
+        hausdorff_dists[chunk] = np.sqrt(
+            np.maximum(
+                sq_dists.min(axis=2).max(axis=1), sq_dists.min(axis=1).max(axis=1)
+            )
+        )
+
+    return hausdorff_dists
+
+
+# Increase cache_functions.SEGMENT_VERSION when the segments created here change
+def _get_segments(geoms, seg_length):
 
     """
-    Convert a Shapely MultiLinestring into a Linestring
+    Convert an array of Shapely LineStrings into segments of a speficied length.
+    If a line segment ends up being shorter than a third of the specified distance, it is merged with the segment before it.
+    All lines are processed at once using the cumulative length along the coordinates of the lines.
 
     Arguments:
-        line_geom (Shapely LineString or MultiLineString): geometry to be merged
+        geoms (array of Shapely LineStrings): Lines to be cut into segments
+        seg_length (numerical): The length of the segments
 
     Returns:
-        line_geom (Shapely LineString): original geometry as LineString
+        segments (array of Shapely LineStrings): the line segments, ordered by line and position along the line
+        geom_ix (array): position in geoms of the line each segment was created from
     """
 
-    if line_geom.geom_type == "MultiLineString":
-        line_geom = linemerge(line_geom)
+    lengths = shapely.length(geoms)
+
+    no_segments = np.ceil(lengths / seg_length).astype(np.int64)
+
+    # Distance along the line of the k'th cut, computed by repeated addition of the segment length
+    cut_lookup = np.zeros(no_segments.max(initial=0) + 2)
+    cut_lookup[1:] = np.cumsum(np.full(len(cut_lookup) - 1, seg_length))
+
+    # If the last segment is too short, merge it with the one before
+    # Check that more than one segment exist (to avoid cases where the line is too short to create multiple segments)
+    merge_last = (no_segments > 1) & (
+        lengths - cut_lookup[np.maximum(no_segments - 1, 0)] < seg_length / 3
+    )
+    no_out = no_segments - merge_last
+
+    geom_ix = np.repeat(np.arange(len(geoms)), no_out)
+    first_seg = np.cumsum(no_out) - no_out
+    seg_no = np.arange(len(geom_ix)) - np.repeat(first_seg, no_out)
+    seg_ix = np.arange(len(geom_ix))
+
+    is_merged = merge_last[geom_ix] & (seg_no == no_out[geom_ix] - 1)
+
+    starts = cut_lookup[seg_no]
+    ends = cut_lookup[np.where(is_merged, seg_no + 2, seg_no + 1)]
+
+    # Cumulative distance along each line for all vertices
+    coords, vertex_geom_ix = shapely.get_coordinates(geoms, return_index=True)
+    new_geom = np.ones(len(coords), dtype=bool)
+    new_geom[1:] = vertex_geom_ix[1:] != vertex_geom_ix[:-1]
+    step = np.zeros(len(coords))
+    step[1:] = (
+        (coords[1:, 0] - coords[:-1, 0]) ** 2 + (coords[1:, 1] - coords[:-1, 1]) ** 2
+    ) ** 0.5
+    step[new_geom] = 0
+    vertex_dist = pd.Series(step).groupby(vertex_geom_ix).cumsum().values
+
+    # Interior vertices are placed in the segment they fall strictly within
+    last_vertex = np.ones(len(coords), dtype=bool)
+    last_vertex[:-1] = new_geom[1:]
+    vertex_seg_no = np.floor(vertex_dist / seg_length).astype(np.int64)
+    vertex_seg_no = np.clip(vertex_seg_no, 0, len(cut_lookup) - 2)
+    vertex_seg_no -= (vertex_seg_no > 0) & (cut_lookup[vertex_seg_no] > vertex_dist)
+    vertex_seg_no += cut_lookup[vertex_seg_no + 1] <= vertex_dist
+    is_interior = (
+        ~new_geom
+        & ~last_vertex
+        & (cut_lookup[vertex_seg_no] < vertex_dist)
+        & (vertex_seg_no < no_segments[vertex_geom_ix])
+    )
+    vertex_seg_no = np.minimum(vertex_seg_no, no_out[vertex_geom_ix] - 1)
+
+    vertex_seg_ix = first_seg[vertex_geom_ix] + vertex_seg_no
+
+    # Start, end and (for merged segments) joint points are interpolated along the line
+    joint_ix = seg_ix[is_merged]
+    cut_seg_ix = np.concatenate([seg_ix, joint_ix, seg_ix])
+    cut_dist = np.concatenate([starts, cut_lookup[seg_no[joint_ix] + 1], ends])
+    cut_order = np.repeat([0, 1, 2], [len(seg_ix), len(joint_ix), len(seg_ix)])
+    cut_points = shapely.line_interpolate_point(geoms[geom_ix[cut_seg_ix]], cut_dist)
+
+    all_seg_ix = np.concatenate([cut_seg_ix, vertex_seg_ix[is_interior]])
+    all_dist = np.concatenate([cut_dist, vertex_dist[is_interior]])
+    all_order = np.concatenate([cut_order, np.ones(is_interior.sum(), dtype=int)])
+    all_coords = np.concatenate(
+        [shapely.get_coordinates(cut_points), coords[is_interior]]
+    )
 
-    assert line_geom.geom_type == "LineString"
+    order = np.lexsort((all_dist, all_order, all_seg_ix))
+    all_seg_ix = all_seg_ix[order]
+    all_coords = all_coords[order]
 
-    return line_geom
+    # Merging two segments removes repeated points
+    repeated = np.zeros(len(all_seg_ix), dtype=bool)
+    repeated[1:] = (all_seg_ix[1:] == all_seg_ix[:-1]) & (
+        all_coords[1:] == all_coords[:-1]
+    ).all(axis=1)
+    keep = ~(repeated & is_merged[all_seg_ix])
+
+    segments = shapely.linestrings(all_coords[keep], indices=all_seg_ix[keep])
+
+    return segments, geom_ix
 
 
 def create_segment_gdf(org_gdf, segment_length):
@@ -146,47 +329,85 @@ def create_segment_gdf(org_gdf, segment_length):
     Returns:
         segments_gdf (geodataframe): New geodataframe with segments and new unique ids (seg_id)
     """
-    gdf = org_gdf.copy()
-    gdf["geometry"] = gdf["geometry"].apply(lambda x: _merge_multiline(x))
-    assert gdf.geometry.geom_type.unique()[0] == "LineString"
 
-    gdf["geometry"] = gdf["geometry"].apply(lambda x: _get_segments(x, segment_length))
-    segments_gdf = gdf.explode(index_parts=False, ignore_index=True)
+    geoms = org_gdf.geometry.values.copy()
+
+    # Convert MultiLineStrings to LineStrings
+    is_multi = shapely.get_type_id(geoms) == 5
+    geoms[is_multi] = shapely.line_merge(geoms[is_multi])
+    assert (shapely.get_type_id(geoms) == 1).all()
+
+    segments, geom_ix = _get_segments(geoms, segment_length)
 
-    segments_gdf.dropna(subset=["geometry"], inplace=True)
+    # The geometry column is moved to the end, as in GeoDataFrame.explode
+    geom = org_gdf.geometry.name
+    segments_gdf = org_gdf[[c for c in org_gdf.columns if c != geom]].iloc[geom_ix].reset_index(drop=True)
+    segments_gdf = gpd.GeoDataFrame(segments_gdf, geometry=gpd.GeoSeries(segments, crs=org_gdf.crs, name=geom))
 
-    ids = []
-    for i in range(1000, 1000 + len(segments_gdf)):
-        ids.append(i)
+    segments_gdf.dropna(subset=[geom], inplace=True)
 
-    segments_gdf["seg_id"] = ids
+    segments_gdf["seg_id"] = np.arange(1000, 1000 + len(segments_gdf))
     assert len(segments_gdf["seg_id"].unique()) == len(segments_gdf)
 
     return segments_gdf
 
 
-def _find_matches_from_group(group_id, groups, id_col):
+def _get_buffer_pairs(
+    osm_data, reference_data, dist, ref_id_col, osm_id_col, method
+):
 
     """
-    Helper function for overlay_buffer(). Returns all values in a column for a group in a grouped dataframe.
+    Helper function for overlay_buffer(). Finds all pairs of reference and osm features within the specified distance of each other.
 
     Arguments:
-        group_id (str/int): identifier of specific group
-        groups (grouped datafame):
-        id_col (str): name of column to be returned
+        osm_data (gdf):
+        reference_data (gdf):
+        dist (numeric): max distance (meters) between potential matches
+        ref_id_col (str): name of column with unique edge id in reference data
+        osm_id_col (str): name of column with unique edge id in osm data
+        method (str): 'strtree' for querying the spatial index of osm_data directly, or 'overlay' for intersecting buffered reference features with osm_data
 
     Returns:
-        matches (list): column values as list
+        pairs (df): dataframe with a row per pair with the reference id and the osm id
     """
 
-    group = groups.get_group(group_id)
+    if method == "strtree":
 
-    matches = list(group[id_col])
+        # Query the spatial index of the osm data - no buffer polygons or intersection geometries are created
+        ref_ix, osm_ix = osm_data.sindex.query(
+            reference_data.geometry.values, predicate="dwithin", distance=dist
+        )
 
-    return matches
+        order = np.lexsort((osm_ix, ref_ix))
 
+        pairs = pd.DataFrame(
+            {
+                ref_id_col: reference_data[ref_id_col].values[ref_ix[order]],
+                osm_id_col: osm_data[osm_id_col].values[osm_ix[order]],
+            }
+        )
 
-def overlay_buffer(osm_data, reference_data, dist, ref_id_col, osm_id_col):
+    elif method == "overlay":
+
+        reference_buff = reference_data[[ref_id_col, "geometry"]].copy(deep=True)
+        reference_buff.geometry = reference_buff.geometry.buffer(distance=dist)
+
+        # Overlay buffered geometries and osm segments
+        joined = gpd.overlay(
+            reference_buff, osm_data, how="intersection", keep_geom_type=False
+        )
+
+        pairs = pd.DataFrame(joined[[ref_id_col, osm_id_col]])
+
+    else:
+        raise ValueError(f"Unknown method for finding buffer matches: {method}")
+
+    return pairs
+
+
+def overlay_buffer(
+    osm_data, reference_data, dist, ref_id_col, osm_id_col, method="strtree"
+):
 
     """
     Initial buffer matching function. Matches each row in a dataset with reference data (linestrings) to all the osm features that are within the specified buffer distance.
@@ -198,6 +419,10 @@ def overlay_buffer(osm_data, reference_data, dist, ref_id_col, osm_id_col):
         reference_data (gdf):
         dist (numeric): max distance (meters) between potential matches
         ref_id_col (str): name of column with unique edge id in reference data
+        osm_id_col (str): name of column with unique edge id in osm data
+        method (str): 'strtree' (default) finds the matches with a spatial index query, 'overlay' with an overlay of buffered reference features.
+            'strtree' uses the exact distance, while the buffer polygons used by 'overlay' are a slightly smaller approximation of the same distance,
+            so 'strtree' can return a few additional matches at the edge of the buffer.
 
     Returns:
         reference_buff (df):  dataframe with the buffered matches for each reference segment
@@ -205,132 +430,389 @@ def overlay_buffer(osm_data, reference_data, dist, ref_id_col, osm_id_col):
 
     assert osm_data.crs == reference_data.crs, "Data not in the same crs!"
 
-    # TODO: no need for deep copy?
-    reference_buff = reference_data[[ref_id_col, "geometry"]].copy(deep=True)
-    reference_buff.geometry = reference_buff.geometry.buffer(distance=dist)
-
-    # Overlay buffered geometries and osm segments
-    joined = gpd.overlay(
-        reference_buff, osm_data, how="intersection", keep_geom_type=False
+    pairs = _get_buffer_pairs(
+        osm_data, reference_data, dist, ref_id_col, osm_id_col, method
     )
 
     # Group by id - find all matches for each ref segment
-    grouped = joined.groupby(ref_id_col)
+    grouped = pairs.groupby(ref_id_col, sort=False)[osm_id_col].agg(list)
 
-    reference_buff["matches_id"] = None
+    reference_buff = pd.DataFrame(reference_data[[ref_id_col]])
 
-    group_ids = grouped.groups.keys()
+    reference_buff["matches_id"] = reference_buff[ref_id_col].map(grouped)
 
-    reference_buff["matches_id"] = reference_buff.apply(
-        lambda x: _find_matches_from_group(x[ref_id_col], grouped, osm_id_col)
-        if x[ref_id_col] in group_ids
-        else 0,
-        axis=1,
-    )
+    # Remove rows with no matches
+    reference_buff = reference_buff[reference_buff["matches_id"].notna()].copy()
 
     # Count matches
-    reference_buff["count"] = reference_buff["matches_id"].apply(
-        lambda x: len(x) if type(x) == list else 0
+    reference_buff["count"] = reference_buff["matches_id"].apply(len)
+
+    return reference_buff
+
+
+def get_candidate_store(
+    osm_data, reference_data, dist, ref_id_col, osm_id_col, method="strtree"
+):
+
+    """
+    Finds the same potential matches as overlay_buffer(), but stores them in compact arrays instead of a column with lists.
+    The osm ids of the potential matches of all reference features are stored in one flat array, ordered by reference feature (CSR layout).
+    The potential matches of the i'th reference feature are osm_ids[offsets[i]:offsets[i+1]].
+    Only reference features with at least one potential match are included, in the order of reference_data.
+
+    Arguments:
+        osm_data (gdf): osm segments
+        reference_data (gdf): reference segments
+        dist (numeric): max distance (meters) between potential matches
+        ref_id_col (str): name of column with unique edge id in reference data
+        osm_id_col (str): name of column with unique (integer) edge id in osm data
+        method (str): 'strtree' (default) or 'overlay' (see overlay_buffer())
+
+    Returns:
+        candidates (dict): dictionary with the arrays 'ref_ids' (ids of reference features), 'offsets' (start of the matches of each reference feature in osm_ids)
+            and 'osm_ids' (ids of the potential osm matches), and the names of the id columns ('ref_id_col' and 'osm_id_col')
+    """
+
+    assert osm_data.crs == reference_data.crs, "Data not in the same crs!"
+
+    pairs = _get_buffer_pairs(
+        osm_data, reference_data, dist, ref_id_col, osm_id_col, method
     )
 
-    # Remove rows with no matches
-    reference_buff = reference_buff[reference_buff["count"] >= 1]
+    # Order pairs by the position of the reference feature in reference_data
+    ref_pos = pd.Index(reference_data[ref_id_col]).get_indexer(pairs[ref_id_col])
+    order = np.argsort(ref_pos, kind="stable")
 
-    reference_buff.drop("geometry", axis=1, inplace=True)
+    ref_pos, counts = np.unique(ref_pos[order], return_counts=True)
 
-    return reference_buff
+    candidates = {
+        "ref_ids": reference_data[ref_id_col].values[ref_pos],
+        "offsets": np.r_[0, np.cumsum(counts)].astype(np.int64),
+        "osm_ids": pairs[osm_id_col].values[order].astype(np.int64),
+        "ref_id_col": ref_id_col,
+        "osm_id_col": osm_id_col,
+    }
 
+    return candidates
 
-# Function for finding the best out of potential/possible matches
-def _find_best_match(
-    buffer_matches,
-    ref_index,
+
+def save_candidate_store(candidates, fp):
+
+    """
+    Save potential matches (result from get_candidate_store()) to disk as a .npz file.
+
+    Arguments:
+        candidates (dict): potential matches
+        fp (str): file path
+
+    Returns:
+        None
+    """
+
+    np.savez(fp, **candidates)
+
+    return None
+
+
+def load_candidate_store(fp):
+
+    """
+    Load potential matches saved with save_candidate_store().
+
+    Arguments:
+        fp (str): file path
+
+    Returns:
+        candidates (dict): potential matches
+    """
+
+    with np.load(fp, allow_pickle=False) as data:
+        candidates = {k: data[k] for k in data.files}
+
+    candidates["ref_id_col"] = str(candidates["ref_id_col"])
+    candidates["osm_id_col"] = str(candidates["osm_id_col"])
+
+    return candidates
+
+
+def _get_candidate_pairs(buffer_matches, osm_edges, reference_data, osm_id_col="seg_id"):
+
+    """
+    Helper function for find_matches_from_buffer(). Converts the potential matches from the buffer step into one table with a row per (reference segment, osm segment) pair.
+
+    Arguments:
+        buffer_matches (dataframe or dict): Outcome of buffer intersection step (result from overlay_buffer() or get_candidate_store())
+        osm_edges (geodataframe): osm segments
+        reference_data (geodataframe): reference segments
+        osm_id_col (str): name of column with unique segment id in osm_edges
+
+    Returns:
+        pairs (dataframe): dataframe with the column 'ref_ix' with the index of the reference segment and 'osm_pos' with the position of the osm segment in osm_edges
+    """
+
+    if isinstance(buffer_matches, dict):
+
+        ref_pos = pd.Index(
+            reference_data[buffer_matches["ref_id_col"]]
+        ).get_indexer(buffer_matches["ref_ids"])
+
+        ref_pos = np.repeat(ref_pos, np.diff(buffer_matches["offsets"]))
+
+        osm_pos = pd.Index(osm_edges[osm_id_col]).get_indexer(
+            buffer_matches["osm_ids"]
+        )
+
+        # Ignore reference segments that are not in reference_data
+        osm_pos = osm_pos[ref_pos >= 0]
+        ref_ix = reference_data.index.values[ref_pos[ref_pos >= 0]]
+
+    else:
+
+        exploded = buffer_matches["matches_id"].explode()
+
+        osm_pos = pd.Index(osm_edges[osm_id_col]).get_indexer(exploded.values)
+        ref_ix = exploded.index.values
+
+    pairs = pd.DataFrame({"ref_ix": ref_ix, "osm_pos": osm_pos})
+
+    # Ignore potential matches that are not in osm_edges
+    pairs = pairs[pairs["osm_pos"] >= 0].reset_index(drop=True)
+
+    return pairs
+
+
+def _get_bbox_lower_bounds(osm_bounds, ref_bounds):
+
+    """
+    Helper function for _score_candidate_pairs(). Computes a lower bound of the Hausdorff distance between pairs of lines from their bounding boxes.
+    All points of one line are within the Hausdorff distance of the other line, so the bounding boxes of the two lines
+    can not differ by more than the Hausdorff distance on any side.
+
+    Arguments:
+        osm_bounds (array): bounding box (minx, miny, maxx, maxy) of the first line in each pair
+        ref_bounds (array): bounding box of the second line in each pair
+
+    Returns:
+        lower_bounds (array): lower bound of the Hausdorff distance for each pair
+    """
+
+    return np.abs(osm_bounds - ref_bounds).max(axis=1)
+
+
+def _get_endpoint_lower_bounds(osm_endpoints, ref_endpoints, osm_bounds, ref_bounds):
+
+    """
+    Helper function for _score_candidate_pairs(). Computes a lower bound of the Hausdorff distance between pairs of lines from the endpoints of the lines.
+    The endpoints of each line are within the Hausdorff distance of the other line, and therefore also of its bounding box.
+
+    Arguments:
+        osm_endpoints (array): coordinates of the first and last vertex of the first line in each pair, with shape (pairs, 2, 2)
+        ref_endpoints (array): coordinates of the first and last vertex of the second line in each pair
+        osm_bounds (array): bounding box (minx, miny, maxx, maxy) of the first line in each pair
+        ref_bounds (array): bounding box of the second line in each pair
+
+    Returns:
+        lower_bounds (array): lower bound of the Hausdorff distance for each pair
+    """
+
+    def _get_dist_to_bounds(points, bounds):
+        # Distance from points to the bounding boxes - 0 for points inside the box
+        dx = np.maximum(
+            np.maximum(bounds[:, None, 0] - points[:, :, 0], 0),
+            points[:, :, 0] - bounds[:, None, 2],
+        )
+        dy = np.maximum(
+            np.maximum(bounds[:, None, 1] - points[:, :, 1], 0),
+            points[:, :, 1] - bounds[:, None, 3],
+        )
+        return np.hypot(dx, dy).max(axis=1)
+
+    return np.maximum(
+        _get_dist_to_bounds(osm_endpoints, ref_bounds),
+        _get_dist_to_bounds(ref_endpoints, osm_bounds),
+    )
+
+
+def _score_candidate_pairs(
+    pairs,
     osm_edges,
-    reference_edge,
+    reference_data,
     angular_threshold,
     hausdorff_threshold,
+    densify=None,
+    angle_method="first_segment",
+    verbose=False,
 ):
 
     """
-    Finds the best match out of potential matches identifed with a buffer method.
-    Computes angle and hausdorff and find best match within threshold, if any exist.
+    Computes the angle and the Hausdorff distance for all candidate pairs at once.
+    Pairs are pruned with a series of increasingly expensive tests, so the exact Hausdorff distance is only computed for the remaining pairs:
+    1. a lower bound of the Hausdorff distance based on the bounding boxes of the segments
+    2. a lower bound of the Hausdorff distance based on the distance from the endpoints of each segment to the bounding box of the other
+    3. the angle between the segments
+    Pairs removed by a test can not be a match, and have no value for the angle and/or Hausdorff distance.
+    The bearing, bounding box and endpoints of each segment are only computed once, no matter how many pairs it is part of.
 
     Arguments:
-        buffer_matches(dataframe): Outcome of buffer intersection step
-        ref_index: the index of the reference_edge locating it in the original dataset with reference segments
-        osm_edges (geodataframe): osm_edges to be matched to the reference_edge
-        reference_edge (linestring): edge currently being matched to corresponding edge in osm_edges
+        pairs (dataframe): candidate pairs (result from _get_candidate_pairs())
+        osm_edges (geodataframe): osm segments
+        reference_data (geodataframe): reference segments
         angular_threshold (numerical): Threshold for max angle between lines considered a match (in degrees)
         hausdorff_threshold: Threshold for max Hausdorff distance between lines considered a match (in meters)
+        densify (numerical): if not None, max distance between vertices used when computing the Hausdorff distance (see _get_hausdorff_dists())
+        angle_method (str): method used to find the bearing of segments (see get_bearings())
+        verbose (boolean): if True, print the number of pairs removed by each test
 
     Returns:
-        best_osm_index: The index of the osm_edge identified as the best match. None if no match is found.
+        pairs (dataframe): candidate pairs with the additional columns 'angle' and 'hausdorff_dist'
     """
 
-    # potential_matches = osm_edges[['osmid','geometry']].loc[osm_edges.osmid.isin(buffer_matches.loc[ref_index,'matches_id'])].copy(deep=True)
+    osm_pos = pairs["osm_pos"].values
+    ref_pos = reference_data.index.get_indexer(pairs["ref_ix"].values)
 
-    potential_matches_ix = osm_edges.loc[
-        osm_edges.seg_id.isin(buffer_matches.loc[ref_index, "matches_id"])
-    ].index
+    # Segments in at least one pair
+    osm_unique, osm_inverse = np.unique(osm_pos, return_inverse=True)
+    ref_unique, ref_inverse = np.unique(ref_pos, return_inverse=True)
 
-    osm_edges["angle"] = osm_edges.loc[potential_matches_ix].apply(
-        lambda x: _get_angle(x.geometry, reference_edge), axis=1
-    )
+    osm_geoms = osm_edges.geometry.values[osm_unique]
+    ref_geoms = reference_data.geometry.values[ref_unique]
+
+    osm_bounds = shapely.bounds(osm_geoms)
+    ref_bounds = shapely.bounds(ref_geoms)
 
-    # Avoid computing Hausdorff distance to edges that fail the angle threshold
-    osm_edges["hausdorff_dist"] = osm_edges.loc[potential_matches_ix].apply(
-        lambda x: _get_hausdorff_dist(osm_edge=x.geometry, ref_edge=reference_edge)
-        if x.angle <= angular_threshold
-        else None,
+    # Stage 1 - bounding boxes
+    lower_bounds = _get_bbox_lower_bounds(
+        osm_bounds[osm_inverse], ref_bounds[ref_inverse]
+    )
+    keep = np.flatnonzero(lower_bounds <= hausdorff_threshold)
+    removed_bbox = len(pairs) - len(keep)
+
+    # Stage 2 - endpoints
+    osm_endpoints = np.stack(
+        [
+            shapely.get_coordinates(shapely.get_point(osm_geoms, 0)),
+            shapely.get_coordinates(shapely.get_point(osm_geoms, -1)),
+        ],
+        axis=1,
+    )
+    ref_endpoints = np.stack(
+        [
+            shapely.get_coordinates(shapely.get_point(ref_geoms, 0)),
+            shapely.get_coordinates(shapely.get_point(ref_geoms, -1)),
+        ],
         axis=1,
     )
 
-    # Find matches within thresholds out of all matches for this referehce geometry
-    potential_matches_subset = osm_edges[
-        (osm_edges.angle <= angular_threshold)
-        & (osm_edges.hausdorff_dist <= hausdorff_threshold)
-    ].copy()
-
-    if len(potential_matches_subset) == 0:
+    lower_bounds = _get_endpoint_lower_bounds(
+        osm_endpoints[osm_inverse[keep]],
+        ref_endpoints[ref_inverse[keep]],
+        osm_bounds[osm_inverse[keep]],
+        ref_bounds[ref_inverse[keep]],
+    )
+    removed_endpoints = np.count_nonzero(lower_bounds > hausdorff_threshold)
+    keep = keep[lower_bounds <= hausdorff_threshold]
 
-        best_osm_ix = None
+    # Stage 3 - angles
+    osm_bearings = get_bearings(osm_geoms, angle_method)
+    ref_bearings = get_bearings(ref_geoms, angle_method)
 
-    elif len(potential_matches_subset) == 1:
-        best_osm_ix = potential_matches_subset.index.values[0]
+    angles = np.full(len(pairs), np.nan)
+    angles[keep] = _get_angles(
+        osm_bearings[osm_inverse[keep]], ref_bearings[ref_inverse[keep]]
+    )
+    removed_angle = np.count_nonzero(angles[keep] > angular_threshold)
+    keep = keep[angles[keep] <= angular_threshold]
 
-    else:
+    # Exact Hausdorff distance for the remaining pairs
+    hausdorff_dists = np.full(len(pairs), np.nan)
+    hausdorff_dists[keep] = _get_hausdorff_dists(
+        osm_geoms[osm_inverse[keep]], ref_geoms[ref_inverse[keep]], densify=densify
+    )
 
-        # Get match(es) with smallest Hausdorff distance and angular tolerance
-        potential_matches_subset["hausdorff_dist"] = pd.to_numeric(
-            potential_matches_subset["hausdorff_dist"]
-        )
-        potential_matches_subset["angle"] = pd.to_numeric(
-            potential_matches_subset["angle"]
+    if verbose:
+        print(
+            f"{len(pairs)} candidate pairs: {removed_bbox} removed by bounding box, {removed_endpoints} removed by endpoints, {removed_angle} removed by angle, {len(keep)} Hausdorff distances computed"
         )
 
-        best_matches_index = potential_matches_subset[
-            ["hausdorff_dist", "angle"]
-        ].idxmin()
-        best_matches = potential_matches_subset.loc[best_matches_index]
+    pairs = pairs.copy()
+    pairs["angle"] = angles
+    pairs["hausdorff_dist"] = hausdorff_dists
+
+    return pairs
+
+
+def _assign_matches(sorted_pairs, max_ref_per_osm):
+
+    """
+    Helper function for _get_best_matches(). Greedy global assignment of reference segments to osm segments.
+    Pairs are visited from best to worst, and a pair is accepted if the reference segment has not been matched yet
+    and the osm segment has been matched to fewer than max_ref_per_osm reference segments.
+
+    Arguments:
+        sorted_pairs (dataframe): valid candidate pairs sorted from best to worst
+        max_ref_per_osm (int): max number of reference segments each osm segment can be matched to
+
+    Returns:
+        accepted (array): boolean array with True for the accepted pairs
+    """
+
+    ref_codes = pd.factorize(sorted_pairs["ref_ix"])[0]
+    osm_codes = pd.factorize(sorted_pairs["osm_pos"])[0]
 
-        best_matches = best_matches[
-            ~best_matches.index.duplicated(keep="first")
-        ]  # Duplicates may appear if the same edge is the one with min dist and min angle
+    # Python lists are faster than arrays for single element access in the loop
+    ref_matched = [False] * (ref_codes.max(initial=-1) + 1)
+    osm_count = [0] * (osm_codes.max(initial=-1) + 1)
+
+    accepted = np.zeros(len(sorted_pairs), dtype=bool)
+
+    for i, (r, o) in enumerate(zip(ref_codes.tolist(), osm_codes.tolist())):
+        if ref_matched[r] or osm_count[o] >= max_ref_per_osm:
+            continue
+        ref_matched[r] = True
+        osm_count[o] += 1
+        accepted[i] = True
 
-        if len(best_matches) == 1:
+    return accepted
 
-            best_osm_ix = best_matches.index.values[0]
 
-        elif len(best_matches) > 1:  # Take the one with the smallest hausdorff distance
+def _get_best_matches(
+    scored_pairs, angular_threshold, hausdorff_threshold, max_ref_per_osm=None
+):
 
-            best_match_index = best_matches["hausdorff_dist"].idxmin()
-            best_match = potential_matches_subset.loc[best_match_index]
-            # Remove duplicates
-            best_match = best_match[~best_match.index.duplicated(keep="first")]
+    """
+    Finds the best match for each reference segment out of the scored candidate pairs.
+    The best match is the pair within both thresholds with the smallest Hausdorff distance.
+    Ties are resolved by the order of the osm segments.
+    If max_ref_per_osm is given, osm segments compete for reference segments: the pairs are assigned greedily from the smallest Hausdorff distance,
+    and a reference segment gets its best match among the osm segments that have not already been matched to max_ref_per_osm reference segments.
 
-            best_osm_ix = best_match.name
+    Arguments:
+        scored_pairs (dataframe): candidate pairs with angle and Hausdorff distance (result from _score_candidate_pairs())
+        angular_threshold (numerical): Threshold for max angle between lines considered a match (in degrees)
+        hausdorff_threshold: Threshold for max Hausdorff distance between lines considered a match (in meters)
+        max_ref_per_osm (int): max number of reference segments each osm segment can be matched to. If None, there is no limit
 
-    return best_osm_ix
+    Returns:
+        best_osm_pos (series): position of the best matching osm segment, indexed by the index of the reference segment
+    """
+
+    valid = scored_pairs[
+        (scored_pairs["angle"] <= angular_threshold)
+        & (scored_pairs["hausdorff_dist"] <= hausdorff_threshold)
+    ]
+
+    best = valid.sort_values(["hausdorff_dist", "osm_pos"], kind="stable")
+
+    if max_ref_per_osm is None:
+        # Grouped argmin - keep the first pair per reference segment after sorting
+        best = best.drop_duplicates(subset="ref_ix", keep="first")
+
+    else:
+        best = best[_assign_matches(best, max_ref_per_osm)]
+
+    best_osm_pos = pd.Series(best["osm_pos"].values, index=best["ref_ix"].values)
+
+    return best_osm_pos
 
 
 def find_matches_from_buffer(
@@ -339,46 +821,66 @@ def find_matches_from_buffer(
     reference_data,
     angular_threshold=20,
     hausdorff_threshold=12,
+    densify=None,
+    angle_method="first_segment",
+    max_ref_per_osm=None,
+    verbose=False,
+    osm_id_col=None,
 ):
 
     """
     Finds the best/correct matches in two datasets with linestrings, from an initial matching based on a buffered intersection.
+    All candidate pairs are scored in one batch, and the best match for each reference segment is the one within the thresholds with the smallest Hausdorff distance.
 
     Arguments:
-        buffer_matches (dataframe): Outcome of buffer intersection step
+        buffer_matches (dataframe or dict): Outcome of buffer intersection step (result from overlay_buffer() or get_candidate_store())
         reference_data (geodataframe): reference data to be matched to osm data
         osm_edges (geodataframe): osm data to be matched to reference data
         angular_threshold (numerical): Threshold for max angle between lines considered a match (in degrees)
         hausdorff_threshold: Threshold for max Hausdorff distance between lines considered a match (in meters)
+        densify (numerical): if not None, vertices are added to the lines so no line segment is longer than densify (in meters) before the Hausdorff distance is computed
+        angle_method (str): method used to find the bearing of segments when computing angles between them (see get_bearings()).
+            Use 'first_segment' for the direction given by the first two vertices, as in earlier versions
+        max_ref_per_osm (int): max number of reference segments each osm segment can be matched to, e.g. 2 for cycle tracks mapped on both sides of the street in the reference data.
+            If given, the matches are assigned greedily from the smallest Hausdorff distance across all reference segments. If None (default), each reference segment is matched to its best match independently
+        verbose (boolean): if True, print the number of candidate pairs removed by each test before the Hausdorff distance is computed
+        osm_id_col (str): name of column with unique segment id in osm_edges, used for the ids of the matches.
+            If None, the column of the candidate store is used, or 'seg_id' if buffer_matches is a dataframe
 
     Returns:
         matched_data (geodataframe): Reference data with additional columns specifying the index and ids of matched osm edges
     """
 
-    # Get edges matched with buffer
-    matched_data = reference_data.loc[buffer_matches.index].copy(deep=True)
+    if osm_id_col is None:
+        osm_id_col = buffer_matches["osm_id_col"] if isinstance(buffer_matches, dict) else "seg_id"
 
     # Find best match within thresholds of angles and distance
-    matched_data["matches_ix"] = matched_data.apply(
-        lambda x: _find_best_match(
-            buffer_matches,
-            ref_index=x.name,
-            osm_edges=osm_edges,
-            reference_edge=x["geometry"],
-            angular_threshold=angular_threshold,
-            hausdorff_threshold=hausdorff_threshold,
-        ),
-        axis=1,
+    pairs = _get_candidate_pairs(buffer_matches, osm_edges, reference_data, osm_id_col)
+
+    scored_pairs = _score_candidate_pairs(
+        pairs,
+        osm_edges,
+        reference_data,
+        angular_threshold,
+        hausdorff_threshold,
+        densify=densify,
+        angle_method=angle_method,
+        verbose=verbose,
+    )
+
+    best_osm_pos = _get_best_matches(
+        scored_pairs, angular_threshold, hausdorff_threshold, max_ref_per_osm
     )
 
     # Drop rows where no match was found
-    matched_data.dropna(subset=["matches_ix"], inplace=True)
+    matched_data = reference_data.loc[
+        reference_data.index.isin(best_osm_pos.index)
+    ].copy(deep=True)
 
-    matched_data["matches_ix"] = matched_data["matches_ix"].astype(int)
+    osm_pos = best_osm_pos.loc[matched_data.index].values
 
-    ixs = matched_data["matches_ix"].values
-    ids = osm_edges["seg_id"].loc[ixs].values
-    matched_data["matches_id"] = ids
+    matched_data["matches_ix"] = osm_edges.index.values[osm_pos].astype(int)
+    matched_data["matches_id"] = osm_edges[osm_id_col].values[osm_pos]
 
     print(f"{len(matched_data)} reference segments were matched to OSM edges")
 
@@ -389,13 +891,270 @@ def find_matches_from_buffer(
     return matched_data
 
 
-def summarize_feature_matches(segments, segment_matches, seg_id_col, edge_id_col, osm):
+def _assign_tiles(gdf, tile_size):
+
+    """
+    Assign each feature to a square grid tile based on the center of its bounding box.
+
+    Arguments:
+        gdf (geodataframe): features to be assigned to tiles
+        tile_size (numerical): the width and height of the tiles (in units of the crs)
+
+    Returns:
+        tile_ids (array): integer id of the tile each feature belongs to
+    """
+
+    if len(gdf) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    bounds = shapely.bounds(gdf.geometry.values)
+
+    center_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    center_y = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    col = np.floor((center_x - center_x.min()) / tile_size).astype(np.int64)
+    row = np.floor((center_y - center_y.min()) / tile_size).astype(np.int64)
+
+    tile_ids = row * (col.max() + 1) + col
+
+    return tile_ids
+
+
+def _get_tile_data(osm_data, reference_data, tile_ids, tile_id, dist):
+
+    """
+    Get the reference features in a tile and the osm features within the halo of the tile.
+    The halo is the bounding box of the reference features in the tile expanded by the buffer distance,
+    which means that the tile contains all osm features that can be matched to the reference features in the tile.
+
+    Arguments:
+        osm_data (gdf):
+        reference_data (gdf):
+        tile_ids (array): tile ids of the reference features (result from _assign_tiles())
+        tile_id (int): the tile to get data for
+        dist (numeric): max distance (meters) between potential matches
+
+    Returns:
+        tile_osm (gdf): osm features within the halo of the tile, in the same order as in osm_data
+        tile_ref (gdf): reference features in the tile
+    """
+
+    tile_ref = reference_data[tile_ids == tile_id]
+
+    minx, miny, maxx, maxy = tile_ref.total_bounds
+    halo = shapely.box(minx - dist, miny - dist, maxx + dist, maxy + dist)
+
+    # Keep the original order of osm features to resolve ties in the same way as for the full dataset
+    osm_pos = np.sort(osm_data.sindex.query(halo))
+    tile_osm = osm_data.iloc[osm_pos]
+
+    return tile_osm, tile_ref
+
+
+def match_tile(
+    osm_data,
+    reference_data,
+    ref_id_col,
+    osm_id_col,
+    dist,
+    angular_threshold,
+    hausdorff_threshold,
+    densify=None,
+    angle_method="first_segment",
+    max_ref_per_osm=None,
+):
+
+    """
+    Runs the buffer matching and finds the best matches for the data in one tile.
+
+    Arguments:
+        osm_data (gdf): osm segments in the tile (including the halo)
+        reference_data (gdf): reference segments in the tile
+        ref_id_col (str): name of column with unique edge id in reference data
+        osm_id_col (str): name of column with unique edge id in osm data
+        dist (numeric): max distance (meters) between potential matches
+        angular_threshold (numerical): Threshold for max angle between lines considered a match (in degrees)
+        hausdorff_threshold: Threshold for max Hausdorff distance between lines considered a match (in meters)
+        densify (numerical): if not None, vertices are added to the lines so no line segment is longer than densify (in meters) before the Hausdorff distance is computed
+        angle_method (str): method used to find the bearing of segments when computing angles between them (see get_bearings()).
+            Use 'first_segment' for the direction given by the first two vertices, as in earlier versions
+        max_ref_per_osm (int): max number of reference segments each osm segment can be matched to, e.g. 2 for cycle tracks mapped on both sides of the street in the reference data.
+            If given, the matches are assigned greedily from the smallest Hausdorff distance across all reference segments. If None (default), each reference segment is matched to its best match independently
+
+    Returns:
+        matched_data (geodataframe): segment matches for the reference segments in the tile
+    """
+
+    candidates = get_candidate_store(
+        osm_data=osm_data,
+        reference_data=reference_data,
+        dist=dist,
+        ref_id_col=ref_id_col,
+        osm_id_col=osm_id_col,
+    )
+
+    matched_data = find_matches_from_buffer(
+        buffer_matches=candidates,
+        osm_edges=osm_data,
+        reference_data=reference_data,
+        angular_threshold=angular_threshold,
+        hausdorff_threshold=hausdorff_threshold,
+        densify=densify,
+        angle_method=angle_method,
+        max_ref_per_osm=max_ref_per_osm,
+        osm_id_col=osm_id_col,
+    )
+
+    return matched_data
+
+
+def _match_tile_args(args):
+
+    """
+    Helper function for match_networks_tiled(). Unpacks arguments for match_tile() when run in a process pool,
+    and saves the result as a checkpoint if a checkpoint folder is given.
+    """
+
+    match_args, checkpoint_dir, name, key = args
+
+    matched_data = match_tile(*match_args)
+
+    if checkpoint_dir is not None:
+        cf.save_checkpoint(matched_data, checkpoint_dir, name, key)
+
+    return matched_data
+
+
+def match_networks_tiled(
+    osm_data,
+    reference_data,
+    ref_id_col,
+    osm_id_col,
+    dist,
+    angular_threshold=20,
+    hausdorff_threshold=12,
+    densify=None,
+    angle_method="first_segment",
+    max_ref_per_osm=None,
+    tile_size=10000,
+    processes=None,
+    tiles=None,
+    checkpoint_dir=None,
+):
+
+    """
+    Finds segment matches by splitting the data into square grid tiles and matching each tile separately, optionally in parallel.
+    Each reference segment belongs to exactly one tile, and each tile includes the osm segments within a halo of the size of the buffer distance.
+    The result is the same as running overlay_buffer() and find_matches_from_buffer() on the full dataset.
+
+    Arguments:
+        osm_data (gdf): osm segments
+        reference_data (gdf): reference segments
+        ref_id_col (str): name of column with unique edge id in reference data
+        osm_id_col (str): name of column with unique edge id in osm data
+        dist (numeric): max distance (meters) between potential matches
+        angular_threshold (numerical): Threshold for max angle between lines considered a match (in degrees)
+        hausdorff_threshold: Threshold for max Hausdorff distance between lines considered a match (in meters)
+        densify (numerical): if not None, vertices are added to the lines so no line segment is longer than densify (in meters) before the Hausdorff distance is computed
+        angle_method (str): method used to find the bearing of segments when computing angles between them (see get_bearings()).
+            Use 'first_segment' for the direction given by the first two vertices, as in earlier versions
+        max_ref_per_osm (int): max number of reference segments each osm segment can be matched to, e.g. 2 for cycle tracks mapped on both sides of the street in the reference data.
+            If given, the matches are assigned greedily from the smallest Hausdorff distance across all reference segments. If None (default), each reference segment is matched to its best match independently
+            The limit is applied within each tile, so osm segments in the halo of neighbouring tiles can exceed it at tile borders
+        tile_size (numerical): the width and height of the tiles (in units of the crs)
+        processes (int): number of processes to use. If None, all available cores are used. If 1, tiles are matched in the current process
+        tiles (list): ids of the tiles to match (e.g. for running a subset of tiles as a SLURM array task). If None, all tiles are matched
+        checkpoint_dir (str): folder for checkpoints of matched tiles. Tiles already matched with the same data and settings are loaded instead of matched again. If None, no checkpoints are used
+
+    Returns:
+        segment_matches (geodataframe): Reference data with additional columns specifying the index and ids of matched osm edges
+    """
+
+    assert osm_data.crs == reference_data.crs, "Data not in the same crs!"
+
+    tile_ids = _assign_tiles(reference_data, tile_size)
+
+    if tiles is None:
+        tiles = np.unique(tile_ids)
+
+    results = {}
+    tile_args = []
+    for tile_id in tiles:
+        tile_osm, tile_ref = _get_tile_data(
+            osm_data, reference_data, tile_ids, tile_id, dist
+        )
+        match_args = (
+            tile_osm,
+            tile_ref,
+            ref_id_col,
+            osm_id_col,
+            dist,
+            angular_threshold,
+            hausdorff_threshold,
+            densify,
+            angle_method,
+            max_ref_per_osm,
+        )
+
+        name = f"tile_{tile_id}"
+        key = None
+
+        if checkpoint_dir is not None:
+            key = cf.get_stage_key(name, dict(enumerate(match_args)))
+            found, result = cf.load_checkpoint(checkpoint_dir, name, key)
+            if found:
+                results[tile_id] = result
+                continue
+
+        tile_args.append((match_args, checkpoint_dir, name, key))
+
+    print(
+        f"Matching {len(tile_args)} tiles ({len(results)} loaded from checkpoints)..."
+    )
+
+    todo = [t for t in tiles if t not in results]
+
+    if processes == 1:
+        results.update(zip(todo, map(_match_tile_args, tile_args)))
+
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results.update(zip(todo, executor.map(_match_tile_args, tile_args)))
+
+    results = [results[t] for t in tiles]
+
+    if not results:
+        # No tiles with reference segments - return matches with the same columns as find_matches_from_buffer()
+        segment_matches = reference_data.iloc[:0].copy(deep=True)
+        segment_matches["matches_ix"] = np.empty(0, dtype=int)
+        segment_matches["matches_id"] = osm_data[osm_id_col].values[:0]
+
+        print("0 reference segments were matched to OSM edges")
+
+        return segment_matches
+
+    segment_matches = pd.concat(results)
+
+    # Remove duplicate matches deterministically and restore the order of the reference data
+    segment_matches = segment_matches[~segment_matches.index.duplicated(keep="first")]
+    ordered_ix = reference_data.index[reference_data.index.isin(segment_matches.index)]
+    segment_matches = segment_matches.loc[ordered_ix]
+
+    print(f"{len(segment_matches)} reference segments were matched to OSM edges")
+
+    return segment_matches
+
+
+def summarize_feature_matches(
+    segments, segment_matches, seg_id_col, edge_id_col, osm, threshold=0.5
+):
 
     """
     Determine whether a feature have been matched to a feature in the other dataset
     based on how big a share of the feature's segments have been matched.
-    If less than half of the length of a feature have been mapped, the match is considered incomplete.
-    If half or more is matched, it is considered fully matched.
+    If the share of the length of a feature that has been matched is not above the threshold, the match is considered incomplete.
+    If the matched share is above the threshold (by default more than half), it is considered fully matched.
+    Features where all segments have been matched are always considered fully matched.
 
     Arguments:
         segments (gdf): gdf with data segments
@@ -403,6 +1162,7 @@ def summarize_feature_matches(segments, segment_matches, seg_id_col, edge_id_col
         seg_id_col (str): column name with unique id of segments
         edge_id_col (str): column name with unique id of edges
         osm (boolean): whether segments are osm (True) or reference (False)
+        threshold (float): share of a feature's length that must be matched for the feature to be considered matched
 
     Returns:
         matched_ids (list): ids of features that have been consistently matched
@@ -410,56 +1170,45 @@ def summarize_feature_matches(segments, segment_matches, seg_id_col, edge_id_col
     """
 
     # Create column to do join on if segments are from OSM (reference data)
+    # The column is added to a new dataframe, so segment_matches is not changed
     if osm == True:
-        segment_matches[seg_id_col] = segment_matches["matches_id"]
+        matches = segment_matches[["matches_ix", "matches_id"]].assign(
+            **{seg_id_col: segment_matches["matches_id"]}
+        )
+    else:
+        matches = segment_matches
 
     # Create dataframe with new and old ids and information on matches
     merged = segments.merge(
-        segment_matches[[seg_id_col, "matches_ix", "matches_id"]],
+        matches[[seg_id_col, "matches_ix", "matches_id"]],
         how="left",
         on=seg_id_col,
     )
 
-    # org_ids = list( merged[edge_id_col].unique() )
-
-    org_ids = list(merged.loc[merged.matches_id.notna()][edge_id_col].unique())
-
-    matched_ids = []
-    undecided_ids = []
+    merged["matched"] = merged.matches_id.notna()
+    merged["length"] = merged.geometry.length
 
-    for i in org_ids:
+    # Only features with at least one matched segment are considered
+    org_ids = merged.loc[merged["matched"], edge_id_col].unique()
 
-        feature = merged.loc[merged[edge_id_col] == i].copy()
-
-        # First check if all segments belonging to the id have been matched
-        if len(feature.loc[feature.matches_id.isna()]) == 0:
-
-            # If yes, mark as matched
-            matched_ids.append(i)
-
-        elif len(feature.loc[feature.matches_id.isna()]) == len(feature):
-            continue
-
-        else:
-            # Set matched as either True or False and compute length
-            feature["length"] = feature.geometry.length
-            feature["matched"] = None
-
-            not_matched_ix = feature.loc[feature.matches_id.isna()].index
-            matched_ix = feature.loc[feature.matches_id.notna()].index
-            feature.loc[not_matched_ix, "matched"] = False
-            feature.loc[matched_ix, "matched"] = True
+    # Sum the matched and unmatched length of all features in one pass
+    summed = (
+        merged.groupby([edge_id_col, "matched"])["length"]
+        .sum()
+        .unstack(fill_value=0)
+        .reindex(columns=[False, True], fill_value=0)
+        .reindex(org_ids)
+    )
 
-            summed = feature.groupby("matched").agg({"length": "sum"})
+    unmatched_ids = merged.loc[~merged["matched"], edge_id_col].unique()
+    all_matched = ~summed.index.isin(unmatched_ids)
 
-            majority_value = summed["length"].idxmax()
+    majority_matched = summed[True] * (1 - threshold) > summed[False] * threshold
 
-            if majority_value == True:
-                matched_ids.append(i)
+    is_matched = all_matched | majority_matched.values
 
-            # compute majority value len - if less than some threshold and False, change to True
-            else:
-                undecided_ids.append(i)
+    matched_ids = list(summed.index.values[is_matched])
+    undecided_ids = list(summed.index.values[~is_matched])
 
     return matched_ids, undecided_ids
 
@@ -473,24 +1222,24 @@ def update_osm(osm_segments, osm_data, final_matches, attr, edge_id_col, seg_id_
         osm_segments (geodataframe): the osm_segments used in the matching process
         osm_data (geodataframe): original osm data to be updated
         final_matches (geodataframe): the result of the matching process
-        attr (str): name of column in final_matches data with attribute to be transfered to osm data
+        attr (str or list): name of column(s) in final_matches data with attribute(s) to be transfered to osm data
         edge_id_col(str): name of column in osm_data with unique id of all edges/features
         seg_id_col(str): name of column in osm_data with unique id of all segments
 
     Returns:
-        updated_osm (geodataframe): osm data with an additional column with attribute from reference data
+        updated_osm (geodataframe): osm data with additional columns with the attributes from reference data.
+            Only features with at least one matched attribute value are included.
     """
 
-    ids_attr_dict = _summarize_attribute_matches(
-        osm_segments, final_matches, edge_id_col, seg_id_col, attr
-    )
+    attrs = [attr] if isinstance(attr, str) else list(attr)
 
-    attr_df = pd.DataFrame.from_dict(ids_attr_dict, orient="index")
-    attr_df.reset_index(inplace=True)
-    attr_df.rename(columns={"index": edge_id_col, 0: attr}, inplace=True)
+    attr_df = _summarize_attribute_matches(
+        osm_segments, final_matches, edge_id_col, seg_id_col, attrs
+    )
     attr_df[edge_id_col] = attr_df[edge_id_col].astype(int)
 
-    osm_data["id_merge_col"] = osm_data[edge_id_col].astype(int)
+    # The merge column is added to a new dataframe, so osm_data is not changed
+    osm_data = osm_data.assign(id_merge_col=osm_data[edge_id_col].astype(int))
     assert len(osm_data) == len(osm_data.id_merge_col.unique())
 
     updated_osm = osm_data.merge(
@@ -507,61 +1256,291 @@ def update_osm(osm_segments, osm_data, final_matches, attr, edge_id_col, seg_id_
 
 
 def _summarize_attribute_matches(
-    osm_segments, segment_matches, edge_id_col, seg_id_col, attr
+    osm_segments, segment_matches, edge_id_col, seg_id_col, attrs
 ):
 
     """
-    Create a dictionary with the original feature ids and the attribute they have been matched to
+    Find the attribute values each original feature has been matched to.
+    If a feature's segments have been matched to different values, the value matched to the largest share of the feature's length is used.
+    All attributes are summarized in one pass.
 
     Arguments:
         osm_segments (geodataframe): osm_segments used in the analysis
         final_matches: reference_data with information about corresponding osm segments
-        attr (str): name of column in final_matches data with attribute to be transfered to osm data
+        attrs (list): names of columns in final_matches data with attributes to be transfered to osm data
 
-    Returns (dict): a dictionary with the original osmid as keys and the matched value as values
+    Returns (dataframe): a dataframe with the original edge ids and a column with the matched value for each attribute.
+        Features without any matched values are not included.
     """
 
     # Create dataframe with new and old ids and information on matches
-
-    segment_matches[seg_id_col] = segment_matches["matches_id"]
+    # The id column is added to a new dataframe, so segment_matches is not changed
+    matches = segment_matches[attrs + ["matches_id"]].assign(
+        **{seg_id_col: segment_matches["matches_id"]}
+    )
     osm_merged = osm_segments.merge(
-        segment_matches[[seg_id_col, attr, "matches_id"]],
+        matches[[seg_id_col] + attrs + ["matches_id"]],
         how="left",
         on=seg_id_col,
         suffixes=("", "_matched"),
     )
 
-    if attr in osm_segments.columns:
-        attr = attr + "_matched"
+    org_ids = osm_merged.loc[osm_merged.matches_id.notna(), edge_id_col].unique()
 
-    # org_ids = list( osm_merged[edge_id_col].unique() )
-    org_ids = list(osm_merged.loc[osm_merged.matches_id.notna()][edge_id_col].unique())
+    osm_merged = osm_merged.loc[osm_merged[edge_id_col].isin(org_ids)]
+    lengths = osm_merged.geometry.length
 
-    matched_attributes_dict = {}
+    matched_attributes = pd.DataFrame(index=pd.Index(org_ids, name=edge_id_col))
 
-    for i in org_ids:
+    for attr in attrs:
 
-        feature = osm_merged.loc[osm_merged[edge_id_col] == i].copy()
-        feature[attr] = feature[attr].fillna("none")
+        col = attr + "_matched" if attr in osm_segments.columns else attr
 
-        matched_values = feature[attr].unique()
+        values = osm_merged[col].astype(object).fillna("none")
 
-        # print('matched', matched_values, i)
+        # Length of each feature matched to each value
+        summed = (
+            pd.DataFrame(
+                {edge_id_col: osm_merged[edge_id_col], attr: values, "length": lengths}
+            )
+            .groupby([edge_id_col, attr])["length"]
+            .sum()
+            .reset_index()
+        )
 
-        if len(matched_values) == 1:
-            matched_attributes_dict[str(i)] = matched_values[0]
-            # print('match1') # OK
+        # Value with the largest length - ties go to the first value in sorted order
+        majority = summed.loc[summed.groupby(edge_id_col)["length"].idxmax()]
 
-        else:
-            feature["length"] = feature.geometry.length
-            summed = feature.groupby(attr).agg({"length": "sum"})
+        matched_attributes[attr] = majority.set_index(edge_id_col)[attr]
 
-            majority_value = summed["length"].idxmax()
+    matched_attributes = matched_attributes.replace("none", np.nan)
+    matched_attributes = matched_attributes.dropna(how="all").reset_index()
 
-            matched_attributes_dict[str(i)] = majority_value
+    return matched_attributes
 
-    matched_attributes_dict = {
-        key: val for key, val in matched_attributes_dict.items() if val != "none"
-    }
 
-    return matched_attributes_dict
+def get_feature_hashes(gdf, edge_id_col, cols=None):
+
+    """
+    Computes a hash of the geometry and attributes of each feature, used to find features that have changed between two versions of a dataset.
+
+    Arguments:
+        gdf (geodataframe): features to hash
+        edge_id_col (str): name of column with unique id of all features
+        cols (list): names of the attribute columns included in the hash. If None, all columns are included
+
+    Returns:
+        hashes (series): hash of each feature, indexed by the feature id
+    """
+
+    if cols is None:
+        cols = [c for c in gdf.columns if c not in [gdf.geometry.name, edge_id_col]]
+
+    data = pd.DataFrame(gdf[cols])
+
+    # Integer columns are read as floats from the database if a chunk has missing values, so all numbers are hashed as floats
+    for c in cols:
+        if pd.api.types.is_numeric_dtype(data[c]) and not pd.api.types.is_bool_dtype(data[c]):
+            data[c] = data[c].astype(float)
+
+    data["geometry_hash"] = pd.util.hash_array(
+        np.asarray(shapely.to_wkb(gdf.geometry.values), dtype=object)
+    )
+
+    try:
+        hashes = pd.util.hash_pandas_object(data, index=False).values
+    except TypeError:
+        # Columns with unhashable values (e.g. lists of osmids)
+        data[cols] = data[cols].astype(str)
+        hashes = pd.util.hash_pandas_object(data, index=False).values
+
+    return pd.Series(hashes, index=gdf[edge_id_col].values)
+
+
+def compare_feature_hashes(old_hashes, new_hashes):
+
+    """
+    Find features that have been added, removed or changed from the hashes of two versions of a dataset.
+    Hashes can be computed chunk by chunk, so the data does not have to be in memory at once.
+
+    Arguments:
+        old_hashes (series): hashes of the previous version of the data (result from get_feature_hashes())
+        new_hashes (series): hashes of the new version of the data
+
+    Returns:
+        changed_ids (array): ids of all added, removed and changed features
+    """
+
+    added = new_hashes.index.difference(old_hashes.index)
+    removed = old_hashes.index.difference(new_hashes.index)
+
+    common = new_hashes.index.intersection(old_hashes.index)
+    modified = common[new_hashes.loc[common].values != old_hashes.loc[common].values]
+
+    print(
+        f"{len(added)} features added, {len(removed)} features removed and {len(modified)} features changed"
+    )
+
+    changed_ids = added.append(removed).append(modified).values
+
+    return changed_ids
+
+
+def get_changed_features(old_data, new_data, edge_id_col, cols=None):
+
+    """
+    Find features that have been added, removed or changed (geometry or attributes) between two versions of a dataset.
+
+    Arguments:
+        old_data (geodataframe): previous version of the data
+        new_data (geodataframe): new version of the data
+        edge_id_col (str): name of column with unique id of all features
+        cols (list): names of the attribute columns to compare. If None, all columns are compared
+
+    Returns:
+        changed_ids (array): ids of all added, removed and changed features
+    """
+
+    old_hashes = get_feature_hashes(old_data, edge_id_col, cols)
+    new_hashes = get_feature_hashes(new_data, edge_id_col, cols)
+
+    changed_ids = compare_feature_hashes(old_hashes, new_hashes)
+
+    return changed_ids
+
+
+def update_segments(
+    old_segments, new_data, changed_ids, edge_id_col, seg_id_col, segment_func
+):
+
+    """
+    Update the segments of a dataset after some features have changed, without segmenting the unchanged features again.
+    Segments of unchanged features keep their segment id, so previous matches of these segments are still valid.
+    Segments of added and changed features get new segment ids larger than all previous ids.
+
+    Arguments:
+        old_segments (geodataframe): segments of the previous version of the data
+        new_data (geodataframe): new version of the data. Only the added and changed features are used, so it can be limited to these
+        changed_ids (array): ids of added, removed and changed features (result from get_changed_features() or compare_feature_hashes())
+        edge_id_col (str): name of column with unique id of all features
+        seg_id_col (str): name of column with unique id of all segments
+        segment_func (function): function creating segments (with ids in seg_id_col) from a geodataframe with features, e.g. a wrapper around create_segment_gdf()
+
+    Returns:
+        segments (geodataframe): segments of the new version of the data
+    """
+
+    # Removed features are in changed_ids, so their segments are not kept
+    kept_segments = old_segments.loc[~old_segments[edge_id_col].isin(changed_ids)]
+
+    new_segments = segment_func(new_data.loc[new_data[edge_id_col].isin(changed_ids)])
+
+    first_id = old_segments[seg_id_col].max() + 1 if len(old_segments) > 0 else 1000
+    new_segments[seg_id_col] = np.arange(first_id, first_id + len(new_segments))
+
+    segments = pd.concat([kept_segments, new_segments], ignore_index=True)
+
+    assert len(segments[seg_id_col].unique()) == len(segments)
+
+    print(
+        f"{len(kept_segments)} segments kept, {len(new_segments)} segments created for changed features"
+    )
+
+    return segments
+
+
+def rematch_changed(
+    osm_data,
+    reference_data,
+    old_matches,
+    changed_geoms,
+    ref_id_col,
+    osm_id_col,
+    dist,
+    angular_threshold=20,
+    hausdorff_threshold=12,
+    densify=None,
+    angle_method="first_segment",
+):
+
+    """
+    Update segment matches from a previous run after some features in the osm and/or reference data have changed.
+    Only reference segments within the buffer distance of a changed feature can get a different set of potential matches,
+    so only these are matched again - all other reference segments keep their previous match.
+    Segment ids must be stable between the runs (see update_segments()).
+    Each reference segment is matched independently (as in find_matches_from_buffer() without max_ref_per_osm), since a global assignment can not be updated locally.
+
+    Arguments:
+        osm_data (gdf): new osm segments
+        reference_data (gdf): new reference segments
+        old_matches (geodataframe): segment matches from the previous run (result from find_matches_from_buffer())
+        changed_geoms (array of Shapely geometries): previous and new geometries of all added, removed and changed features in both datasets
+        ref_id_col (str): name of column with unique edge id in reference data
+        osm_id_col (str): name of column with unique edge id in osm data
+        dist (numeric): max distance (meters) between potential matches
+        angular_threshold (numerical): Threshold for max angle between lines considered a match (in degrees)
+        hausdorff_threshold: Threshold for max Hausdorff distance between lines considered a match (in meters)
+        densify (numerical): if not None, vertices are added to the lines so no line segment is longer than densify (in meters) before the Hausdorff distance is computed
+        angle_method (str): method used to find the bearing of segments when computing angles between them (see get_bearings())
+
+    Returns:
+        segment_matches (geodataframe): Reference data with additional columns specifying the index and ids of matched osm edges
+    """
+
+    assert osm_data.crs == reference_data.crs, "Data not in the same crs!"
+
+    # Reference segments with potential matches among changed features
+    _, ref_pos = reference_data.sindex.query(
+        np.asarray(changed_geoms), predicate="dwithin", distance=dist
+    )
+    affected = np.zeros(len(reference_data), dtype=bool)
+    affected[ref_pos] = True
+
+    print(f"Matching {affected.sum()} of {len(reference_data)} reference segments again...")
+
+    # Keep previous matches of unaffected segments if both segments still exist
+    old_osm_ids = old_matches.set_index(ref_id_col)["matches_id"]
+    kept_osm_ids = reference_data[ref_id_col].map(old_osm_ids)
+
+    keep = (
+        ~affected
+        & kept_osm_ids.notna().values
+        & kept_osm_ids.isin(osm_data[osm_id_col]).values
+    )
+
+    kept_matches = reference_data.loc[keep].copy(deep=True)
+    kept_osm_ids = kept_osm_ids[keep].astype(osm_data[osm_id_col].dtype)
+
+    osm_pos = pd.Index(osm_data[osm_id_col]).get_indexer(kept_osm_ids.values)
+    kept_matches["matches_ix"] = osm_data.index.values[osm_pos].astype(int)
+    kept_matches["matches_id"] = kept_osm_ids.values
+
+    # Match affected segments again
+    affected_ref = reference_data.loc[affected]
+
+    candidates = get_candidate_store(
+        osm_data=osm_data,
+        reference_data=affected_ref,
+        dist=dist,
+        ref_id_col=ref_id_col,
+        osm_id_col=osm_id_col,
+    )
+
+    new_matches = find_matches_from_buffer(
+        buffer_matches=candidates,
+        osm_edges=osm_data,
+        reference_data=affected_ref,
+        angular_threshold=angular_threshold,
+        hausdorff_threshold=hausdorff_threshold,
+        densify=densify,
+        angle_method=angle_method,
+        osm_id_col=osm_id_col,
+    )
+
+    # Merge and restore the order of the reference data
+    segment_matches = pd.concat([kept_matches, new_matches])
+    segment_matches = segment_matches.loc[
+        reference_data.index[reference_data.index.isin(segment_matches.index)]
+    ]
+
+    return segment_matches
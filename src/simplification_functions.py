@@ -6,10 +6,14 @@ multidigraph to a graph.
 """
 
 
-import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 import shapely
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 from shapely.geometry import LineString
 from shapely.geometry import Point
 import networkx as nx
@@ -287,29 +291,29 @@ def get_undirected(G, attributes=None):
 
     # the previous operation added all directed edges from G as undirected
     # edges in H. we now have duplicate edges for every bidirectional parallel
-    # edge or self-loop. so, look through the edges and remove any duplicates.
-    duplicate_edges = set()
-    for u1, v1, key1, data1 in H.edges(keys=True, data=True):
+    # edge or self-loop. so, look through the parallel edges and remove any
+    # duplicates: edges with the same osmid, geometry and selected attributes
+    # as an edge before them
+    edges = list(H.edges(keys=True, data=True))
+    parallel = _get_uvk(H, edges)[["a", "b"]]
+    parallel = parallel[parallel.duplicated(keep=False).to_numpy()].copy()
+    data = [edges[i][3] for i in parallel.index]
 
-        # if we haven't already flagged this edge as a duplicate
-        if (u1, v1, key1) not in duplicate_edges:
-
-            # look at every other edge between u and v, one at a time
-            for key2 in H[u1][v1]:
-
-                # don't compare this edge to itself
-                if key1 != key2:
+    # if either edge's osmid contains multiple values (due to simplification)
+    # compare them as sets to see if they contain the same values
+    parallel["osmid"] = _get_codes([frozenset(d["osmid"]) if isinstance(d["osmid"], list)
+                                    else d["osmid"] for d in data])
+    parallel["geometry"] = _get_geometry_keys([d.get("geometry") for d in data])
+    if attributes is not None:
+        parallel["attributes"] = _get_attribute_keys(data, attributes)
 
-                    # compare the first edge's data to the second's
-                    # if they match up, flag the duplicate for removal
-                    data2 = H.edges[u1, v1, key2]
-                    if _is_duplicate_edge(data1, data2, attributes=attributes):
-                        duplicate_edges.add((u1, v1, key2))
+    duplicates = parallel.index[parallel.duplicated(keep="first").to_numpy()]
+    duplicate_edges = set([edges[i][:3] for i in duplicates])
 
     H.remove_edges_from(duplicate_edges)
     return H
 
-# Same function
+# Modified function
 def _update_edge_keys(G):
     """
     Increment key of one edge of parallel edges that differ in geometry.
@@ -331,25 +335,29 @@ def _update_edge_keys(G):
     # identify all the edges that are duplicates based on a sorted combination
     # of their origin, destination, and key. that is, edge uv will match edge vu
     # as a duplicate, but only if they have the same key
-    edges = graph_to_gdfs(G, nodes=False, fill_edge_geometry=False)
-    edges["uvk"] = ["_".join(sorted([str(u), str(v)]) + [str(k)]) for u, v, k in edges.index]
-    mask = edges["uvk"].duplicated(keep=False)
-    dupes = edges[mask].dropna(subset=["geometry"])
-
-    different_streets = []
-    groups = dupes[["geometry", "uvk"]].groupby("uvk")
-
-    # for each group of duplicate edges
-    for _, group in groups:
-
-        # for each pair of edges within this group
-        for geom1, geom2 in itertools.combinations(group["geometry"], 2):
-
-            # if they don't have the same geometry, flag them as different
-            # streets: flag edge uvk, but not edge vuk, otherwise we would
-            # increment both their keys and they'll still duplicate each other
-            if not _is_same_geometry(geom1, geom2):
-                different_streets.append(group.index[0])
+    edges = list(G.edges(keys=True, data=True))
+    uvk = _get_uvk(G, edges)
+    mask = uvk.duplicated(keep=False).to_numpy()
+    has_geometry = np.array([d.get("geometry") is not None for _, _, _, d in edges], dtype=bool)
+    dupes = uvk[mask & has_geometry].copy()
+
+    # the geometries of the duplicates as integer keys, equal if the
+    # geometries are the same in either direction
+    dupes["geometry"] = _get_geometry_keys([edges[i][3]["geometry"] for i in dupes.index])
+
+    # flag the first edge of each group of duplicates with different
+    # geometries as a different street: flag edge uvk, but not edge vuk,
+    # otherwise we would increment both their keys and they'll still
+    # duplicate each other
+    groups = dupes.groupby(["a", "b", "k"], sort=False)["geometry"]
+    different = dupes[groups.transform("nunique").to_numpy() > 1]
+    first = different.groupby(["a", "b", "k"], sort=False).head(1).index
+
+    # in the same order as the groups of string keys "u_v_k" were visited
+    different_streets = sorted(
+        [edges[i][:3] for i in first],
+        key=lambda e: "_".join(sorted([str(e[0]), str(e[1])]) + [str(e[2])]),
+    )
 
     # for each unique different street, increment its key to make it unique
     for u, v, k in set(different_streets):
@@ -359,6 +367,96 @@ def _update_edge_keys(G):
 
     return G
 
+# New function
+def _get_uvk(G, edges):
+    """
+    Get the position of the first and last node (sorted) and the key of
+    edges as integers, so that edge uvk and edge vuk are equal.
+
+    Parameters
+    ----------
+    G : networkx.MultiDiGraph or networkx.MultiGraph
+        input graph
+    edges : list
+        (u, v, key, data) of the edges
+
+    Returns
+    -------
+    pandas.DataFrame
+        columns a, b and k, with one row for each edge
+    """
+    position = {n: i for i, n in enumerate(G.nodes)}
+    u = np.array([position[e[0]] for e in edges], dtype=np.int64)
+    v = np.array([position[e[1]] for e in edges], dtype=np.int64)
+    k, _ = pd.factorize(pd.Series([e[2] for e in edges], dtype=object))
+
+    return pd.DataFrame({"a": np.minimum(u, v), "b": np.maximum(u, v), "k": k})
+
+
+# New function
+def _get_geometry_keys(geometries):
+    """
+    Encode LineString geometries as integers, so that two geometries get the
+    same key if they have the same coordinates in either direction, like
+    _is_same_geometry. Missing geometries all get the key -1.
+
+    Each geometry is turned into its canonical orientation, the one of the
+    two directions with the smallest coordinates, and the WKB of the
+    canonical geometries is factorized.
+
+    Parameters
+    ----------
+    geometries : list
+        shapely LineStrings or None
+
+    Returns
+    -------
+    keys : numpy.ndarray
+    """
+    geometries = np.array(list(geometries) + [None], dtype=object)[:-1]
+    keys = np.full(len(geometries), -1, dtype=np.int64)
+
+    has_geometry = np.array([g is not None for g in geometries], dtype=bool)
+    geometries = geometries[has_geometry]
+    if not len(geometries):
+        return keys
+
+    # like _is_same_geometry, only x and y are compared. -0.0 is equal to 0.0,
+    # but not in WKB
+    coords, index = shapely.get_coordinates(geometries, return_index=True)
+    coords = coords + 0.0
+
+    counts = np.bincount(index, minlength=len(geometries))
+    start = np.cumsum(counts) - counts
+    end = start + counts - 1
+
+    # reverse the geometry if its last point is smaller than its first point
+    valid = counts > 1
+    first = coords[np.where(valid, start, 0)]
+    last = coords[np.where(valid, end, 0)]
+    reverse = valid & ((last[:, 0] < first[:, 0])
+                       | ((last[:, 0] == first[:, 0]) & (last[:, 1] < first[:, 1])))
+
+    # if the first and last points are the same (rings), compare all points
+    for i in np.flatnonzero(valid & (first == last).all(axis=1)):
+        forward = [tuple(c) for c in coords[start[i]:end[i] + 1]]
+        reverse[i] = forward[::-1] < forward
+
+    position = np.arange(len(coords))
+    position = np.where(reverse[index], start[index] + end[index] - position, position)
+    canonical = coords[position]
+
+    # geometries with less than two points can not be made into LineStrings
+    wkb = np.empty(len(geometries), dtype=object)
+    wkb[valid] = shapely.to_wkb(
+        shapely.linestrings(canonical[valid[index]], indices=index[valid[index]])
+    )
+    wkb[~valid] = shapely.to_wkb(geometries[~valid])
+
+    keys[has_geometry], _ = pd.factorize(wkb)
+    return keys
+
+
 # Same function
 def graph_to_gdfs(G, nodes=True, edges=True, node_geometry=True,
                   fill_edge_geometry=True):
@@ -454,7 +552,7 @@ def graph_to_gdfs(G, nodes=True, edges=True, node_geometry=True,
         raise ValueError("you must request nodes or edges or both")
 
 # Modified function
-def _is_duplicate_edge(data1, data2, attributes=None):
+def _is_duplicate_edge(data1, data2, attributes=None, attribute_keys=None):
     """
     Check if two graph edge data dicts have the same osmid and geometry.
 
@@ -464,6 +562,11 @@ def _is_duplicate_edge(data1, data2, attributes=None):
         the first edge's data
     data2 : dict
         the second edge's data
+    attributes : list
+        key of the attributes we should discriminate
+    attribute_keys : tuple
+        attribute keys of the two edges, from _get_edge_attribute_keys. If
+        given, the keys are compared instead of the values of the attributes
 
     Returns
     -------
@@ -495,6 +598,9 @@ def _is_duplicate_edge(data1, data2, attributes=None):
 
         if attributes is None:
             pass
+        elif attribute_keys is not None:
+            if attribute_keys[0] != attribute_keys[1]:
+                is_dupe = False
         elif isinstance(attributes, list):
             for attr in attributes:
                 if data1[attr] != data2[attr]:
@@ -537,7 +643,8 @@ def _is_same_geometry(ls1, ls2):
 
 
 # Modified function
-def simplify_graph(G, attributes=None, strict=True, remove_rings=True):
+def simplify_graph(G, attributes=None, strict=True, remove_rings=True,
+                   pinned=None):
     """
     Simplify a graph's topology by removing interstitial nodes.
 
@@ -560,6 +667,9 @@ def simplify_graph(G, attributes=None, strict=True, remove_rings=True):
         have multiple OSM IDs within them too.
     remove_rings : bool
         if True, remove isolated self-contained rings that have no endpoints
+    pinned : set
+        nodes that are always endpoints, e.g. the nodes of edges cut when
+        splitting the graph into tiles
 
     Returns
     -------
@@ -580,7 +690,7 @@ def simplify_graph(G, attributes=None, strict=True, remove_rings=True):
 
     # generate each path that needs to be simplified
     for path in _get_paths_to_simplify(G, attributes=attributes,
-                                       strict=strict):
+                                       strict=strict, pinned=pinned):
 
         # add the interstitial edges we're removing to a list so we can retain
         # their spatial geometry
@@ -640,10 +750,12 @@ def simplify_graph(G, attributes=None, strict=True, remove_rings=True):
     if remove_rings:
         # remove any connected components that form a self-contained ring
         # without any endpoints
+        if pinned is None:
+            pinned = set()
         wccs = nx.weakly_connected_components(G)
         nodes_in_rings = set()
         for wcc in wccs:
-            if not any(_is_endpoint(G, n) for n in wcc):
+            if not any(n in pinned or _is_endpoint(G, n) for n in wcc):
                 nodes_in_rings.update(wcc)
         G.remove_nodes_from(nodes_in_rings)
 
@@ -653,12 +765,16 @@ def simplify_graph(G, attributes=None, strict=True, remove_rings=True):
 
 
 # Modified function
-def _get_paths_to_simplify(G, attributes=None, strict=True):
+def _get_paths_to_simplify(G, attributes=None, strict=True, nodes=None,
+                           pinned=None):
     """
     Generate all the paths to be simplified between endpoint nodes.
 
     The path is ordered from the first endpoint, through the interstitial
-    nodes, to the second endpoint.
+    nodes, to the second endpoint. Paths are generated one at a time, and
+    since a path never leaves its weakly connected component, the paths of
+    a graph can be split between workers by component (see
+    _get_component_shards).
 
     Parameters
     ----------
@@ -669,19 +785,42 @@ def _get_paths_to_simplify(G, attributes=None, strict=True):
     strict : bool
         if False, allow nodes to be end points even if they fail all other
         rules but have edges with different OSM IDs
+    nodes : list
+        if not None, only the paths of the weakly connected components made
+        of these nodes are generated. The nodes must be whole components
+    pinned : set
+        nodes that are always endpoints, e.g. the nodes of edges cut when
+        splitting the graph into tiles
 
     Yields
     ------
     path_to_simplify : list
     """
+    if nodes is None:
+        nodes = G.nodes
+        H = G
+    else:
+        H = G.subgraph(nodes)
+
+    # encode the attributes of every edge once, so that the endpoint check
+    # compares one integer per pair of edges
+    attribute_keys = None
+    if attributes is not None:
+        attribute_keys = _get_edge_attribute_keys(H, attributes)
+
+    if pinned is None:
+        pinned = set()
+
     # first identify all the nodes that are endpoints
-    endpoints = set([n for n in G.nodes if _is_endpoint(G, n,
-                                                        attributes=attributes,
-                                                        strict=strict)])
+    endpoints = set([n for n in nodes if n in pinned or _is_endpoint(G, n,
+                                                                     attributes=attributes,
+                                                                     strict=strict,
+                                                                     attribute_keys=attribute_keys)])
 
     # for each endpoint node, look at each of its successor nodes
+    adjacency = G.succ
     for endpoint in endpoints:
-        for successor in G.successors(endpoint):
+        for successor in adjacency[endpoint]:
             if successor not in endpoints:
                 # if endpoint node's successor is not an endpoint, build path
                 # from the endpoint node, through the successor, and on to the
@@ -689,7 +828,7 @@ def _get_paths_to_simplify(G, attributes=None, strict=True):
                 yield _build_path(G, endpoint, successor, endpoints)
 
 # Modified function
-def _is_endpoint(G, node, attributes=None, strict=True):
+def _is_endpoint(G, node, attributes=None, strict=True, attribute_keys=None):
     """
     Is node a true endpoint of an edge.
 
@@ -716,6 +855,10 @@ def _is_endpoint(G, node, attributes=None, strict=True):
     strict : bool
         if False, allow nodes to be end points even if they fail all other
         rules but have edges with different OSM IDs
+    attribute_keys : dict
+        attribute key of each edge by (u, v, key), from
+        _get_edge_attribute_keys. If given, the keys are compared instead of
+        the values of the attributes
 
     Returns
     -------
@@ -770,6 +913,12 @@ def _is_endpoint(G, node, attributes=None, strict=True):
     else:
         if attributes is None:
             return False
+        elif attribute_keys is not None:
+            for pre in list(G.predecessors(node)):
+                for suc in list(G.successors(node)):
+                    if attribute_keys[pre, node, 0] != attribute_keys[node, suc, 0]:
+                        return True
+            return False
         else:
             if isinstance(attributes, list):
                 for attr in attributes:
@@ -790,7 +939,7 @@ def _is_endpoint(G, node, attributes=None, strict=True):
                             return True
             return False
 
-# Same function
+# Modified function
 def _build_path(G, endpoint, endpoint_successor, endpoints):
     """
     Build a path of nodes from one endpoint node to next endpoint node.
@@ -815,22 +964,27 @@ def _build_path(G, endpoint, endpoint_successor, endpoints):
         subsequently
     """
     # start building path from endpoint node through its successor
+    # the nodes of the path are also kept in a set, so that checking whether
+    # a node is in the path does not get slower as the path grows
     path = [endpoint, endpoint_successor]
+    in_path = {endpoint, endpoint_successor}
 
     # for each successor of the endpoint's successor
     for successor in G.successors(endpoint_successor):
-        if successor not in path:
+        if successor not in in_path:
             # if this successor is already in the path, ignore it, otherwise
             # add it to the path
             path.append(successor)
+            in_path.add(successor)
             while successor not in endpoints:
                 # find successors (of current successor) not in path
-                successors = [n for n in G.successors(successor) if n not in path]
+                successors = [n for n in G.successors(successor) if n not in in_path]
 
                 # 99%+ of the time there will be only 1 successor: add to path
                 if len(successors) == 1:
                     successor = successors[0]
                     path.append(successor)
+                    in_path.add(successor)
 
                 # handle relatively rare cases or OSM digitization quirks
                 elif len(successors) == 0:
@@ -857,9 +1011,719 @@ def _build_path(G, endpoint, endpoint_successor, endpoints):
     return path
 
 
+# New function
+def _get_component_shards(G, n_shards):
+    """
+    Split the nodes of a graph into shards of whole weakly connected
+    components, to generate the paths to simplify of each shard separately.
+
+    The largest components are placed first, each in the shard with the
+    fewest nodes so far.
+
+    Parameters
+    ----------
+    G : networkx.MultiDiGraph
+        input graph
+    n_shards : int
+        number of shards
+
+    Returns
+    -------
+    shards : list
+        list of lists of nodes. Empty shards are left out
+    """
+    components = sorted(nx.weakly_connected_components(G), key=len, reverse=True)
+
+    shards = [[] for _ in range(n_shards)]
+    for component in components:
+        min(shards, key=len).extend(component)
+
+    return [shard for shard in shards if shard]
+
+
+# New function
+def _get_graph_arrays(G):
+    """
+    Get the nodes, edges and successors of a graph as arrays, in the same
+    order as they are iterated in networkx.
+
+    Parameters
+    ----------
+    G : networkx.MultiDiGraph
+        input graph
+
+    Returns
+    -------
+    nodes : list
+        node ids, in the order of G.nodes
+    eu : numpy.ndarray
+        position in nodes of the origin of each edge
+    ev : numpy.ndarray
+        position in nodes of the destination of each edge
+    ek : list
+        key of each edge
+    edge_data : list
+        data dict of each edge
+    succ_ptr : list
+        start of the successors of each node in succ (CSR format)
+    succ : list
+        position in nodes of the distinct successors of each node, in the
+        order of G.successors
+    """
+    nodes = list(G.nodes)
+    position = {n: i for i, n in enumerate(nodes)}
+
+    eu, ev, ek, edge_data = [], [], [], []
+    succ_ptr, succ = [0], []
+
+    for u, nbrs in G.adjacency():
+        pu = position[u]
+        for v, keydict in nbrs.items():
+            pv = position[v]
+            succ.append(pv)
+            for k, d in keydict.items():
+                eu.append(pu)
+                ev.append(pv)
+                ek.append(k)
+                edge_data.append(d)
+        succ_ptr.append(len(succ))
+
+    return (nodes, np.array(eu, dtype=np.int64), np.array(ev, dtype=np.int64),
+            ek, edge_data, succ_ptr, succ)
+
+
+# New function
+def _get_codes(values):
+    """
+    Encode values as integers, so that two values get the same code if they
+    are equal (==). Lists are compared as tuples, and NaN values are never
+    equal to anything, like in Python.
+
+    Parameters
+    ----------
+    values : list
+        values to encode
+
+    Returns
+    -------
+    codes : numpy.ndarray
+    """
+    if any(isinstance(v, (list, tuple)) for v in values):
+        # factorize finds NaN values inside tuples equal, but Python finds
+        # them equal only if they are the same object, so lists and tuples
+        # are encoded with a dict instead
+        codes = np.empty(len(values), dtype=np.int64)
+        seen = {}
+        n_nan = 0
+        for i, v in enumerate(values):
+            if isinstance(v, float) and v != v:
+                n_nan += 1
+                codes[i] = -n_nan
+            else:
+                codes[i] = seen.setdefault(tuple(v) if isinstance(v, list) else v, len(seen))
+        return codes
+
+    values = np.array(values + [None], dtype=object)[:-1]
+    codes, _ = pd.factorize(values)
+
+    # factorize gives all missing values the code -1. None is equal to None,
+    # but NaN is not equal to anything
+    missing = np.flatnonzero(codes == -1)
+    if len(missing):
+        is_none = np.array([values[i] is None for i in missing], dtype=bool)
+        codes[missing[is_none]] = codes.max() + 1
+        codes[missing[~is_none]] = -1 - np.arange((~is_none).sum())
+
+    return codes
+
+
+# New function
+def _get_attribute_keys(edge_data, attributes):
+    """
+    Encode the values of several attributes of each edge as one integer key,
+    so that two edges get the same key if all their values are equal.
+
+    Every attribute is encoded once with _get_codes, and the codes of the
+    attributes are packed together attribute by attribute. Comparing two
+    edges is then a single integer comparison instead of one comparison of
+    Python values per attribute.
+
+    Parameters
+    ----------
+    edge_data : list
+        data dict of each edge
+    attributes : list
+        key of the attributes we should discriminate
+
+    Returns
+    -------
+    keys : numpy.ndarray
+    """
+    if not isinstance(attributes, list):
+        attributes = [attributes]
+
+    keys = np.zeros(len(edge_data), dtype=np.int64)
+    if not len(edge_data):
+        return keys
+
+    for attr in attributes:
+        codes = _get_codes([data[attr] for data in edge_data])
+        # NaN values have unique negative codes, shift all codes to >= 0
+        codes = codes - codes.min()
+        # keys and codes are both smaller than the number of edges (or twice
+        # that with NaN values), so the packed key does not overflow
+        keys, _ = pd.factorize(keys * (codes.max() + 1) + codes)
+
+    return keys.astype(np.int64)
+
+
+# New function
+def _get_edge_attribute_keys(G, attributes):
+    """
+    Get the attribute key of every edge of a graph, see _get_attribute_keys.
+
+    Parameters
+    ----------
+    G : networkx.MultiDiGraph or networkx.MultiGraph
+        input graph
+    attributes : list
+        key of the attributes we should discriminate
+
+    Returns
+    -------
+    dict
+        attribute key of each edge, by (u, v, key)
+    """
+    edges = list(G.edges(keys=True, data=True))
+    keys = _get_attribute_keys([data for _, _, _, data in edges], attributes)
+    return dict(zip([(u, v, k) for u, v, k, _ in edges], keys.tolist()))
+
+
+# New function
+def _has_different_values(n_nodes, node, codes):
+    """Check for each node whether it has more than one distinct code."""
+    # compare all codes of a node with one of them
+    first = np.zeros(n_nodes, dtype=np.int64)
+    first[node] = codes
+
+    different = np.zeros(n_nodes, dtype=bool)
+    different[node[codes != first[node]]] = True
+
+    return different
+
+
+# New function
+def _get_endpoint_mask(n_nodes, eu, ev, ek=None, edge_data=None,
+                       attributes=None, strict=True):
+    """
+    Vectorized version of _is_endpoint for all nodes of a graph at once.
+
+    Parameters
+    ----------
+    n_nodes : int
+        number of nodes
+    eu, ev : numpy.ndarray
+        position of the origin and destination of each edge
+    ek : list
+        key of each edge. Only needed if attributes is not None
+    edge_data : list
+        data dict of each edge. Only needed if strict is False or attributes
+        is not None
+    attributes : list
+        key of the attributes we should discriminate
+    strict : bool
+        if False, allow nodes to be end points even if they fail all other
+        rules but have edges with different OSM IDs
+
+    Returns
+    -------
+    endpoints : numpy.ndarray
+        boolean mask of the nodes that are endpoints
+    """
+    out_degree = np.bincount(eu, minlength=n_nodes)
+    in_degree = np.bincount(ev, minlength=n_nodes)
+    degree = out_degree + in_degree
+
+    # number of distinct neighbors, in both directions
+    pairs = np.unique(np.concatenate([eu, ev]) * n_nodes + np.concatenate([ev, eu]))
+    n_neighbors = np.bincount(pairs // n_nodes, minlength=n_nodes)
+
+    # rule 1
+    endpoints = np.zeros(n_nodes, dtype=bool)
+    endpoints[eu[eu == ev]] = True
+
+    # rule 2
+    endpoints |= (out_degree == 0) | (in_degree == 0)
+
+    # rule 3
+    endpoints |= ~((n_neighbors == 2) & ((degree == 2) | (degree == 4)))
+
+    candidates = ~endpoints
+
+    # rule 4
+    if not strict:
+        in_idx = np.flatnonzero(candidates[ev])
+        out_idx = np.flatnonzero(candidates[eu])
+        idx = np.concatenate([in_idx, out_idx])
+        node = np.concatenate([ev[in_idx], eu[out_idx]])
+        codes = _get_codes([edge_data[i]["osmid"] for i in idx])
+        endpoints |= _has_different_values(n_nodes, node, codes)
+
+    # rule 5
+    elif attributes is not None:
+        # only edges with key 0 are compared
+        is_key_0 = np.array([k == 0 for k in ek], dtype=bool)
+        in_idx = np.flatnonzero(candidates[ev] & is_key_0)
+        out_idx = np.flatnonzero(candidates[eu] & is_key_0)
+
+        # every predecessor and successor of a candidate must have an edge
+        # with key 0, like G.edges[pre, node, 0] in _is_endpoint
+        n_pred = np.bincount(np.unique(ev * n_nodes + eu) // n_nodes, minlength=n_nodes)
+        n_succ = np.bincount(np.unique(eu * n_nodes + ev) // n_nodes, minlength=n_nodes)
+        missing = candidates & (
+            (np.bincount(ev[in_idx], minlength=n_nodes) != n_pred)
+            | (np.bincount(eu[out_idx], minlength=n_nodes) != n_succ)
+        )
+        if missing.any():
+            raise KeyError(f"Edge with key 0 missing at node position {np.flatnonzero(missing)[0]}")
+
+        idx = np.concatenate([in_idx, out_idx])
+        node = np.concatenate([ev[in_idx], eu[out_idx]])
+        keys = _get_attribute_keys([edge_data[i] for i in idx], attributes)
+        endpoints |= _has_different_values(n_nodes, node, keys)
+
+    return endpoints
+
+
+# New function
+def _walk_path(succ_ptr, succ, is_endpoint, endpoint, endpoint_successor, nodes):
+    """
+    Same as _build_path, but on the successor arrays from _get_graph_arrays.
+    Nodes are given by their positions in nodes.
+    """
+    path = [endpoint, endpoint_successor]
+    in_path = {endpoint, endpoint_successor}
+
+    for successor in succ[succ_ptr[endpoint_successor]:succ_ptr[endpoint_successor + 1]]:
+        if successor not in in_path:
+            path.append(successor)
+            in_path.add(successor)
+            while not is_endpoint[successor]:
+                successors = [n for n in succ[succ_ptr[successor]:succ_ptr[successor + 1]]
+                              if n not in in_path]
+
+                if len(successors) == 1:
+                    successor = successors[0]
+                    path.append(successor)
+                    in_path.add(successor)
+
+                elif len(successors) == 0:
+                    if endpoint in succ[succ_ptr[successor]:succ_ptr[successor + 1]]:
+                        # end of a self-looping edge
+                        return path + [endpoint]
+                    else:  # pragma: no cover
+                        return path
+                else:  # pragma: no cover
+                    raise Exception(f"Unexpected simplify pattern failed near {nodes[successor]}")
+
+            return path
+
+    return path
+
+
+# New function
+def simplify_graph_arrays(G, attributes=None, strict=True, remove_rings=True,
+                          pinned=None):
+    """
+    Same as simplify_graph, but the graph is simplified on arrays instead of
+    node by node in networkx.
+
+    Endpoints are found for all nodes at once from the degrees of the nodes
+    and integer codes of the edge attributes, paths are walked on the
+    successors stored in CSR format, and the simplified graph is built once
+    instead of modifying a copy of the input graph. The result is identical to
+    simplify_graph: same nodes, edges, keys, attributes and geometries, in
+    the same order.
+
+    Parameters
+    ----------
+    G : networkx.MultiDiGraph
+        input graph
+    attributes : list
+        key of the attributes we should discriminate
+    strict : bool
+        if False, allow nodes to be end points even if they fail all other
+        rules but have incident edges with different OSM IDs. Lets you keep
+        nodes at elbow two-way intersections, but sometimes individual blocks
+        have multiple OSM IDs within them too.
+    remove_rings : bool
+        if True, remove isolated self-contained rings that have no endpoints
+    pinned : set
+        nodes that are always endpoints, e.g. the nodes of edges cut when
+        splitting the graph into tiles
+
+    Returns
+    -------
+    H : networkx.MultiDiGraph
+        topologically simplified graph, with a new `geometry` attribute on
+        each simplified edge
+    """
+    if "simplified" in G.graph and G.graph["simplified"]:
+        raise Exception("This graph has already been simplified, cannot simplify it again.")
+
+    # define edge segment attributes to sum upon edge simplification
+    attrs_to_sum = {"length", "travel_time"}
+
+    nodes, eu, ev, ek, edge_data, succ_ptr, succ = _get_graph_arrays(G)
+    n_nodes = len(nodes)
+
+    position = {n: i for i, n in enumerate(nodes)}
+    pinned_mask = np.zeros(n_nodes, dtype=bool)
+    if pinned is not None:
+        pinned_mask[[position[n] for n in pinned]] = True
+
+    endpoint_mask = _get_endpoint_mask(n_nodes, eu, ev, ek, edge_data,
+                                       attributes=attributes, strict=strict)
+    endpoint_mask |= pinned_mask
+    is_endpoint = endpoint_mask.tolist()
+
+    # the endpoints are visited in the same order as in _get_paths_to_simplify
+    endpoints = set([nodes[i] for i in np.flatnonzero(endpoint_mask)])
+
+    paths = []
+    for endpoint in endpoints:
+        e = position[endpoint]
+        for successor in succ[succ_ptr[e]:succ_ptr[e + 1]]:
+            if not is_endpoint[successor]:
+                paths.append(_walk_path(succ_ptr, succ, is_endpoint, e, successor, nodes))
+
+    # edges with key 0, used for the attributes of the simplified edges
+    edge_0 = {(u, v): i for i, (u, v, k) in enumerate(zip(eu.tolist(), ev.tolist(), ek)) if k == 0}
+
+    removed = np.zeros(n_nodes, dtype=bool)
+    new_u, new_v, new_attributes = [], [], []
+
+    for path in paths:
+        path_attributes = dict()
+        for u, v in zip(path[:-1], path[1:]):
+            edge = edge_0.get((u, v))
+            if edge is None:
+                raise KeyError((nodes[u], nodes[v], 0))
+            edge_data_uv = edge_data[edge]
+            for attr in edge_data_uv:
+                if attr in path_attributes:
+                    path_attributes[attr].append(edge_data_uv[attr])
+                else:
+                    path_attributes[attr] = [edge_data_uv[attr]]
+
+        # consolidate the path's edge segments' attribute values
+        for attr in path_attributes:
+            if attr in attrs_to_sum:
+                path_attributes[attr] = sum(path_attributes[attr])
+            elif len(set(path_attributes[attr])) == 1:
+                path_attributes[attr] = path_attributes[attr][0]
+            else:
+                path_attributes[attr] = list(set(path_attributes[attr]))
+
+        removed[path[1:-1]] = True
+        new_u.append(path[0])
+        new_v.append(path[-1])
+        new_attributes.append(path_attributes)
+
+    # geometries of all simplified edges at once
+    if paths:
+        xy = np.array([(d["x"], d["y"]) for _, d in G.nodes(data=True)], dtype=float)
+        path_nodes = np.concatenate(paths)
+        path_ids = np.repeat(np.arange(len(paths)), [len(p) for p in paths])
+        geometries = shapely.linestrings(xy[path_nodes], indices=path_ids)
+        for path_attributes, geometry in zip(new_attributes, geometries):
+            path_attributes["geometry"] = geometry
+
+    new_u = np.array(new_u, dtype=np.int64)
+    new_v = np.array(new_v, dtype=np.int64)
+
+    keep_edges = ~(removed[eu] | removed[ev])
+    keep_new = ~(removed[new_u] | removed[new_v])
+
+    keep_nodes = ~removed
+
+    if remove_rings:
+        # remove any connected components that form a self-contained ring
+        # without any endpoints
+        fu = np.concatenate([eu[keep_edges], new_u[keep_new]])
+        fv = np.concatenate([ev[keep_edges], new_v[keep_new]])
+
+        final_endpoints = _get_endpoint_mask(n_nodes, fu, fv) | pinned_mask
+
+        adjacency = sparse.coo_matrix((np.ones(len(fu)), (fu, fv)), shape=(n_nodes, n_nodes))
+        _, labels = connected_components(adjacency, directed=True, connection="weak")
+
+        has_endpoint = np.zeros(labels.max() + 1, dtype=bool)
+        has_endpoint[labels[keep_nodes & final_endpoints]] = True
+
+        keep_nodes &= has_endpoint[labels]
+        keep_edges &= keep_nodes[eu] & keep_nodes[ev]
+        keep_new &= keep_nodes[new_u] & keep_nodes[new_v]
+
+    # build the simplified graph in the same order as a modified copy of G
+    H = G.__class__()
+    H.graph.update(G.graph)
+    H.add_nodes_from((n, d.copy()) for (n, d), keep in zip(G.nodes(data=True), keep_nodes) if keep)
+    H.add_edges_from(
+        (nodes[eu[i]], nodes[ev[i]], ek[i], edge_data[i].copy()) for i in np.flatnonzero(keep_edges)
+    )
+
+    # new edges get the key networkx would give them when added to G
+    adjacency = dict(G.adjacency())
+    new_keys = {}
+    for u, v, path_attributes, keep in zip(new_u.tolist(), new_v.tolist(), new_attributes, keep_new):
+        u, v = nodes[u], nodes[v]
+        keys = new_keys.get((u, v))
+        if keys is None:
+            keys = new_keys[(u, v)] = set(adjacency[u].get(v, {}))
+        key = len(keys)
+        while key in keys:
+            key += 1
+        keys.add(key)
+        if keep:
+            H.add_edge(u, v, key=key, **path_attributes)
+
+    # mark graph as having been simplified
+    H.graph["simplified"] = True
+    return H
+
+
+# New function
+def _get_tile_parts(G, tile_size):
+    """
+    Split the nodes of a graph into square grid tiles from their x and y
+    coordinates, and find the edges cut by the tiles.
+
+    Parameters
+    ----------
+    G : networkx.MultiDiGraph
+        input graph
+    tile_size : float
+        width and height of the tiles, in the units of the x and y of the
+        nodes
+
+    Returns
+    -------
+    parts : list
+        list of lists of nodes, one for each tile
+    cut_edges : list
+        (u, v, key, data) of the edges between nodes in different tiles
+    """
+    nodes = list(G.nodes)
+    xy = np.array([(d["x"], d["y"]) for _, d in G.nodes(data=True)], dtype=float)
+
+    # same tiles as in matching_functions._assign_tiles
+    col = np.floor((xy[:, 0] - xy[:, 0].min()) / tile_size).astype(np.int64)
+    row = np.floor((xy[:, 1] - xy[:, 1].min()) / tile_size).astype(np.int64)
+    tile_ids = row * (col.max() + 1) + col
+
+    tile_of = dict(zip(nodes, tile_ids.tolist()))
+    parts = {}
+    for n, tile_id in zip(nodes, tile_ids.tolist()):
+        parts.setdefault(tile_id, []).append(n)
+
+    cut_edges = [(u, v, k, d) for u, v, k, d in G.edges(keys=True, data=True)
+                 if tile_of[u] != tile_of[v]]
+
+    return list(parts.values()), cut_edges
+
+
+# New function
+def _get_part_graph(G, nodes):
+    """
+    Get the graph of a part of G, with the nodes and the edges between them
+    in the same order as in G. Faster than G.subgraph(nodes).copy() for
+    large graphs, and like it, the graph can be sent to another process
+    without the rest of G.
+    """
+    nodes = set(nodes)
+
+    H = G.__class__()
+    H.graph.update(G.graph)
+    H.add_nodes_from((n, d) for n, d in G.nodes(data=True) if n in nodes)
+    H.add_edges_from(
+        (u, v, k, d) for u in H for v, keydict in G.adj[u].items() if v in nodes
+        for k, d in keydict.items()
+    )
+
+    return H
+
+
+# New function
+def _simplify_part(args):
+    """
+    Helper function for simplify_graph_parallel. Unpacks the arguments of
+    the simplification function when run in a process pool.
+    """
+    function, G, kwargs = args
+    return function(G, **kwargs)
+
+
+# New function
+def _stitch_parts(G, parts, results, cut_edges=None):
+    """
+    Join graphs simplified separately into one graph.
+
+    Nodes of G keep their id, and are placed in the same order as in G. Nodes
+    created by the simplification function (e.g. by multidigraph_to_graph)
+    get a new id if it is already used by G or by another part. The edges of
+    each node are added in the same order as in its part.
+
+    Parameters
+    ----------
+    G : networkx.MultiDiGraph
+        graph that was split into parts
+    parts : list
+        list of lists of the nodes of G in each part
+    results : list
+        simplified graph of each part
+    cut_edges : list
+        (u, v, key, data) of edges between parts, added back unchanged
+
+    Returns
+    -------
+    H : networkx graph
+        graph of the same class as the results
+    """
+    used = set(G.nodes)
+    next_id = max([n for n in used if isinstance(n, int)], default=-1) + 1
+
+    owner = {}
+    new_nodes = []
+    mappings = []
+    for i, (part, R) in enumerate(zip(parts, results)):
+        part = set(part)
+        mapping = {}
+        for n in R.nodes:
+            if n in part:
+                owner[n] = i
+                continue
+            if n in used:
+                while next_id in used:
+                    next_id += 1
+                mapping[n] = next_id
+            used.add(mapping.get(n, n))
+            new_nodes.append((i, n))
+        mappings.append(mapping)
+
+    order = [(owner[n], n) for n in G.nodes if n in owner] + new_nodes
+
+    H = results[0].__class__()
+    H.graph.update(results[0].graph)
+    H.add_nodes_from((mappings[i].get(n, n), results[i].nodes[n]) for i, n in order)
+
+    is_multi = H.is_multigraph()
+    edges = []
+    for i, n in order:
+        mapping = mappings[i]
+        u = mapping.get(n, n)
+        for v, data in results[i].adj[n].items():
+            v = mapping.get(v, v)
+            if is_multi:
+                edges.extend((u, v, k, d) for k, d in data.items())
+            else:
+                edges.append((u, v, data))
+    H.add_edges_from(edges)
+
+    if cut_edges:
+        H.add_edges_from((u, v, k, d.copy()) for u, v, k, d in cut_edges
+                         if u in H and v in H)
+
+    return H
+
+
+# New function
+def simplify_graph_parallel(G, function=simplify_graph_arrays, processes=None,
+                            tile_size=None, **kwargs):
+    """
+    Simplify a graph in parts in a process pool, and join the results.
+
+    By default the graph is split into weakly connected components, grouped
+    into one shard per process. Since simplification never crosses
+    components, the result has the same nodes, edges, keys and attributes as
+    simplifying the whole graph, and the nodes and the edges of each node
+    are in the same order.
+
+    If tile_size is given, the graph is instead split into square grid tiles,
+    which also splits large components. The nodes of the edges cut by the
+    tiles are pinned as endpoints, and the cut edges are added back
+    unchanged, so paths crossing a tile border are simplified into one edge
+    on each side of the border instead of one edge, and rings crossing a
+    border are not removed.
+
+    Parameters
+    ----------
+    G : networkx.MultiDiGraph
+        input graph
+    function : function
+        simplification function run on each part: simplify_graph_arrays,
+        simplify_graph, momepy_simplify_graph or multidigraph_to_graph.
+        Tiles can not be used with multidigraph_to_graph
+    processes : int
+        number of processes to use. If None, the number of cores allocated
+        to the SLURM job (SLURM_CPUS_PER_TASK) is used, or 1 outside SLURM.
+        If 1, the parts are simplified in the current process
+    tile_size : float
+        if not None, width and height of the tiles, in the units of the x and
+        y of the nodes
+    **kwargs
+        arguments of the simplification function, e.g. attributes
+
+    Returns
+    -------
+    H : networkx graph
+        simplified graph, of the class returned by the function
+    """
+    if processes is None:
+        processes = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+
+    if tile_size is None:
+        parts = _get_component_shards(G, processes)
+        cut_edges = []
+        pinned = None
+    elif function is multidigraph_to_graph:
+        raise ValueError("Tiles can not be used with multidigraph_to_graph")
+    else:
+        parts, cut_edges = _get_tile_parts(G, tile_size)
+        pinned = set([u for u, _, _, _ in cut_edges] + [v for _, v, _, _ in cut_edges])
+
+    if not parts:
+        return function(G, **kwargs)
+
+    # nodes of each part in the same order as in G
+    position = {n: i for i, n in enumerate(G.nodes)}
+    parts = [sorted(part, key=position.get) for part in parts]
+
+    part_args = []
+    for part in parts:
+        part_kwargs = dict(kwargs)
+        if pinned is not None:
+            part_kwargs["pinned"] = pinned.intersection(part)
+        part_args.append((function, _get_part_graph(G, part), part_kwargs))
+
+    print(f"Simplifying {len(part_args)} parts with {processes} processes...")
+
+    if processes == 1:
+        results = list(map(_simplify_part, part_args))
+
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_simplify_part, part_args))
+
+    if len(results) == 1 and not cut_edges:
+        return results[0]
+
+    return _stitch_parts(G, parts, results, cut_edges)
+
+
 # Modified function
 def momepy_simplify_graph(G, attributes=None,
-                          strict=True, remove_rings=True):
+                          strict=True, remove_rings=True, pinned=None):
     """
     Same as simplify_graph, but geometry is not taken into account in the same
     way : here it can take into account places where a geometry attribute
@@ -885,6 +1749,9 @@ def momepy_simplify_graph(G, attributes=None,
         have multiple OSM IDs within them too.
     remove_rings : bool
         if True, remove isolated self-contained rings that have no endpoints
+    pinned : set
+        nodes that are always endpoints, e.g. the nodes of edges cut when
+        splitting the graph into tiles
 
     Returns
     -------
@@ -906,7 +1773,7 @@ def momepy_simplify_graph(G, attributes=None,
 
     # generate each path that needs to be simplified
     for path in _get_paths_to_simplify(G, attributes=attributes,
-                                       strict=strict):
+                                       strict=strict, pinned=pinned):
         # add the interstitial edges we're removing to a list so we can retain
         # their spatial geometry
         path_attributes = dict()
@@ -979,10 +1846,12 @@ def momepy_simplify_graph(G, attributes=None,
     if remove_rings:
         # remove any connected components that form a self-contained ring
         # without any endpoints
+        if pinned is None:
+            pinned = set()
         wccs = nx.weakly_connected_components(G)
         nodes_in_rings = set()
         for wcc in wccs:
-            if not any(_is_endpoint(G, n) for n in wcc):
+            if not any(n in pinned or _is_endpoint(G, n) for n in wcc):
                 nodes_in_rings.update(wcc)
         G.remove_nodes_from(nodes_in_rings)
 
@@ -0,0 +1,750 @@
+"""
+Functions for running the sql files in scripts/sql as stages of individual statements.
+Statements that do not depend on each other are run concurrently on pooled connections (see db_functions.get_pool),
+the run time of each statement is recorded, and stages are skipped if neither the sql file nor the tables it uses have changed since the last run.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+from src import db_functions as dbf
+
+
+_keywords = {
+    "all", "and", "as", "by", "cascade", "cross", "except", "fetch", "for", "from",
+    "full", "group", "having", "inner", "intersect", "join", "lateral", "left",
+    "limit", "natural", "not", "offset", "on", "only", "or", "order", "outer",
+    "returning", "right", "select", "set", "tablesample", "union", "using",
+    "values", "where", "window", "with",
+}
+
+# Commands that change the state of the session (settings, transactions, prepared statements and cursors)
+_session_commands = {
+    "ABORT", "BEGIN", "CLOSE", "COMMIT", "DEALLOCATE", "DECLARE", "DISCARD", "END",
+    "FETCH", "LISTEN", "LOCK", "MOVE", "PREPARE", "RELEASE", "RESET", "ROLLBACK",
+    "SAVEPOINT", "SET", "START", "UNLISTEN",
+}
+
+_token_pattern = re.compile(r'(?:"(?:[^"]|"")*"|[A-Za-z_][\w$]*)(?:\.(?:"(?:[^"]|"")*"|[A-Za-z_][\w$]*))*|\S')
+
+_dollar_pattern = re.compile(r"\$([A-Za-z_]\w*)?\$")
+
+
+def _scan(sql):
+
+    """
+    Split sql into parts of code, string literals, quoted identifiers, dollar quoted strings and comments.
+
+    Arguments:
+        sql (str): sql code
+
+    Returns:
+        parts (list): tuples with the type and text of each part
+    """
+
+    parts = []
+    i = 0
+    start = 0
+    n = len(sql)
+
+    def add(kind, end):
+        if end > start:
+            parts.append((kind, sql[start:end]))
+
+    while i < n:
+        c = sql[i]
+
+        if c == "-" and sql.startswith("--", i):
+            add("code", i)
+            start = i
+            end = sql.find("\n", i)
+            i = n if end == -1 else end
+            add("comment", i)
+            start = i
+
+        elif c == "/" and sql.startswith("/*", i):
+            # Block comments can be nested
+            add("code", i)
+            start = i
+            depth = 0
+            while i < n:
+                if sql.startswith("/*", i):
+                    depth += 1
+                    i += 2
+                elif sql.startswith("*/", i):
+                    depth -= 1
+                    i += 2
+                    if depth == 0:
+                        break
+                else:
+                    i += 1
+            add("comment", i)
+            start = i
+
+        elif c == "'" or c == '"':
+            add("code", i)
+            start = i
+            i += 1
+            while i < n:
+                if sql[i] == c:
+                    # Quotes are escaped by doubling them
+                    if i + 1 < n and sql[i + 1] == c:
+                        i += 2
+                        continue
+                    i += 1
+                    break
+                i += 1
+            add("string" if c == "'" else "identifier", i)
+            start = i
+
+        elif c == "$" and (i == 0 or not (sql[i - 1].isalnum() or sql[i - 1] in "_$")):
+            match = _dollar_pattern.match(sql, i)
+            if match is None:
+                i += 1
+                continue
+            add("code", i)
+            start = i
+            tag = match.group(0)
+            end = sql.find(tag, match.end())
+            i = n if end == -1 else end + len(tag)
+            add("dollar", i)
+            start = i
+
+        else:
+            i += 1
+
+    add("code", n)
+
+    return parts
+
+
+def split_statements(sql):
+
+    """
+    Split sql code into statements.
+    Semicolons in string literals, quoted identifiers, dollar quoted strings (e.g. function bodies) and comments do not end a statement.
+
+    Arguments:
+        sql (str): sql code, e.g. the content of an sql file
+
+    Returns:
+        statements (list): dicts with the text of the statement (text), the statement without comments and with empty
+        string literals used for finding tables (clean) and the line number where the statement starts (line)
+    """
+
+    statements = []
+
+    text = []
+    clean = []
+    line = 1
+    start_line = None
+
+    def end_statement():
+        if "".join(clean).strip():
+            statements.append(
+                {
+                    "text": "".join(text).strip(),
+                    "clean": " ".join("".join(clean).split()),
+                    "line": start_line,
+                }
+            )
+
+    for kind, part in _scan(sql):
+
+        if kind != "code":
+            if start_line is None and kind != "comment":
+                start_line = line
+            text.append(part)
+            if kind in ("string", "dollar"):
+                clean.append(" '' ")
+            elif kind == "identifier":
+                clean.append(part)
+            else:
+                clean.append(" ")
+            line += part.count("\n")
+            continue
+
+        for piece in re.split(r"(;)", part):
+            if piece == ";":
+                text.append(piece)
+                end_statement()
+                text = []
+                clean = []
+                start_line = None
+                continue
+
+            if start_line is None and piece.strip():
+                # Line of the first code in the statement
+                start_line = line + piece[: len(piece) - len(piece.lstrip())].count("\n")
+
+            text.append(piece)
+            clean.append(piece)
+            line += piece.count("\n")
+
+    end_statement()
+
+    return statements
+
+
+def _normalize_name(name):
+
+    parts = re.findall(r'"((?:[^"]|"")*)"|([^."]+)', name)
+
+    return ".".join(q.replace('""', '"') if q else u.lower() for q, u in parts)
+
+
+def _is_name(token):
+
+    return (token[0] == '"' or token[0].isalpha() or token[0] == "_") and token.lower() not in _keywords
+
+
+def _calls_functions(tokens):
+
+    # Aggregates are the only functions assumed not to change data in plain queries
+    aggregates = {"count", "sum", "min", "max", "avg"}
+
+    return any(
+        _is_name(t) and t.lower() not in aggregates and tokens[i + 1] == "("
+        for i, t in enumerate(tokens[:-1])
+    )
+
+
+def get_statement_tables(statement):
+
+    """
+    Find the tables (and views) read and written by an sql statement.
+    Tables are found from the statement type and FROM/JOIN clauses, so the result is table level - not column level.
+
+    Arguments:
+        statement (str): sql statement without comments and string literals (clean from split_statements)
+
+    Returns:
+        kind (str): type of the statement, e.g. 'CREATE TABLE' or 'UPDATE'. 'SESSION' for statements that change the state of the session
+            (e.g. SET, CREATE TEMP TABLE or BEGIN). None if the type is not recognized
+        reads (set): names of the tables read
+        writes (set): names of the tables written (including created, altered and dropped tables)
+    """
+
+    tokens = _token_pattern.findall(statement)
+    upper = [t.upper() for t in tokens]
+
+    reads = set()
+    writes = set()
+    kind = None
+
+    def skip(i, *words):
+        while i < len(tokens) and upper[i] in words:
+            i += 1
+        return i
+
+    def name_list(i):
+        names = []
+        while i < len(tokens) and _is_name(tokens[i]):
+            names.append(_normalize_name(tokens[i]))
+            i += 1
+            if i < len(tokens) and tokens[i] == ",":
+                i += 1
+            else:
+                break
+        return names, i
+
+    if not tokens:
+        return kind, reads, writes
+
+    # Settings, transactions and temporary tables only exist in the session that created them
+    temp = any(
+        upper[j] in ("TEMP", "TEMPORARY") and upper[j - 1] in ("CREATE", "OR", "REPLACE", "GLOBAL", "LOCAL", "INTO")
+        for j in range(1, len(tokens))
+    )
+    if upper[0] in _session_commands or temp or "SET_CONFIG" in upper:
+        return "SESSION", reads, writes
+
+    # Names defined in WITH clauses are not tables
+    ctes = set()
+    if upper[0] == "WITH":
+        for j in range(1, len(tokens) - 2):
+            if upper[j + 1] == "AS" and tokens[j + 2] == "(" and upper[j - 1] in ("WITH", "RECURSIVE", ","):
+                ctes.add(_normalize_name(tokens[j]))
+
+    # Position of the main statement after any WITH clauses
+    i = 0
+    if upper[0] == "WITH":
+        depth = 0
+        for j, t in enumerate(upper):
+            depth += (t == "(") - (t == ")")
+            if depth == 0 and t in ("SELECT", "UPDATE", "DELETE", "INSERT"):
+                i = j
+                break
+
+    if upper[0] == "CREATE":
+        j = skip(1, "OR", "REPLACE", "TEMP", "TEMPORARY", "UNLOGGED", "UNIQUE", "MATERIALIZED")
+        if j < len(tokens) and upper[j] in ("TABLE", "VIEW"):
+            kind = "CREATE " + ("MATERIALIZED VIEW" if "MATERIALIZED" in upper[1:j] else upper[j])
+            j = skip(j + 1, "IF", "NOT", "EXISTS")
+            writes.update(name_list(j)[0][:1])
+        elif j < len(tokens) and upper[j] == "INDEX":
+            kind = "CREATE INDEX"
+            if "ON" in upper[j:]:
+                k = skip(upper.index("ON", j) + 1, "ONLY")
+                writes.update(name_list(k)[0][:1])
+
+    elif upper[0] == "ALTER":
+        j = skip(1, "MATERIALIZED")
+        if j < len(tokens) and upper[j] in ("TABLE", "VIEW"):
+            kind = "ALTER"
+            writes.update(name_list(skip(j + 1, "IF", "EXISTS", "ONLY"))[0][:1])
+
+    elif upper[0] == "DROP":
+        j = skip(1, "MATERIALIZED")
+        if j < len(tokens) and upper[j] in ("TABLE", "VIEW", "INDEX") and "CASCADE" not in upper:
+            # CASCADE can drop other objects, so it is left unrecognized
+            kind = "DROP"
+            writes.update(name_list(skip(j + 1, "IF", "EXISTS", "CONCURRENTLY"))[0])
+
+    elif upper[0] == "TRUNCATE" and "CASCADE" not in upper:
+        kind = "TRUNCATE"
+        writes.update(name_list(skip(1, "TABLE", "ONLY"))[0])
+
+    elif upper[0] == "REFRESH":
+        kind = "REFRESH"
+        writes.update(name_list(skip(1, "MATERIALIZED", "VIEW", "CONCURRENTLY"))[0][:1])
+
+    elif upper[i] == "SELECT" and not _calls_functions(tokens):
+        # Plain queries. Queries calling other functions might change data and are left unrecognized
+        kind = "SELECT"
+
+    if upper[i] == "UPDATE":
+        kind = "UPDATE"
+        writes.update(name_list(skip(i + 1, "ONLY"))[0][:1])
+    elif upper[i] == "DELETE":
+        kind = "DELETE"
+        writes.update(name_list(skip(i + 1, "FROM", "ONLY"))[0][:1])
+    elif upper[i] == "INSERT":
+        kind = "INSERT"
+        writes.update(name_list(skip(i + 1, "INTO"))[0][:1])
+
+    # Tables in FROM and JOIN clauses
+    for j, t in enumerate(upper):
+
+        if t not in ("FROM", "JOIN") or (t == "FROM" and j > 0 and upper[j - 1] == "DELETE"):
+            continue
+
+        k = skip(j + 1, "ONLY", "LATERAL")
+        while k < len(tokens) and _is_name(tokens[k]):
+            if k + 1 < len(tokens) and tokens[k + 1] == "(":
+                # Function call, e.g. FROM unnest(...)
+                break
+            reads.add(_normalize_name(tokens[k]))
+            k += 1
+            # Alias
+            if k < len(tokens) and upper[k] == "AS":
+                k += 1
+            if k < len(tokens) and _is_name(tokens[k]):
+                k += 1
+            if t == "FROM" and k < len(tokens) and tokens[k] == ",":
+                k += 1
+            else:
+                break
+
+    # Updated and deleted tables are also read
+    if kind in ("UPDATE", "DELETE"):
+        reads.update(writes)
+
+    reads -= ctes
+    writes -= ctes
+
+    return kind, reads, writes
+
+
+def get_dependencies(statements):
+
+    """
+    Find which statements must be completed before each statement can run.
+    A statement depends on an earlier statement if one of them writes a table the other reads or writes.
+    Reads and updates of views defined earlier in the statements also count as reads and writes of the tables in the view.
+    Statements of an unrecognized type depend on all earlier statements, and all later statements depend on them.
+    Statements that change the state of the session (e.g. SET or CREATE TEMP TABLE) are not allowed, since each statement runs on its own pooled connection
+    and the change would not be seen by the other statements.
+
+    Arguments:
+        statements (list): statements from split_statements
+
+    Returns:
+        tables (list): tuples with the reads and writes of each statement
+        dependencies (list): sets with the positions of the statements each statement depends on
+    """
+
+    views = {}
+    tables = []
+    dependencies = []
+    barrier = None
+
+    for n, statement in enumerate(statements):
+
+        kind, reads, writes = get_statement_tables(statement["clean"])
+
+        if kind == "SESSION":
+            raise ValueError(
+                f"Statement at line {statement['line']} changes the session ({statement['clean'][:40]}). "
+                "Statements run on separate pooled connections, so settings, transactions and temporary tables are not kept between statements. "
+                "Run the file with db_functions.run_query_pg instead"
+            )
+
+        def expand(names):
+            expanded = set(names)
+            for name in names:
+                expanded.update(views.get(name, ()))
+            return expanded
+
+        reads = expand(reads)
+
+        if kind in ("UPDATE", "DELETE", "INSERT"):
+            writes = expand(writes)
+
+        if kind in ("CREATE VIEW", "CREATE MATERIALIZED VIEW"):
+            for name in writes:
+                views[name] = reads - {name}
+
+        tables.append((reads, writes))
+
+        if kind is None:
+            dependencies.append(set(range(n)))
+            barrier = n
+            continue
+
+        depends_on = set() if barrier is None else {barrier}
+        for m in range(barrier + 1 if barrier is not None else 0, n):
+            m_reads, m_writes = tables[m]
+            if writes & (m_reads | m_writes) or reads & m_writes:
+                depends_on.add(m)
+
+        dependencies.append(depends_on)
+
+    return tables, dependencies
+
+
+def _run_statement(pool, statement):
+
+    start = time.perf_counter()
+
+    with dbf.session(pool) as connection:
+        cursor = connection.cursor()
+        cursor.execute(statement)
+        cursor.close()
+
+    return time.perf_counter() - start
+
+
+def _get_table_state(pool, names):
+
+    """
+    Get a signature of the current state of each table, used to decide whether a stage must be run again.
+    The signature of a table changes if it is recreated, rewritten or rows are inserted, updated or deleted.
+    The signature of a view includes its definition and the signatures of the tables it selects from.
+    """
+
+    query = """
+        SELECT c.relkind::text, c.relfilenode, md5(pg_get_viewdef(c.oid)),
+            s.n_tup_ins, s.n_tup_upd, s.n_tup_del
+        FROM pg_class c LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+        WHERE c.oid = to_regclass(%s);
+    """
+
+    view_query = """
+        SELECT DISTINCT d.refobjid::regclass::text
+        FROM pg_rewrite r JOIN pg_depend d ON d.objid = r.oid
+        WHERE r.ev_class = to_regclass(%s) AND d.refobjid <> r.ev_class AND d.classid = 'pg_rewrite'::regclass
+            AND d.refclassid = 'pg_class'::regclass;
+    """
+
+    state = {}
+
+    with dbf.session(pool, commit=False) as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT pg_stat_clear_snapshot();")
+
+        todo = sorted(names)
+        while todo:
+            name = todo.pop()
+            if name in state:
+                continue
+
+            cursor.execute(query, (name,))
+            row = cursor.fetchone()
+            state[name] = None if row is None else list(row)
+
+            if row is not None and row[0] in ("v", "m"):
+                cursor.execute(view_query, (name,))
+                todo.extend(r[0] for r in cursor.fetchall())
+
+        cursor.close()
+
+    return state
+
+
+def _get_stage_tables(statements, tables):
+
+    """
+    Helper function for run_sql_stage. Finds the input tables of a stage and the tables it changes in place.
+    Inputs are tables the stage reads but does not write. A table is changed in place if the stage writes it without creating it first
+    (e.g. with ALTER TABLE or UPDATE), so the state of the table after the stage can not tell whether the stage has already been run.
+    """
+
+    created = set()
+    written = set()
+    inputs = set()
+
+    for statement, (reads, writes) in zip(statements, tables):
+        kind = get_statement_tables(statement["clean"])[0]
+
+        if kind in ("CREATE TABLE", "CREATE VIEW", "CREATE MATERIALIZED VIEW"):
+            created.update(writes - written)
+
+        inputs.update(reads)
+        written.update(writes)
+
+    return inputs - written, written - created
+
+
+def _load_stage_state(state_fp):
+
+    if state_fp is None or not os.path.exists(state_fp):
+        return {}
+
+    with open(state_fp, "r") as f:
+        return json.load(f)
+
+
+def _save_stage_state(state, state_fp):
+
+    os.makedirs(os.path.dirname(state_fp) or ".", exist_ok=True)
+
+    with open(state_fp + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_fp + ".tmp", state_fp)
+
+
+def run_sql_stage(fp, pool, processes=4, state_fp=None, force=False):
+
+    """
+    Run an sql file as a stage of individual statements.
+    Statements are run as soon as the statements they depend on (see get_dependencies) are completed,
+    with up to processes statements running at the same time on connections from the pool.
+    Each statement is commited when it is completed - unlike run_query_pg, a failed stage is not rolled back as a whole.
+    If a statement fails, no new statements are started, the statements that were completed (and committed) and not run are printed,
+    and a RuntimeError is raised, so the following stages are not run on a partly applied stage.
+
+    If state_fp is given, the hash of the file and the state of the input tables of the stage (tables read but not written) before the stage is run
+    are saved when the stage is completed. In later runs, the stage is skipped if the file and the input tables have not changed.
+    Stages that change tables in place (e.g. with ALTER TABLE or UPDATE on tables they do not create) are never skipped,
+    since their result is changed by running them again - use run_sql_stages to skip such stages as part of a pipeline.
+    Table states are based on the statistics counters in PostgreSQL, so a change might not be detected right after a table is changed (the stage is then run again).
+
+    Arguments:
+        fp (str): file path of the sql file
+        pool (connection pool): pool of psycopg2 connections (result from db_functions.get_pool). Must allow at least processes connections
+        processes (int): max number of statements running at the same time
+        state_fp (str): file path of the JSON file with the states of completed stages. If None, stages are never skipped
+        force (boolean): run the stage even if nothing has changed
+
+    Returns:
+        timings (dataframe): for each statement the line number, type, tables read and written, start time (relative to the start of the stage),
+        run time in seconds and status ('completed' or 'not run'). None if the stage is skipped
+    """
+
+    with open(fp, "r") as f:
+        sql = f.read()
+
+    file_hash = hashlib.blake2b(sql.encode(), digest_size=16).hexdigest()
+
+    statements = split_statements(sql)
+    tables, dependencies = get_dependencies(statements)
+
+    inputs, changed_in_place = _get_stage_tables(statements, tables)
+
+    stage_key = os.path.abspath(fp)
+
+    if state_fp is not None:
+        input_state = _get_table_state(pool, inputs)
+        previous = _load_stage_state(state_fp).get(stage_key)
+
+        if changed_in_place:
+            print(f"Stage {os.path.basename(fp)} can not be skipped - it changes {sorted(changed_in_place)} in place")
+
+        elif not force and previous is not None and previous["hash"] == file_hash and previous["inputs"] == input_state:
+            print(f"Stage {os.path.basename(fp)} skipped - nothing has changed since the last run")
+            return None
+
+    print(f"Running stage {os.path.basename(fp)} with {len(statements)} statements...")
+
+    dependents = [[] for _ in statements]
+    remaining = [len(d) for d in dependencies]
+    for n, depends_on in enumerate(dependencies):
+        for m in depends_on:
+            dependents[m].append(n)
+
+    timings = pd.DataFrame(
+        {
+            "line": [s["line"] for s in statements],
+            "statement": [s["clean"][:80] for s in statements],
+            "kind": [get_statement_tables(s["clean"])[0] for s in statements],
+            "reads": [sorted(r) for r, _ in tables],
+            "writes": [sorted(w) for _, w in tables],
+            "start": None,
+            "seconds": None,
+            "status": "not run",
+        }
+    )
+
+    stage_start = time.perf_counter()
+    failed = False
+
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+
+        running = {}
+
+        def submit(n):
+            timings.at[n, "start"] = time.perf_counter() - stage_start
+            running[executor.submit(_run_statement, pool, statements[n]["text"])] = n
+
+        for n in range(len(statements)):
+            if remaining[n] == 0:
+                submit(n)
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                n = running.pop(future)
+
+                try:
+                    timings.at[n, "seconds"] = future.result()
+                    timings.at[n, "status"] = "completed"
+                except Exception as error:
+                    timings.at[n, "seconds"] = time.perf_counter() - stage_start - timings.at[n, "start"]
+                    timings.at[n, "status"] = "failed"
+                    print(f"Statement at line {statements[n]['line']} in {os.path.basename(fp)} failed!")
+                    print(error)
+                    failed = True
+                    continue
+
+                if failed:
+                    continue
+
+                for m in dependents[n]:
+                    remaining[m] -= 1
+                    if remaining[m] == 0:
+                        submit(m)
+
+    total = time.perf_counter() - stage_start
+    timings["start"] = timings["start"].astype(float)
+    timings["seconds"] = timings["seconds"].astype(float)
+
+    if failed:
+        print(f"Stage {os.path.basename(fp)} failed after {total:.1f}s and is partly applied:")
+        for status in ["failed", "completed", "not run"]:
+            lines = timings.loc[timings.status == status, "line"].tolist()
+            print(f"    {status}: statements at lines {lines}")
+        raise RuntimeError(f"Stage {os.path.basename(fp)} failed. Please fix error before rerunning")
+
+    print(f"Stage {os.path.basename(fp)} completed in {total:.1f}s (statements ran for {timings.seconds.sum():.1f}s in total)")
+
+    if state_fp is not None and not changed_in_place:
+        stage_state = _load_stage_state(state_fp)
+        stage_state[stage_key] = {"hash": file_hash, "inputs": input_state}
+        _save_stage_state(stage_state, state_fp)
+
+    return timings
+
+
+def run_sql_stages(fps, pool, processes=4, state_fp=None, force=False):
+
+    """
+    Run several sql files as stages (see run_sql_stage) in order.
+    If a stage fails, the error is raised and the following stages are not run.
+
+    If state_fp is given, the hashes of the files and the state of all tables used by the stages are saved when all stages are completed.
+    The state is recorded for the pipeline as a whole, since later stages often change the tables of earlier stages (which would make the state
+    of each single stage differ in every run), so also stages that change tables in place can be skipped.
+    In later runs, stages are skipped if none of the tables have changed since the end of the last run, until the first stage with a changed file.
+    That stage and all stages after it are run again, together with any earlier stages that write tables those stages change in place.
+
+    Arguments:
+        fps (list): file paths of the sql files
+        pool (connection pool): pool of psycopg2 connections (result from db_functions.get_pool)
+        processes (int): max number of statements running at the same time
+        state_fp (str): file path of the JSON file with the states of completed pipelines. If None, stages are never skipped
+        force (boolean): run the stages even if nothing has changed
+
+    Returns:
+        timings (dataframe): timings of the statements in all stages that were run, with the file path of the stage in the column stage
+    """
+
+    hashes = []
+    used_tables = set()
+    stage_writes = []
+    stage_changed_in_place = []
+
+    for fp in fps:
+        with open(fp, "r") as f:
+            sql = f.read()
+
+        hashes.append(hashlib.blake2b(sql.encode(), digest_size=16).hexdigest())
+
+        statements = split_statements(sql)
+        tables = get_dependencies(statements)[0]
+
+        writes = set()
+        for r, w in tables:
+            used_tables.update(r | w)
+            writes.update(w)
+
+        stage_writes.append(writes)
+        stage_changed_in_place.append(_get_stage_tables(statements, tables)[1])
+
+    pipeline_key = "|".join(os.path.abspath(fp) for fp in fps)
+
+    # Number of stages at the start of the pipeline that are unchanged since the last run
+    n_skipped = 0
+
+    if state_fp is not None and not force:
+        previous = _load_stage_state(state_fp).get(pipeline_key)
+
+        if previous is not None and previous["tables"] == _get_table_state(pool, previous["tables"].keys()):
+            while n_skipped < len(fps) and previous["hashes"][n_skipped] == hashes[n_skipped]:
+                n_skipped += 1
+
+            # Stages that are run again must start from the tables they changed in place as they were before the last run
+            rerun = True
+            while rerun:
+                changed_in_place = set().union(*stage_changed_in_place[n_skipped:])
+                rerun = False
+                for i in range(n_skipped):
+                    if stage_writes[i] & changed_in_place:
+                        n_skipped = i
+                        rerun = True
+                        break
+
+            for fp in fps[:n_skipped]:
+                print(f"Stage {os.path.basename(fp)} skipped - nothing has changed since the last run")
+
+    all_timings = []
+
+    for fp in fps[n_skipped:]:
+        timings = run_sql_stage(fp, pool, processes=processes)
+
+        timings.insert(0, "stage", fp)
+        all_timings.append(timings)
+
+    if state_fp is not None:
+        stage_state = _load_stage_state(state_fp)
+        stage_state[pipeline_key] = {"hashes": hashes, "tables": _get_table_state(pool, used_tables)}
+        _save_stage_state(stage_state, state_fp)
+
+    if not all_timings:
+        return pd.DataFrame(columns=["stage", "line", "statement", "kind", "reads", "writes", "start", "seconds", "status"])
+
+    return pd.concat(all_timings, ignore_index=True)
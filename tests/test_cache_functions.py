@@ -0,0 +1,146 @@
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import LineString
+
+from src import cache_functions as cf
+from src import matching_functions as mf
+
+
+@pytest.fixture
+def segments():
+
+    return gpd.GeoDataFrame(
+        {"seg_id": [1, 2, 3], "osmid": [10, 10, 20]},
+        geometry=[
+            LineString([(0, 0), (10, 0)]),
+            LineString([(10, 0), (20, 0)]),
+            LineString([(0, 5), (10, 5)]),
+        ],
+        crs="EPSG:25832",
+    )
+
+
+def _counting(func):
+
+    calls = []
+
+    def wrapper(**inputs):
+        calls.append(inputs)
+        return func(**inputs)
+
+    return wrapper, calls
+
+
+def test_save_and_load_checkpoint(tmp_path):
+
+    cf.save_checkpoint({"a": 1}, tmp_path, "stage", "key1")
+
+    assert cf.load_checkpoint(tmp_path, "stage", "key1") == (True, {"a": 1})
+
+
+def test_load_checkpoint_miss(tmp_path):
+
+    assert cf.load_checkpoint(tmp_path, "stage", "key1") == (False, None)
+
+    cf.save_checkpoint({"a": 1}, tmp_path, "stage", "key1")
+
+    # Changed key and other stage name
+    assert cf.load_checkpoint(tmp_path, "stage", "key2") == (False, None)
+    assert cf.load_checkpoint(tmp_path, "other", "key1") == (False, None)
+
+
+def test_save_checkpoint_overwrites(tmp_path):
+
+    cf.save_checkpoint({"a": 1}, tmp_path, "stage", "key1")
+    cf.save_checkpoint({"a": 2}, tmp_path, "stage", "key2")
+
+    assert cf.load_checkpoint(tmp_path, "stage", "key1") == (False, None)
+    assert cf.load_checkpoint(tmp_path, "stage", "key2") == (True, {"a": 2})
+
+
+def test_run_stage_hit(tmp_path, segments):
+
+    func, calls = _counting(lambda data, n: len(data) * n)
+
+    assert cf.run_stage("count", func, tmp_path, data=segments, n=2) == 6
+    assert cf.run_stage("count", func, tmp_path, data=segments.copy(), n=2) == 6
+
+    assert len(calls) == 1
+
+
+def test_run_stage_changed_input(tmp_path, segments):
+
+    func, calls = _counting(lambda data, n: len(data) * n)
+
+    cf.run_stage("count", func, tmp_path, data=segments, n=2)
+
+    # Changed parameter
+    assert cf.run_stage("count", func, tmp_path, data=segments, n=3) == 9
+
+    # Changed data
+    changed = segments.copy()
+    changed.loc[0, "osmid"] = 30
+    assert cf.run_stage("count", func, tmp_path, data=changed, n=3) == 9
+
+    assert len(calls) == 3
+
+
+def test_get_stage_key_rejects_objects():
+
+    with pytest.raises(TypeError):
+        cf.get_stage_key("stage", {"obj": object()})
+
+
+def test_summarize_stage_resumes(tmp_path, segments):
+
+    # summarize_feature_matches must not change its inputs, otherwise the key of a later stage
+    # using the same data differs between a fresh and a resumed run
+    matches = pd.DataFrame({"seg_id_ref": [5], "matches_ix": [[0]], "matches_id": [1]})
+    columns = list(matches.columns)
+
+    key_before = cf.get_stage_key("next", {"matches": matches})
+
+    func, calls = _counting(
+        lambda segments, segment_matches: mf.summarize_feature_matches(
+            segments, segment_matches, "seg_id", "osmid", osm=True
+        )
+    )
+    result = cf.run_stage("summarize", func, tmp_path, segments=segments, segment_matches=matches)
+
+    # Half of the length of osmid 10 is matched, which is not more than the threshold
+    assert result == ([], [10])
+    assert list(matches.columns) == columns
+    assert cf.get_stage_key("next", {"matches": matches}) == key_before
+
+
+def test_create_segment_gdf_cached(segments, tmp_path, monkeypatch):
+
+    calls = []
+
+    def segment_func(gdf, segment_length):
+        calls.append(segment_length)
+        return mf.create_segment_gdf(gdf, segment_length)
+
+    first = cf.create_segment_gdf_cached(segments, 4, segment_func, cache_dir=str(tmp_path))
+    second = cf.create_segment_gdf_cached(segments, 4, segment_func, cache_dir=str(tmp_path))
+
+    assert len(calls) == 1
+    assert second.equals(first)
+
+    # Segments are created again when the segmentation version changes
+    monkeypatch.setattr(cf, "SEGMENT_VERSION", cf.SEGMENT_VERSION + 1)
+    cf.create_segment_gdf_cached(segments, 4, segment_func, cache_dir=str(tmp_path))
+
+    assert len(calls) == 2
+
+
+def test_save_segment_cache_raises(segments, tmp_path):
+
+    # Arbitrary Python objects can not be written to parquet
+    segments["osmid"] = [object(), object(), object()]
+
+    with pytest.raises(Exception):
+        cf.save_segment_cache(segments, str(tmp_path), "key")
+
+    assert list(tmp_path.iterdir()) == []
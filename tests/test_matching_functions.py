@@ -0,0 +1,310 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+from src import matching_functions as mf
+
+
+ref_id_col = "seg_id_ref"
+osm_id_col = "seg_id"
+dist = 15
+angular_threshold = 30
+hausdorff_threshold = 17
+
+
+def _segment(fp):
+
+    gdf = gpd.read_file(fp)
+    gdf["edge_id"] = np.arange(len(gdf))
+
+    return gdf, mf.create_segment_gdf(gdf, segment_length=10)
+
+
+@pytest.fixture(scope="module")
+def osm_data():
+    return _segment("tests/osm_subset.gpkg")
+
+
+@pytest.fixture(scope="module")
+def reference_data():
+    edges, segments = _segment("tests/geodk_test.gpkg")
+    return edges, segments.rename(columns={"seg_id": ref_id_col})
+
+
+def _match(osm_segments, ref_segments, buffer_matches=None):
+
+    if buffer_matches is None:
+        buffer_matches = mf.get_candidate_store(osm_segments, ref_segments, dist, ref_id_col, osm_id_col)
+
+    return mf.find_matches_from_buffer(
+        buffer_matches=buffer_matches,
+        osm_edges=osm_segments,
+        reference_data=ref_segments,
+        angular_threshold=angular_threshold,
+        hausdorff_threshold=hausdorff_threshold,
+    )
+
+
+def _match_list(matches):
+    return list(zip(matches[ref_id_col], matches["matches_ix"], matches["matches_id"]))
+
+
+def test_create_segment_gdf_columns(osm_data):
+
+    osm_edges, osm_segments = osm_data
+
+    # The geometry column is moved to the end and followed by seg_id, as when the segments were made with GeoDataFrame.explode
+    assert list(osm_segments.columns) == [c for c in osm_edges.columns if c != "geometry"] + ["geometry", "seg_id"]
+    assert osm_segments.geometry.name == "geometry"
+    assert osm_segments.crs == osm_edges.crs
+    assert list(osm_segments.groupby("edge_id").size().index) == list(osm_edges["edge_id"])
+
+
+def test_candidate_store_same_candidates_as_overlay_buffer(osm_data, reference_data):
+
+    _, osm_segments = osm_data
+    _, ref_segments = reference_data
+
+    buffer_matches = mf.overlay_buffer(osm_segments, ref_segments, dist, ref_id_col, osm_id_col)
+    candidates = mf.get_candidate_store(osm_segments, ref_segments, dist, ref_id_col, osm_id_col)
+
+    assert list(candidates["ref_ids"]) == list(buffer_matches[ref_id_col])
+    assert list(np.diff(candidates["offsets"])) == list(buffer_matches["count"])
+    assert list(candidates["osm_ids"]) == [i for ids in buffer_matches["matches_id"] for i in ids]
+
+    assert _match_list(_match(osm_segments, ref_segments, candidates)) == _match_list(
+        _match(osm_segments, ref_segments, buffer_matches)
+    )
+
+
+def test_candidate_store_round_trip(osm_data, reference_data, tmp_path):
+
+    _, osm_segments = osm_data
+    _, ref_segments = reference_data
+
+    candidates = mf.get_candidate_store(osm_segments, ref_segments, dist, ref_id_col, osm_id_col)
+
+    fp = str(tmp_path / "candidates.npz")
+    mf.save_candidate_store(candidates, fp)
+    loaded = mf.load_candidate_store(fp)
+
+    assert loaded.keys() == candidates.keys()
+    assert loaded["ref_id_col"] == ref_id_col
+    assert loaded["osm_id_col"] == osm_id_col
+    for k in ["ref_ids", "offsets", "osm_ids"]:
+        assert np.array_equal(loaded[k], candidates[k])
+
+    assert _match_list(_match(osm_segments, ref_segments, loaded)) == _match_list(
+        _match(osm_segments, ref_segments, candidates)
+    )
+
+
+@pytest.mark.parametrize("store", [False, True])
+def test_find_matches_other_osm_id_col(osm_data, reference_data, store):
+
+    _, osm_segments = osm_data
+    _, ref_segments = reference_data
+
+    # Ids in another column than seg_id, with seg_id not matching the ids
+    renamed = osm_segments.rename(columns={osm_id_col: "osm_seg_id"})
+    renamed["osm_seg_id"] += 10**6
+    renamed[osm_id_col] = 0
+
+    if store:
+        buffer_matches = mf.get_candidate_store(renamed, ref_segments, dist, ref_id_col, "osm_seg_id")
+    else:
+        buffer_matches = mf.overlay_buffer(renamed, ref_segments, dist, ref_id_col, "osm_seg_id")
+
+    matches = mf.find_matches_from_buffer(
+        buffer_matches=buffer_matches,
+        osm_edges=renamed,
+        reference_data=ref_segments,
+        angular_threshold=angular_threshold,
+        hausdorff_threshold=hausdorff_threshold,
+        osm_id_col="osm_seg_id",
+    )
+    expected = _match(osm_segments, ref_segments)
+
+    assert len(matches) > 0
+    assert list(matches["matches_ix"]) == list(expected["matches_ix"])
+    assert list(matches["matches_id"]) == list(expected["matches_id"] + 10**6)
+
+
+@pytest.mark.parametrize("densify", [None, 1])
+def test_hausdorff_dists_same_as_single_pairs(densify):
+
+    rng = np.random.default_rng(0)
+
+    # Lines with different numbers of vertices, so pairs are padded and split in chunks
+    n_vertices = rng.integers(2, 12, size=(2, 500))
+    osm_geoms = shapely.linestrings(rng.uniform(0, 20, size=(n_vertices[0].sum(), 2)), indices=np.repeat(np.arange(500), n_vertices[0]))
+    ref_geoms = shapely.linestrings(rng.uniform(0, 20, size=(n_vertices[1].sum(), 2)), indices=np.repeat(np.arange(500), n_vertices[1]))
+
+    hausdorff_dists = mf._get_hausdorff_dists(osm_geoms, ref_geoms, densify=densify, chunk_size=64, max_size=5000)
+
+    if densify is not None:
+        osm_geoms = shapely.segmentize(osm_geoms, densify)
+        ref_geoms = shapely.segmentize(ref_geoms, densify)
+
+    expected = [mf._get_hausdorff_dist(o, r) for o, r in zip(osm_geoms, ref_geoms)]
+
+    assert np.allclose(hausdorff_dists, expected)
+
+
+def test_hausdorff_dists_close_to_shapely():
+
+    rng = np.random.default_rng(1)
+
+    n_vertices = rng.integers(2, 12, size=(2, 500))
+    osm_geoms = shapely.linestrings(rng.uniform(0, 20, size=(n_vertices[0].sum(), 2)), indices=np.repeat(np.arange(500), n_vertices[0]))
+    ref_geoms = shapely.linestrings(rng.uniform(0, 20, size=(n_vertices[1].sum(), 2)), indices=np.repeat(np.arange(500), n_vertices[1]))
+
+    # Only vertices are compared, while GEOS measures the distance from each vertex to the other line,
+    # so the distances are larger than the GEOS distance by at most half the max distance between vertices
+    densify = 0.5
+    hausdorff_dists = mf._get_hausdorff_dists(osm_geoms, ref_geoms, densify=densify)
+
+    expected = shapely.hausdorff_distance(
+        shapely.segmentize(osm_geoms, densify), shapely.segmentize(ref_geoms, densify)
+    )
+
+    assert (hausdorff_dists >= expected - 1e-9).all()
+    assert (hausdorff_dists <= expected + densify / 2 + 1e-9).all()
+
+
+def test_assign_matches():
+
+    sorted_pairs = pd.DataFrame({"ref_ix": [1, 2, 3, 1, 3, 4], "osm_pos": [10, 10, 10, 11, 11, 11]})
+
+    accepted = mf._assign_matches(sorted_pairs, max_ref_per_osm=2)
+
+    assert accepted.dtype == bool
+    assert accepted.tolist() == [True, True, False, False, True, True]
+    assert mf._assign_matches(sorted_pairs.iloc[:0], max_ref_per_osm=2).tolist() == []
+
+
+@pytest.mark.parametrize("tile_size", [100, 300, 100000])
+def test_match_networks_tiled_same_as_single_process(osm_data, reference_data, tile_size):
+
+    _, osm_segments = osm_data
+    _, ref_segments = reference_data
+
+    matches = _match(osm_segments, ref_segments)
+
+    tiled_matches = mf.match_networks_tiled(
+        osm_data=osm_segments,
+        reference_data=ref_segments,
+        ref_id_col=ref_id_col,
+        osm_id_col=osm_id_col,
+        dist=dist,
+        angular_threshold=angular_threshold,
+        hausdorff_threshold=hausdorff_threshold,
+        tile_size=tile_size,
+        processes=1,
+    )
+
+    assert len(matches) > 0
+    assert _match_list(tiled_matches) == _match_list(matches)
+    assert tiled_matches.equals(matches)
+
+
+@pytest.mark.parametrize("empty", ["reference_data", "tiles"])
+def test_match_networks_tiled_no_tiles(osm_data, reference_data, empty):
+
+    _, osm_segments = osm_data
+    _, ref_segments = reference_data
+
+    matches = _match(osm_segments, ref_segments)
+
+    tiled_matches = mf.match_networks_tiled(
+        osm_data=osm_segments,
+        reference_data=ref_segments.iloc[:0] if empty == "reference_data" else ref_segments,
+        ref_id_col=ref_id_col,
+        osm_id_col=osm_id_col,
+        dist=dist,
+        tile_size=300,
+        processes=1,
+        tiles=[] if empty == "tiles" else None,
+    )
+
+    assert len(tiled_matches) == 0
+    assert list(tiled_matches.columns) == list(matches.columns)
+    assert (tiled_matches.dtypes == matches.dtypes).all()
+
+
+def test_rematch_changed_same_as_full_rematch(osm_data, reference_data):
+
+    osm_edges, osm_segments = osm_data
+    _, ref_segments = reference_data
+
+    old_matches = _match(osm_segments, ref_segments)
+
+    # Move some matched features, remove one and add a copy of another one
+    matched_edges = osm_segments.loc[osm_segments[osm_id_col].isin(old_matches["matches_id"]), "edge_id"].unique()
+
+    new_edges = osm_edges.copy()
+    moved = new_edges["edge_id"].isin(matched_edges[:5])
+    new_edges.loc[moved, "geometry"] = new_edges.loc[moved, "geometry"].translate(6, 6)
+    new_edges = new_edges[new_edges["edge_id"] != matched_edges[5]]
+
+    added = osm_edges[osm_edges["edge_id"] == matched_edges[6]].copy()
+    added["edge_id"] = osm_edges["edge_id"].max() + 1
+    added["geometry"] = added["geometry"].translate(-3, 0)
+    new_edges = gpd.GeoDataFrame(pd.concat([new_edges, added], ignore_index=True), crs=osm_edges.crs)
+
+    changed_ids = mf.get_changed_features(osm_edges, new_edges, "edge_id")
+    assert len(changed_ids) == 7
+
+    new_segments = mf.update_segments(
+        osm_segments, new_edges, changed_ids, "edge_id", osm_id_col, lambda gdf: mf.create_segment_gdf(gdf, segment_length=10)
+    )
+
+    changed = pd.concat([osm_edges, new_edges])
+    changed_geoms = changed.loc[changed["edge_id"].isin(changed_ids), "geometry"].values
+
+    incremental_matches = mf.rematch_changed(
+        osm_data=new_segments,
+        reference_data=ref_segments,
+        old_matches=old_matches,
+        changed_geoms=changed_geoms,
+        ref_id_col=ref_id_col,
+        osm_id_col=osm_id_col,
+        dist=dist,
+        angular_threshold=angular_threshold,
+        hausdorff_threshold=hausdorff_threshold,
+    )
+
+    full_matches = _match(new_segments, ref_segments)
+
+    assert _match_list(incremental_matches) != _match_list(old_matches)
+    assert _match_list(incremental_matches) == _match_list(full_matches)
+
+
+def test_changed_features_from_chunks(osm_data):
+
+    osm_edges, osm_segments = osm_data
+
+    new_edges = osm_edges.copy()
+    new_edges.loc[new_edges.index[10:13], "geometry"] = new_edges.geometry.iloc[10:13].translate(1, 0)
+    new_edges = new_edges.iloc[10:]
+
+    # Hashes computed chunk by chunk, as when the new data is read with db_functions.read_postgis_chunks
+    old_hashes = mf.get_feature_hashes(osm_edges, "edge_id")
+    new_hashes = pd.concat([mf.get_feature_hashes(new_edges.iloc[i : i + 100], "edge_id") for i in range(0, len(new_edges), 100)])
+
+    changed_ids = mf.compare_feature_hashes(old_hashes, new_hashes)
+
+    assert sorted(changed_ids) == sorted(mf.get_changed_features(osm_edges, new_edges, "edge_id"))
+    assert sorted(changed_ids) == list(range(13))
+
+    # Segments can be updated from only the added and changed features
+    changed_edges = new_edges[new_edges["edge_id"].isin(changed_ids)]
+
+    def segment_func(gdf):
+        return mf.create_segment_gdf(gdf, segment_length=10)
+
+    assert mf.update_segments(osm_segments, changed_edges, changed_ids, "edge_id", osm_id_col, segment_func).equals(
+        mf.update_segments(osm_segments, new_edges, changed_ids, "edge_id", osm_id_col, segment_func)
+    )
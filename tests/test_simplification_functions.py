@@ -0,0 +1,225 @@
+import itertools
+
+import networkx as nx
+import pytest
+from shapely.geometry import LineString
+
+from src import simplification_functions as sf
+
+
+def _add_path(G, nodes, osmid, highway="residential"):
+    for u, v in zip(nodes[:-1], nodes[1:]):
+        for a, b in ((u, v), (v, u)):
+            G.add_edge(a, b, osmid=osmid, highway=highway, length=10.0)
+
+
+@pytest.fixture
+def multi_component_graph():
+
+    # Several components with interstitial nodes, branches, parallel paths and an isolated ring
+    G = nx.MultiDiGraph(crs="EPSG:4326")
+
+    for n in range(40):
+        G.add_node(n, x=12.0 + (n % 7) * 0.001, y=55.0 + (n // 7) * 0.001)
+
+    _add_path(G, [0, 1, 2, 3, 4], osmid=1)
+    _add_path(G, [2, 5, 6], osmid=2)
+
+    _add_path(G, [10, 11, 12, 13], osmid=3)
+    _add_path(G, [13, 14, 15], osmid=3, highway="cycleway")
+
+    _add_path(G, [20, 21, 22, 23], osmid=4)
+    _add_path(G, [20, 24, 25, 23], osmid=5)
+
+    for u, v in zip([30, 31, 32, 33], [31, 32, 33, 30]):
+        G.add_edge(u, v, osmid=6, highway="footway", length=10.0)
+
+    _add_path(G, [35, 36, 37, 38, 39], osmid=7)
+
+    return G
+
+
+def _edge_list(G):
+    return [(u, v, k, sorted(d.items(), key=lambda x: x[0])) for u, v, k, d in G.edges(keys=True, data=True)]
+
+
+@pytest.mark.parametrize("function", [sf.simplify_graph, sf.simplify_graph_arrays])
+def test_simplify_graph_parallel_same_edges_and_order(multi_component_graph, function):
+
+    attributes = ["highway"]
+
+    H = function(multi_component_graph, attributes=attributes)
+    H_parallel = sf.simplify_graph_parallel(multi_component_graph, function=function, processes=2, attributes=attributes)
+
+    assert H.number_of_edges() < multi_component_graph.number_of_edges()
+    assert list(H_parallel.nodes) == list(H.nodes)
+    assert _edge_list(H_parallel) == _edge_list(H)
+
+
+def test_simplify_graph_parallel_tiles_keep_cut_edges(multi_component_graph):
+
+    _, cut_edges = sf._get_tile_parts(multi_component_graph, 0.0025)
+
+    H = sf.simplify_graph_arrays(multi_component_graph, attributes=["highway"])
+    H_parallel = sf.simplify_graph_parallel(multi_component_graph, processes=1, tile_size=0.0025, attributes=["highway"])
+
+    # Endpoints of the whole graph are kept, and edges cut by the tiles are added back unchanged
+    assert len(cut_edges) > 0
+    assert set(H.nodes) <= set(H_parallel.nodes) <= set(multi_component_graph.nodes)
+    assert all(H_parallel.has_edge(u, v) for u, v, _, _ in cut_edges)
+
+
+@pytest.mark.parametrize("strict", [True, False])
+@pytest.mark.parametrize("attributes", [None, ["highway"], ["highway", "maxspeed"]])
+def test_simplify_graph_arrays_same_as_simplify_graph(multi_component_graph, attributes, strict):
+
+    G = multi_component_graph.copy()
+
+    # Elbow between two ways, where strict decides whether the node is kept
+    _add_path(G, [7, 8, 9, 16], osmid=8)
+    _add_path(G, [16, 17, 18], osmid=9)
+
+    # Way where maxspeed changes along the way
+    _add_path(G, [26, 27, 28, 29, 34], osmid=10)
+
+    for u, v, d in G.edges(data=True):
+        if d["osmid"] == 10:
+            d["maxspeed"] = "30" if {u, v} <= {26, 27, 28} else "50"
+        else:
+            d["maxspeed"] = "50"
+
+    H = sf.simplify_graph(G, attributes=attributes, strict=strict)
+    H_arrays = sf.simplify_graph_arrays(G, attributes=attributes, strict=strict)
+
+    assert H.number_of_edges() < G.number_of_edges()
+    assert list(H_arrays.nodes) == list(H.nodes)
+    assert sorted(H_arrays.edges(keys=True)) == sorted(H.edges(keys=True))
+
+    for u, v, k, d in H.edges(keys=True, data=True):
+        d_arrays = H_arrays.edges[u, v, k]
+        assert ("geometry" in d_arrays) == ("geometry" in d)
+        if "geometry" in d:
+            assert d_arrays["geometry"].equals_exact(d["geometry"], 0)
+
+
+def _update_edge_keys_pairwise(G):
+
+    # The previous version of _update_edge_keys, comparing each pair of parallel edges with _is_same_geometry
+    groups = {}
+    for u, v, k, d in G.edges(keys=True, data=True):
+        groups.setdefault("_".join(sorted([str(u), str(v)]) + [str(k)]), []).append((u, v, k, d))
+
+    different_streets = []
+    for uvk in sorted(groups):
+        group = [e for e in groups[uvk] if e[3].get("geometry") is not None]
+        if len(groups[uvk]) < 2:
+            continue
+        for e1, e2 in itertools.combinations(group, 2):
+            if not sf._is_same_geometry(e1[3]["geometry"], e2[3]["geometry"]):
+                different_streets.append(group[0][:3])
+
+    for u, v, k in set(different_streets):
+        new_key = max(list(G[u][v]) + list(G[v][u])) + 1
+        G.add_edge(u, v, key=new_key, **G.get_edge_data(u, v, k))
+        G.remove_edge(u, v, key=k)
+
+    return G
+
+
+def _get_undirected_pairwise(G, attributes=None):
+
+    # The previous version of get_undirected, comparing each pair of parallel edges with _is_duplicate_edge
+    G = G.copy()
+    for u, v, d in G.edges(data=True):
+        if "geometry" not in d:
+            d["geometry"] = LineString([(G.nodes[u]["x"], G.nodes[u]["y"]), (G.nodes[v]["x"], G.nodes[v]["y"])])
+
+    G = _update_edge_keys_pairwise(G)
+
+    H = nx.MultiGraph(**G.graph)
+    H.add_nodes_from(G.nodes(data=True))
+    H.add_edges_from(G.edges(keys=True, data=True))
+
+    duplicate_edges = set()
+    for u1, v1, key1, data1 in H.edges(keys=True, data=True):
+        if (u1, v1, key1) not in duplicate_edges:
+            for key2 in H[u1][v1]:
+                if key1 != key2 and sf._is_duplicate_edge(data1, H.edges[u1, v1, key2], attributes=attributes):
+                    duplicate_edges.add((u1, v1, key2))
+
+    H.remove_edges_from(duplicate_edges)
+    return H
+
+
+@pytest.fixture
+def parallel_edges_graph():
+
+    G = nx.MultiDiGraph(crs="EPSG:4326")
+
+    for n in range(12):
+        G.add_node(n, x=float(n % 4), y=float(n // 4))
+
+    def line(*coords):
+        return LineString(coords)
+
+    # Two-way street with the geometry in both directions
+    G.add_edge(0, 1, osmid=1, highway="residential", geometry=line((0, 0), (0.5, 0.2), (1, 0)))
+    G.add_edge(1, 0, osmid=1, highway="residential", geometry=line((1, 0), (0.5, 0.2), (0, 0)))
+
+    # Parallel two-way streets with different geometries
+    G.add_edge(1, 2, osmid=2, highway="residential", geometry=line((1, 0), (1.5, 0.3), (2, 0)))
+    G.add_edge(2, 1, osmid=2, highway="residential", geometry=line((2, 0), (1.5, 0.3), (1, 0)))
+    G.add_edge(1, 2, osmid=2, highway="residential", geometry=line((1, 0), (1.5, -0.3), (2, 0)))
+    G.add_edge(2, 1, osmid=2, highway="residential", geometry=line((2, 0), (1.5, -0.3), (1, 0)))
+
+    # One-way streets with different geometries in opposite directions
+    G.add_edge(2, 3, osmid=3, highway="primary", geometry=line((2, 0), (2.5, 0.1), (3, 0)))
+    G.add_edge(3, 2, osmid=3, highway="primary", geometry=line((3, 0), (2.5, -0.1), (2, 0)))
+
+    # Parallel edges with equal geometries but different attributes
+    G.add_edge(4, 5, osmid=4, highway="residential", geometry=line((0, 1), (0.5, 1.1), (1, 1)))
+    G.add_edge(4, 5, osmid=4, highway="cycleway", geometry=line((0, 1), (0.5, 1.1), (1, 1)))
+    G.add_edge(5, 4, osmid=4, highway="residential", geometry=line((1, 1), (0.5, 1.1), (0, 1)))
+
+    # Parallel edges with equal geometries, different osmids and a -0.0 coordinate
+    G.add_edge(5, 6, osmid=[5, 6], highway="residential", geometry=line((1, 1), (1.5, -0.0), (2, 1)))
+    G.add_edge(6, 5, osmid=[6, 5], highway="residential", geometry=line((2, 1), (1.5, 0.0), (1, 1)))
+    G.add_edge(5, 6, osmid=7, highway="residential", geometry=line((1, 1), (1.5, 0.0), (2, 1)))
+
+    # Edges without geometry and a self-loop
+    G.add_edge(8, 9, osmid=8, highway="residential")
+    G.add_edge(9, 8, osmid=8, highway="residential")
+    G.add_edge(8, 9, osmid=8, highway="residential", geometry=line((0, 2), (0.5, 2.5), (1, 2)))
+    G.add_edge(10, 10, osmid=9, highway="residential", geometry=line((2, 2), (2.5, 2.5), (3, 2), (2, 2)))
+    G.add_edge(10, 10, osmid=9, highway="residential", geometry=line((2, 2), (3, 2), (2.5, 2.5), (2, 2)))
+
+    return G
+
+
+def test_geometry_keys_same_as_is_same_geometry(parallel_edges_graph):
+
+    geometries = [d["geometry"] for _, _, d in parallel_edges_graph.edges(data=True) if "geometry" in d]
+    keys = sf._get_geometry_keys(geometries + [None])
+
+    assert keys[-1] == -1
+    for (k1, g1), (k2, g2) in itertools.combinations(zip(keys, geometries), 2):
+        assert (k1 == k2) == sf._is_same_geometry(g1, g2)
+
+
+def test_update_edge_keys_same_as_pairwise(parallel_edges_graph):
+
+    G = sf._update_edge_keys(parallel_edges_graph.copy())
+    G_pairwise = _update_edge_keys_pairwise(parallel_edges_graph.copy())
+
+    assert G.number_of_edges() == parallel_edges_graph.number_of_edges()
+    assert _edge_list(G) == _edge_list(G_pairwise)
+
+
+@pytest.mark.parametrize("attributes", [None, ["highway"]])
+def test_get_undirected_same_as_pairwise(parallel_edges_graph, attributes):
+
+    H = sf.get_undirected(parallel_edges_graph, attributes=attributes)
+    H_pairwise = _get_undirected_pairwise(parallel_edges_graph, attributes=attributes)
+
+    assert H.number_of_edges() < parallel_edges_graph.number_of_edges()
+    assert _edge_list(H) == _edge_list(H_pairwise)
@@ -0,0 +1,169 @@
+import pytest
+
+from src import sql_functions as sqf
+
+
+def test_split_statements_quotes_and_comments():
+
+    sql = """-- Semicolons in comments; strings, quoted identifiers and function bodies do not end statements
+CREATE TABLE a (name VARCHAR, "odd;name" VARCHAR);
+INSERT INTO a VALUES ('x;y', 'it''s; quoted');
+/* block; /* nested; */ comment */
+CREATE FUNCTION f() RETURNS integer AS $body$
+    SELECT 1;
+$body$ LANGUAGE sql;
+
+UPDATE a SET name = 'z'"""
+
+    statements = sqf.split_statements(sql)
+
+    assert [s["line"] for s in statements] == [2, 3, 5, 9]
+    assert statements[0]["text"].endswith('CREATE TABLE a (name VARCHAR, "odd;name" VARCHAR);')
+    assert statements[1]["clean"] == "INSERT INTO a VALUES ( '' , '' )"
+    assert statements[2]["text"].endswith("$body$ LANGUAGE sql;")
+    assert statements[3]["text"] == "UPDATE a SET name = 'z'"
+
+
+def test_split_statements_test_file():
+
+    with open("tests/test_sql.sql") as f:
+        statements = sqf.split_statements(f.read())
+
+    assert [sqf.get_statement_tables(s["clean"])[0] for s in statements] == ["CREATE TABLE", "INSERT", None]
+
+
+def test_get_statement_tables():
+
+    assert sqf.get_statement_tables("CREATE TABLE c AS SELECT * FROM a JOIN b ON a.id = b.id;") == (
+        "CREATE TABLE",
+        {"a", "b"},
+        {"c"},
+    )
+    assert sqf.get_statement_tables("UPDATE a SET x = b.x FROM b WHERE a.id = b.id;") == ("UPDATE", {"a", "b"}, {"a"})
+    assert sqf.get_statement_tables('WITH t AS (SELECT * FROM "S".a) INSERT INTO b SELECT * FROM t;') == (
+        "INSERT",
+        {"S.a"},
+        {"b"},
+    )
+    assert sqf.get_statement_tables("DROP TABLE IF EXISTS a CASCADE;")[0] is None
+    assert sqf.get_statement_tables("SELECT f(x) FROM a;")[0] is None
+
+
+def test_get_dependencies():
+
+    sql = """
+CREATE TABLE a AS SELECT * FROM source_a;
+CREATE TABLE b AS SELECT * FROM source_b;
+UPDATE a SET x = 1;
+UPDATE b SET x = 1;
+CREATE VIEW v AS SELECT * FROM a;
+CREATE TABLE c AS SELECT * FROM v JOIN b ON v.id = b.id;
+SELECT f(x) FROM c;
+UPDATE a SET y = 1;
+"""
+
+    tables, dependencies = sqf.get_dependencies(sqf.split_statements(sql))
+
+    assert tables[5] == ({"v", "a", "b"}, {"c"})
+    assert dependencies == [
+        set(),
+        set(),
+        {0},
+        {1},
+        {0, 2},
+        {0, 1, 2, 3, 4},
+        {0, 1, 2, 3, 4, 5},
+        {6},
+    ]
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "SET search_path TO osm;",
+        "RESET ALL;",
+        "BEGIN;",
+        "CREATE TEMP TABLE t AS SELECT * FROM a;",
+        "CREATE OR REPLACE TEMPORARY VIEW v AS SELECT * FROM a;",
+        "SELECT * INTO TEMP t FROM a;",
+        "SELECT set_config('search_path', 'osm', false);",
+    ],
+)
+def test_get_dependencies_rejects_session_statements(statement):
+
+    statements = sqf.split_statements("CREATE TABLE a AS SELECT 1 AS x;\n" + statement)
+
+    assert sqf.get_statement_tables(statements[1]["clean"])[0] == "SESSION"
+
+    with pytest.raises(ValueError, match="line 2"):
+        sqf.get_dependencies(statements)
+
+
+def test_run_sql_stages_stops_after_failed_stage(tmp_path, monkeypatch):
+
+    first = tmp_path / "first.sql"
+    first.write_text("CREATE TABLE a AS SELECT 1 AS x;\nUPDATE a SET x = 1 / 0;\nUPDATE a SET x = 2;\n")
+
+    second = tmp_path / "second.sql"
+    second.write_text("CREATE TABLE b AS SELECT * FROM a;\n")
+
+    executed = []
+
+    def run_statement(pool, statement):
+        if "/ 0" in statement:
+            raise Exception("division by zero")
+        executed.append(statement)
+        return 0.0
+
+    monkeypatch.setattr(sqf, "_run_statement", run_statement)
+
+    with pytest.raises(RuntimeError, match="first.sql"):
+        sqf.run_sql_stages([str(first), str(second)], pool=None, processes=1)
+
+    assert executed == ["CREATE TABLE a AS SELECT 1 AS x;"]
+
+
+def test_run_sql_stages_skips_dependent_stages(tmp_path, monkeypatch):
+
+    first = tmp_path / "first.sql"
+    first.write_text("CREATE TABLE a AS SELECT * FROM source;\nUPDATE a SET x = 1;\n")
+
+    # The second stage changes the table of the first stage in place
+    second = tmp_path / "second.sql"
+    second.write_text("ALTER TABLE a ADD COLUMN y INTEGER;\nCREATE TABLE b AS SELECT * FROM a;\n")
+
+    # Number of changes of each table, used as the table state
+    db = {"source": 0}
+    executed = []
+
+    def run_statement(pool, statement):
+        executed.append(statement)
+        for name in sqf.get_statement_tables(sqf.split_statements(statement)[0]["clean"])[2]:
+            db[name] = db.get(name, 0) + 1
+        return 0.0
+
+    monkeypatch.setattr(sqf, "_run_statement", run_statement)
+    monkeypatch.setattr(sqf, "_get_table_state", lambda pool, names: {n: db.get(n) for n in names})
+
+    fps = [str(first), str(second)]
+    state_fp = str(tmp_path / "state.json")
+
+    assert len(sqf.run_sql_stages(fps, pool=None, processes=1, state_fp=state_fp)) == 4
+    assert len(executed) == 4
+
+    assert len(sqf.run_sql_stages(fps, pool=None, processes=1, state_fp=state_fp)) == 0
+    assert len(executed) == 4
+
+    # The second stage changes a in place, so the first stage is run again when only the second stage is changed
+    second.write_text("ALTER TABLE a ADD COLUMN z INTEGER;\nCREATE TABLE b AS SELECT * FROM a;\n")
+    assert sqf.run_sql_stages(fps, pool=None, processes=1, state_fp=state_fp)["stage"].tolist() == [fps[0]] * 2 + [fps[1]] * 2
+
+    db["source"] += 1
+    assert len(sqf.run_sql_stages(fps, pool=None, processes=1, state_fp=state_fp)) == 4
+    assert len(sqf.run_sql_stages(fps, pool=None, processes=1, state_fp=state_fp)) == 0
+
+    # On its own, the second stage is never skipped, while the first stage is skipped if source has not changed
+    assert sqf.run_sql_stage(str(second), pool=None, processes=1, state_fp=state_fp) is not None
+    assert sqf.run_sql_stage(str(second), pool=None, processes=1, state_fp=state_fp) is not None
+    assert sqf.run_sql_stage(str(first), pool=None, processes=1, state_fp=state_fp) is not None
+    assert sqf.run_sql_stage(str(first), pool=None, processes=1, state_fp=state_fp) is None